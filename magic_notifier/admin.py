@@ -1,8 +1,14 @@
 from django.contrib import admin
 
-from magic_notifier.models import Notification
+from magic_notifier.models import Notification, OutboxItem
 
 
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
     list_display = ('id', 'subject', 'type', 'sub_type')
+
+
+@admin.register(OutboxItem)
+class OutboxItemAdmin(admin.ModelAdmin):
+    list_display = ('id', 'channel', 'user', 'subject', 'priority', 'status', 'attempts', 'updated')
+    list_filter = ('status', 'channel')
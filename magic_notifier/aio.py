@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import weakref
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+from asgiref.sync import sync_to_async
+
+logger = logging.getLogger("notifier")
+
+_done = object()
+
+# the http client of each event loop, an httpx client can't be shared between loops
+http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+
+
+def get_http_client() -> Any:
+    """Return the keep-alive httpx.AsyncClient of the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = http_clients.get(loop)
+    if client is None:
+        try:
+            import httpx
+        except ImportError as e:
+            raise ImportError("The async clients need httpx, install django-magic-notifier[async]") from e
+
+        client = httpx.AsyncClient()
+        http_clients[loop] = client
+    return client
+
+
+async def aiterate(iterator: Iterator) -> AsyncIterator:
+    """Iterate a blocking iterator, a chunked queryset for example, from async code.
+
+    Each item is produced in the thread where django runs the database queries, so the
+    iterator may hold a database cursor between two items.
+    """
+    next_item = sync_to_async(next)
+    while True:
+        item = await next_item(iterator, _done)
+        if item is _done:
+            return
+        yield item
+
+
+def async_method(obj: Any, name: str, sync_name: str) -> Callable[..., Awaitable]:
+    """Return the coroutine function name of obj, or its blocking sync_name method run in a thread.
+
+    The clients of the sdks without an async api (twilio, pyfcm...) are called this way.
+    """
+    method = getattr(obj, name, None)
+    if method is not None:
+        return method
+    return sync_to_async(getattr(obj, sync_name), thread_sensitive=False)
+
+
+async def limited(semaphore: Optional[asyncio.Semaphore], coroutine: Awaitable) -> Any:
+    """Await the coroutine once the semaphore lets it run, the errors are logged and returned"""
+    try:
+        if semaphore is None:
+            return await coroutine
+        async with semaphore:
+            return await coroutine
+    except Exception as e:
+        logger.exception("Can't send the notification")
+        return e
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class NotifConfig(AppConfig):
     name = "magic_notifier"
+
+    def ready(self):
+        from .registry import registry
+
+        # resolve the gateways once, instead of on every notification
+        registry.build()
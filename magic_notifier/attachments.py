@@ -0,0 +1,78 @@
+import base64
+import logging
+import mimetypes
+import mmap
+import os
+from email.mime.base import MIMEBase
+from typing import List, Optional, Union
+
+from django.conf import settings
+from django.core.mail.message import DEFAULT_ATTACHMENT_MIME_TYPE, SafeMIMEText
+
+logger = logging.getLogger("notifier")
+
+# files from this size are memory mapped instead of being read in memory
+MMAP_THRESHOLD = 1024 * 1024
+
+
+def read_path(path: str) -> Union[bytes, mmap.mmap]:
+    """Return the content of the file, memory mapped when it is large"""
+    with open(path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size >= MMAP_THRESHOLD:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return fp.read()
+
+
+def build_attachment(filename: str, content: Union[str, bytes, mmap.mmap], mimetype: Optional[str] = None) -> MIMEBase:
+    """Build the mime part of an attachment, encoded once to be shared by all the emails.
+
+    The parts are built like django does it, text files are attached as text when they can be decoded.
+    """
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(filename)[0] or DEFAULT_ATTACHMENT_MIME_TYPE
+    basetype, subtype = mimetype.split("/", 1)
+
+    if basetype == "text":
+        if not isinstance(content, str):
+            try:
+                content = bytes(content).decode()
+            except UnicodeDecodeError:
+                basetype, subtype = DEFAULT_ATTACHMENT_MIME_TYPE.split("/", 1)
+    elif isinstance(content, str):
+        content = content.encode()
+
+    if basetype == "text":
+        attachment = SafeMIMEText(content, subtype, settings.DEFAULT_CHARSET)
+    else:
+        attachment = MIMEBase(basetype, subtype)
+        attachment.set_payload(base64.encodebytes(content).decode("ascii"))
+        attachment["Content-Transfer-Encoding"] = "base64"
+    attachment.add_header("Content-Disposition", "attachment", filename=filename)
+    return attachment
+
+
+def load_attachments(files: Optional[list]) -> List[MIMEBase]:
+    """Read the files of a notification once and build their mime parts.
+
+    :param files: file paths, file-like objects or (name, file-like object) tuples
+    """
+    attachments: List[MIMEBase] = []
+    for i, pos_file in enumerate(files or []):
+        if isinstance(pos_file, str):
+            content = read_path(pos_file)
+            try:
+                attachments.append(build_attachment(os.path.basename(pos_file), content))
+            finally:
+                if isinstance(content, mmap.mmap):
+                    content.close()
+        elif isinstance(pos_file, tuple):
+            name, f = pos_file
+            if hasattr(f, 'read'):
+                attachments.append(build_attachment(name, f.read()))
+            else:
+                logger.warning(f"file {name} can't be added to mail because it is not a file-like object")
+        elif hasattr(pos_file, 'read'):
+            attachments.append(build_attachment(f"file {i + 1}", pos_file.read()))
+        else:
+            logger.warning(f"discarding possible file {pos_file}")
+    return attachments
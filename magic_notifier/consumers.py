@@ -1,79 +1,188 @@
 import binascii
 import ctypes
+import hashlib
 import json
 import logging
+import time
 import traceback
 from datetime import date, datetime, timedelta
 from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, Optional, Tuple
 
-from asgiref.sync import async_to_sync
 from channels.db import database_sync_to_async
-from channels.generic.websocket import WebsocketConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 from .models import Notification
 from .serializers import NotificationSerializer
+from .settings import NOTIFIER_WS_TOKEN_CACHE_SIZE, NOTIFIER_WS_TOKEN_TTL, NOTIFIER_WS_UNREAD_PAGE_SIZE
 
 logger = logging.getLogger("notif")
 
 
-class PushNotifConsumer(WebsocketConsumer):
+class TokenCache:
+    """The users of the websocket tokens, kept ttl seconds in the process.
+
+    A reconnecting client is authenticated without a database query. The tokens are stored
+    hashed, at most max_size of them, the oldest being dropped first.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        # token hash -> (expiry time, user), in insertion order
+        self.users: Dict[str, Tuple[float, Any]] = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[Any]:
+        cached = self.users.get(self.key(token))
+        if cached is None or cached[0] < time.monotonic():
+            return None
+        return cached[1]
+
+    def set(self, token: str, user: Any):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            while len(self.users) >= self.max_size:
+                self.users.pop(next(iter(self.users)))
+            self.users[self.key(token)] = (time.monotonic() + self.ttl, user)
+
+    def clear(self):
+        with self.lock:
+            self.users.clear()
+
+
+ws_users = TokenCache(NOTIFIER_WS_TOKEN_TTL, NOTIFIER_WS_TOKEN_CACHE_SIZE)
+
+
+@database_sync_to_async
+def fetch_user_from_ws_token(token: str):
+    from .registry import registry
+
+    get_user_from_ws_token_func = registry.hook("USER_FROM_WS_TOKEN_FUNCTION")
+    if get_user_from_ws_token_func is None:
+        raise KeyError("USER_FROM_WS_TOKEN_FUNCTION")
+    return get_user_from_ws_token_func(token)
+
+
+async def get_user_from_ws_token(token: str):
+    """Return the user of the token, from the cache or with USER_FROM_WS_TOKEN_FUNCTION"""
+    user = ws_users.get(token)
+    if user is None:
+        user = await fetch_user_from_ws_token(token)
+        ws_users.set(token, user)
+    return user
+
+
+class PushNotifConsumer(AsyncWebsocketConsumer):
+    """The websocket of a user, receiving the notifications sent to the group user-<id>.
+
+    The consumer doesn't hold a thread while the socket is idle, the database is only queried
+    in the database threads when needed.
+    """
+
+    # the handlers of the events a client may send, the other methods can't be called by the client
+    client_events = ("unread", "markread", "notify", "notification")
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.token: str = None
         self.user = None
 
-    def connect(self):
-        from .utils import get_settings, import_attribute
-
+    async def connect(self):
         try:
             logger.info(f"accepting")
-            self.accept()
+            await self.accept()
 
             self.token = self.scope["url_route"]["kwargs"]["token"]
-            get_user_from_ws_token_func = import_attribute(get_settings("USER_FROM_WS_TOKEN_FUNCTION"))
-            self.user = get_user_from_ws_token_func(self.token)
-
+            self.user = await get_user_from_ws_token(self.token)
 
-            async_to_sync(self.channel_layer.group_add)(f"user-{self.user.id}", self.channel_name)
+            await self.channel_layer.group_add(f"user-{self.user.id}", self.channel_name)
 
             logger.info("Accepted")
         except Exception as e:
-            print(traceback.print_exc())
             logger.error(traceback.format_exc())
+            await self.close()
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
+        if self.user is None:
+            return
         try:
-            async_to_sync(self.channel_layer.group_discard)(f"user-{self.user.id}", self.channel_name)
+            await self.channel_layer.group_discard(f"user-{self.user.id}", self.channel_name)
         except Exception as e:
-            print(traceback.format_exc())
-            logging.error(traceback.format_exc())
+            logger.error(traceback.format_exc())
 
-    def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         event = json.loads(text_data)
         logger.info("{} >> {}".format(self.user, text_data))
 
-        event_handler = getattr(self, event["type"].lower().replace(".", "_"), None)
-        if callable(event_handler):
-            event_handler(event)
+        event_type = str(event.get("type", "")).lower().replace(".", "_")
+        if event_type in self.client_events:
+            await getattr(self, event_type)(event)
 
-    def notify(self, data: dict):
-        self.send(json.dumps(data))
+    async def notify(self, data: dict):
+        await self.send(json.dumps(data))
 
-    def notification(self, data: dict):
-        self.send(json.dumps(data))
+    async def notification(self, data: dict):
+        await self.send(json.dumps(data))
 
-    def unread(self, event: dict):
-        notifs = Notification.objects.filter(user=self.user, read__isnull=True)
-        event["count"] = len(notifs)
-        event["notifications"] = NotificationSerializer(notifs, many=True).data
-        self.send(json.dumps(event))
+    @database_sync_to_async
+    def get_unread(self, since_id: Optional[int] = None, cursor: Optional[int] = None,
+                   limit: int = NOTIFIER_WS_UNREAD_PAGE_SIZE) -> Tuple[int, list, Optional[int]]:
+        """Return the number of unread notifications and a page of them, newest first.
 
-    def markread(self, event: dict):
+        :param since_id: only the notifications newer than this id are returned
+        :param cursor: the next_cursor of the previous page, the page starts after it
+        :param limit: the size of the page, at most NOTIFIER["WS_UNREAD_PAGE_SIZE"]
+        :return: the count, the serialized page and the cursor of the next page, None on the last page
+        """
+        notifs = Notification.objects.filter(user=self.user, read__isnull=True)
+        count = notifs.count()
+
+        page = notifs.order_by("-id")
+        if since_id is not None:
+            page = page.filter(id__gt=since_id)
+        if cursor is not None:
+            page = page.filter(id__lt=cursor)
+        # one more row tells if there is a next page
+        page = list(page[:limit + 1])
+        next_cursor = page[limit - 1].id if len(page) > limit else None
+        return count, NotificationSerializer(page[:limit], many=True).data, next_cursor
+
+    @database_sync_to_async
+    def mark_read(self, notification_id=None):
         notifs = Notification.objects.filter(user=self.user, read__isnull=True)
-        notification_id = event.get('notification')
         if notification_id:
             notifs = notifs.filter(pk=notification_id)
         notifs.update(read=timezone.now())
+
+    async def unread(self, event: dict):
+        """Send the number of unread notifications and a page of them.
+
+        The event may have since_id, cursor (the next_cursor of the previous page) and limit.
+        """
+        try:
+            since_id, cursor = [int(event[key]) if event.get(key) is not None else None
+                                for key in ("since_id", "cursor")]
+            limit = min(int(event.get("limit") or NOTIFIER_WS_UNREAD_PAGE_SIZE), NOTIFIER_WS_UNREAD_PAGE_SIZE)
+        except (TypeError, ValueError):
+            event["error"] = "since_id, cursor and limit must be integers"
+            await self.send(json.dumps(event))
+            return
+
+        count, notifications, next_cursor = await self.get_unread(since_id, cursor, max(limit, 1))
+        event["count"] = count
+        event["notifications"] = notifications
+        event["next_cursor"] = next_cursor
+        await self.send(json.dumps(event))
+
+    async def markread(self, event: dict):
+        await self.mark_read(event.get('notification'))
         event["success"] = True
-        self.send(json.dumps(event))
+        await self.send(json.dumps(event))
@@ -6,6 +6,8 @@ class AmazonSesClient:
 
     @classmethod
     def get_connection(cls, email_settings:dict):
+        # the gateway settings are reused for the next connections, don't consume them
+        email_settings = email_settings.copy()
         ses_backend = SESBackend(
             fail_silently=email_settings.pop('FAIL_SILENTLY', None),
             aws_session_profile=email_settings.pop('AWS_SESSION_PROFILE', None),
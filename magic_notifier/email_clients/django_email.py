@@ -1,6 +1,68 @@
+import smtplib
+
+from django.conf import settings
 from django.core.mail import get_connection
 
 
+class AsyncSmtpConnection:
+    """An smtp connection sending the django email messages with aiosmtplib, without blocking the event loop.
+
+    The errors of aiosmtplib meaning a refused recipient or a lost connection are raised as the smtplib ones.
+    """
+
+    def __init__(self, host: str, port: int, username: str = None, password: str = None,
+                 use_tls: bool = False, use_ssl: bool = False, timeout: float = None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.smtp = None
+
+    async def open(self):
+        try:
+            import aiosmtplib
+        except ImportError as e:
+            raise ImportError("Sending emails from async code needs aiosmtplib, "
+                              "install django-magic-notifier[async]") from e
+
+        self.smtp = aiosmtplib.SMTP(hostname=self.host, port=self.port, use_tls=self.use_ssl,
+                                    start_tls=self.use_tls, timeout=self.timeout)
+        await self.smtp.connect()
+        if self.username and self.password:
+            await self.smtp.login(self.username, self.password)
+
+    async def close(self):
+        if self.smtp is None:
+            return
+        try:
+            await self.smtp.quit()
+        except Exception:
+            pass
+        finally:
+            self.smtp = None
+
+    async def send_messages(self, email_messages: list) -> int:
+        import aiosmtplib
+
+        sent = 0
+        for message in email_messages:
+            if not message.recipients():
+                continue
+            try:
+                await self.smtp.send_message(message.message(), sender=message.from_email,
+                                             recipients=message.recipients())
+            except aiosmtplib.SMTPRecipientsRefused as e:
+                raise smtplib.SMTPRecipientsRefused({error.recipient: (error.code, error.message)
+                                                     for error in e.recipients}) from e
+            except aiosmtplib.SMTPServerDisconnected as e:
+                raise smtplib.SMTPServerDisconnected(str(e)) from e
+            sent += 1
+        return sent
+
+
 class DjangoEmailClient:
 
     @classmethod
@@ -19,4 +81,21 @@ class DjangoEmailClient:
             password=smtp_password,
             use_tls=smtp_use_tls,
             use_ssl=smtp_use_ssl,
-        )
\ No newline at end of file
+        )
+
+    @classmethod
+    def get_async_connection(cls, email_settings: dict):
+        """Return the connection used from async code, None when django doesn't send the emails by smtp"""
+        if settings.EMAIL_BACKEND != "django.core.mail.backends.smtp.EmailBackend":
+            # the locmem, console... backends are run in a thread
+            return None
+
+        return AsyncSmtpConnection(
+            host=email_settings["HOST"],
+            port=email_settings["PORT"],
+            username=email_settings["USER"],
+            password=email_settings["PASSWORD"],
+            use_tls=email_settings.get("USE_TLS", False),
+            use_ssl=email_settings.get("USE_SSL", False),
+            timeout=email_settings.get("TIMEOUT"),
+        )
@@ -1,26 +1,131 @@
+import asyncio
 import logging
 import os.path
+import smtplib
+import socket
+import time
 import traceback
 from argparse import OPTIONAL
+from collections import defaultdict
+from email.mime.base import MIMEBase
 from pathlib import Path
-from threading import Thread
-from typing import Optional, List
+from threading import Lock
+from typing import Any, Dict, Optional, List, Tuple
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
 from django.core.mail import EmailMultiAlternatives
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template import Template
 from django.template.exceptions import TemplateDoesNotExist
 from django.template.loader import render_to_string
 from django.utils.translation import gettext as _
-from mjml import mjml2html
 from functools import partial
 from django.template.engine import Engine
 
-from magic_notifier.utils import get_settings
-
-from .utils import import_attribute
+from magic_notifier.aio import aiterate
+from magic_notifier.attachments import load_attachments
+from magic_notifier.registry import registry
+from magic_notifier.rendering import NotifierTemplate, get_notifier_template
+from magic_notifier.settings import NOTIFIER_ASYNC_CONCURRENCY, NOTIFIER_CHUNK_SIZE
+from magic_notifier.utils import backoff_delay, chunked_receivers
+from magic_notifier.workers import submit
 
 logger = logging.getLogger("notifier")
 
+# mjml templates compiled to html django templates, path -> (modification time, template)
+compiled_mjml_templates: Dict[str, Tuple[float, Optional[Template]]] = {}
+
+# the errors meaning that the connection to the email server is lost
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout)
+
+
+class EmailConnectionPool:
+    """The open email backends of the process, kept between the notify() calls by gateway.
+
+    A connection is used by one emailer at a time, at most POOL_SIZE (default 4) idle
+    connections are kept per gateway.
+    """
+
+    def __init__(self):
+        self.idle_connections: Dict[str, list] = defaultdict(list)
+        self.lock = Lock()
+
+    def acquire(self, gateway: str, email_client, email_settings: dict):
+        while True:
+            with self.lock:
+                if not self.idle_connections[gateway]:
+                    break
+                connection = self.idle_connections[gateway].pop()
+            if self.is_alive(connection):
+                return connection
+            # the server closed the idle connection, it would fail the next send
+            logger.debug(f"discarding a closed connection of the {gateway} gateway")
+            self.discard(connection)
+
+        logger.debug(f"opening a new connection for the {gateway} gateway")
+        connection = email_client.get_connection(email_settings)
+        connection.open()
+        return connection
+
+    def release(self, gateway: str, connection, email_settings: dict):
+        with self.lock:
+            if len(self.idle_connections[gateway]) < email_settings.get("POOL_SIZE", 4):
+                self.idle_connections[gateway].append(connection)
+                return
+        self.discard(connection)
+
+    @staticmethod
+    def is_alive(connection) -> bool:
+        """Check the smtp connection of the backend with a NOOP, the other backends are kept as they are"""
+        smtp = getattr(connection, "connection", None)
+        if not isinstance(smtp, smtplib.SMTP):
+            return True
+        try:
+            return smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            logger.debug(traceback.format_exc())
+
+    def close_all(self):
+        with self.lock:
+            connections = [conn for conns in self.idle_connections.values() for conn in conns]
+            self.idle_connections.clear()
+
+        for connection in connections:
+            self.discard(connection)
+
+
+email_connections = EmailConnectionPool()
+
+
+class ThreadedConnection:
+    """An email backend without async api used from async code, its calls are run in a thread"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def open(self):
+        return await sync_to_async(self.connection.open, thread_sensitive=False)()
+
+    async def close(self):
+        return await sync_to_async(self.connection.close, thread_sensitive=False)()
+
+    async def send_messages(self, email_messages: list) -> int:
+        return await sync_to_async(self.connection.send_messages, thread_sensitive=False)(email_messages)
+
+
+@receiver(setting_changed)
+def close_email_connections(setting, **kwargs):
+    if setting == "NOTIFIER":
+        email_connections.close_all()
+
 
 class Emailer:
     def __init__(
@@ -38,40 +143,55 @@ class Emailer:
         """The class is reponsible of email sending.
 
         :param subject: the subject of the notification, ignored when send by sms
-        :param receivers: list of User
+        :param receivers: list, queryset or manager of User
         :param template: the name of the template to user. Default None
         :param context: the context to be passed to template. Default None
         :param email_gateway: the email gateway to use. Default 'default'
         :param final_message: the final message to be sent as the notification content, must be sent if template is None, template is ignored if it is sent. Default None
         :param files: list of files to be sent. accept file-like objects, tuple, file path. Default None
-        :param kwargs:
+        :param kwargs: accept threaded and chunk_size (number of receivers loaded at once, default NOTIFIER["CHUNK_SIZE"])
         """
-        try:
-            NOTIFIER_EMAIL = get_settings('EMAIL')
-            NOTIFIER_EMAIL_DEFAULT_GATEWAY = NOTIFIER_EMAIL.get('DEFAULT_GATEWAY', 'default')
-        except (AttributeError, KeyError):
-            from magic_notifier.settings import NOTIFIER_EMAIL, NOTIFIER_EMAIL_DEFAULT_GATEWAY
-
-        self.fallback_gateways = NOTIFIER_EMAIL.get('FALLBACKS', [])
-        self.current_gateway = email_gateway if email_gateway else NOTIFIER_EMAIL_DEFAULT_GATEWAY
-        self.email_settings: dict = NOTIFIER_EMAIL[self.current_gateway]
-        self.email_client = import_attribute(self.email_settings["CLIENT"])
+        # get the gateway, resolved once by the registry
+        gateway = registry.get("email", email_gateway or None)
+        self.fallback_gateways = registry.get_fallbacks("email")
+        self.current_gateway = gateway.name
+        self.email_settings: dict = gateway.options
+        self.email_client = gateway.client_class
+        self.rate_limiter = gateway.rate_limiter
 
         self.tried_gateways = tried_gateways if tried_gateways else []
 
-        self.connection = self.email_client.get_connection(self.email_settings)
+        self.connection = None
+        self.async_connection = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.batch_size: int = self.email_settings.get("BATCH_SIZE", 100)
         self.subject: str = subject
-        self.receivers: list = receivers
+        self.receivers = receivers
         self.template: Optional[str] = template
         self.context: dict = context if context else {}
         self.final_message = final_message
         self.threaded: bool = kwargs.get("threaded", False)
+        # raise the errors of the send instead of logging them, set by send_via
+        self.raise_errors: bool = False
+        # the pks of the users reached by the send and the errors of the others, recorded by the outbox
+        self.delivered: set = set()
+        self.failed: Dict[Any, str] = {}
+        self.chunk_size: int = kwargs.get("chunk_size") or NOTIFIER_CHUNK_SIZE
         self.files: Optional[list] = files
+        # read before sending, the file-like objects may be closed by then when threaded
+        self.attachments: List[MIMEBase] = load_attachments(files)
         self.current_engine = Engine.get_default()
+        self.tpl_abs_path = None
+        self.mjml_source = None
+        self.templates_loaded = False
+        self.mjml_template: Optional[NotifierTemplate] = None
+        self.html_template: Optional[NotifierTemplate] = None
+        self.text_template: Optional[NotifierTemplate] = None
         if self.template:
-            self.tpl_abs_path = self.current_engine.find_template(f"notifier/{self.template}/email.mjml")[1].name
-        else:
-            self.tpl_abs_path = None
+            mjml_template = get_notifier_template(self.template, "email.mjml")
+            if mjml_template is not None:
+                self.tpl_abs_path = mjml_template.origin.name
+                self.mjml_source = mjml_template.template.source
         logger.info(f"{self.tpl_abs_path = }")
 
     def mjml_loader(self, dest: str):
@@ -80,94 +200,344 @@ class Emailer:
             res = fp.read()
         return res
 
+    def get_compiled_mjml(self) -> Optional[Template]:
+        """Return the mjml template compiled to an html django template.
+
+        The mjml compilation is done once per template file and modification time, only the
+        django layer is rendered per recipient. None is returned when the template can't be
+        compiled before being rendered by django (when it extends another template for example).
+        """
+        try:
+            mtime = os.path.getmtime(self.tpl_abs_path)
+        except OSError:
+            mtime = 0.0
+
+        cached = compiled_mjml_templates.get(self.tpl_abs_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        source = self.mjml_source
+        # text outside of the mjml root ({% load %} tags for example) is kept as is
+        start = source.find("<mjml")
+        end = source.rfind("</mjml>")
+        compiled = None
+        if start >= 0 and end >= 0:
+            end += len("</mjml>")
+            try:
+                from mjml import mjml2html
+
+                html_content = mjml2html(source[start:end], include_loader=self.mjml_loader)
+                compiled = self.current_engine.from_string(source[:start] + html_content + source[end:])
+            except Exception:
+                logger.warning(f"Can't precompile {self.tpl_abs_path}, it will be compiled per recipient")
+                logger.debug(traceback.format_exc())
+
+        compiled_mjml_templates[self.tpl_abs_path] = (mtime, compiled)
+        return compiled
+
+    def load_templates(self):
+        """Load the templates of the email, once per notification"""
+        if self.templates_loaded or not self.template:
+            return
+        if self.tpl_abs_path:
+            compiled_mjml = self.get_compiled_mjml()
+            if compiled_mjml:
+                self.mjml_template = NotifierTemplate(compiled_mjml, self.context)
+        try:
+            self.html_template = NotifierTemplate.for_channel(self.template, "email.html", self.context)
+        except TemplateDoesNotExist:
+            self.html_template = None
+        self.text_template = NotifierTemplate.for_channel(self.template, "email.txt", self.context)
+        self.templates_loaded = True
+
+    def receivers_fields(self) -> Optional[tuple]:
+        """The user columns needed to send the emails, None meaning all of them.
+
+        When a template references the user it may use any attribute of the user."""
+        if self.template:
+            self.load_templates()
+            if self.tpl_abs_path and self.mjml_template is None:
+                return None
+            templates = [self.mjml_template, self.html_template, self.text_template]
+            if any(template is not None and not template.shared for template in templates):
+                return None
+        return ("pk", "username", "email")
+
     def send(self):
         if self.threaded:
-            t = Thread(target=self._send)
-            t.setDaemon(True)
-            t.start()
+            submit("email", self._send)
         else:
             self._send()
 
-    def _send(self):
-        try:
-            logger.info(f"sending emails to {self.receivers}")
-            for user in self.receivers:
-                # activate(user.settings.lang)
-                if isinstance(user, str):
-                    user = User(email=user, username=user)
+    def switch_gateway(self) -> bool:
+        """Switch to the next fallback gateway not tried yet, return False if there is none left"""
+        self.tried_gateways.append(self.current_gateway)
+        for gateway_name in self.fallback_gateways:
+            if gateway_name not in self.tried_gateways:
+                logger.warning(f"We are falling back to {gateway_name} gateway")
+                gateway = registry.get("email", gateway_name)
+                self.current_gateway = gateway.name
+                self.email_settings = gateway.options
+                self.email_client = gateway.client_class
+                self.rate_limiter = gateway.rate_limiter
+                self.batch_size = self.email_settings.get("BATCH_SIZE", 100)
+                return True
+        return False
+
+    def connect(self):
+        """Acquire a connection to the current gateway, falling back to the next gateways when it fails"""
+        while True:
+            try:
+                self.connection = email_connections.acquire(self.current_gateway, self.email_client,
+                                                            self.email_settings)
+                return
+            except Exception:
+                logger.error(traceback.format_exc())
+                if not self.switch_gateway():
+                    raise
+
+    def send_message(self, message: EmailMultiAlternatives):
+        """Send a message with the pooled connection, retrying with an exponential backoff.
+
+        A lost connection is reopened before retrying. A refused recipient is not retried.
+        """
+        retries = self.email_settings.get("RETRIES", 2)
+        for attempt in range(retries + 1):
+            try:
+                self.connection.send_messages([message])
+                return
+            except smtplib.SMTPRecipientsRefused:
+                raise
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                delay = backoff_delay(attempt, self.email_settings.get("RETRY_DELAY", 1.0),
+                                      self.email_settings.get("RETRY_MAX_DELAY", 30.0))
+                logger.warning(f"Sending to {message.to} via {self.current_gateway} failed ({e!r}), "
+                               f"retrying in {delay:.2f}s")
+                time.sleep(delay)
+                if isinstance(e, CONNECTION_ERRORS):
+                    try:
+                        self.connection.close()
+                        self.connection.open()
+                    except Exception:
+                        logger.debug(traceback.format_exc())
+
+    def send_messages(self, messages: list) -> list:
+        """Send a batch of messages with the pooled connection.
+
+        :return: the messages not sent because the gateway failed, starting with the failing one
+        """
+        if not messages:
+            return []
+        logger.debug(f"Sending {len(messages)} emails via connection")
+        sent = 0
+        for batch in self.rate_limiter.paced(messages):
+            for message in batch:
+                try:
+                    self.send_message(message)
+                except smtplib.SMTPRecipientsRefused:
+                    self.failed[message.user_pk] = f"The recipients {message.to} were refused by {self.current_gateway}"
+                    logger.error(self.failed[message.user_pk])
+                except Exception:
+                    logger.error(traceback.format_exc())
+                    return messages[sent:]
+                else:
+                    self.delivered.add(message.user_pk)
+                sent += 1
+        logger.debug(f"Emails sent!")
+        return []
+
+    def flush(self, messages: list):
+        """Send the messages, the ones a gateway fails to send are sent by the next fallback gateway"""
+        failed = self.send_messages(messages)
+        while failed:
+            email_connections.discard(self.connection)
+            self.connection = None
+            if not self.switch_gateway():
+                raise RuntimeError(f"{len(failed)} emails could not be sent by the gateways {self.tried_gateways}")
+            self.connect()
+            # the messages already rendered are reused
+            for message in failed:
+                message.from_email = self.email_settings["FROM"]
+            failed = self.send_messages(failed)
+
+    def build_message(self, user) -> EmailMultiAlternatives:
+        """Render the email of the user"""
+        # activate(user.settings.lang)
+        if isinstance(user, str):
+            user = User(email=user, username=user)
+
+        logger.info(f" Sending to user {user.username} with context {self.context}")
 
+        if self.template:
+            self.load_templates()
+            html_content = None
+            if self.mjml_template is not None:
+                html_content = self.mjml_template.render(user)
+            elif self.tpl_abs_path:
                 ctx = self.context.copy()
                 ctx["user"] = user
-                logger.info(f" Sending to user {user.username} with context {ctx}")
+                mjml_content = render_to_string(
+                    f"notifier/{self.template}/email.mjml", ctx
+                )
+                logger.debug("mjml_content")
+                logger.debug(mjml_content)
+                from mjml import mjml2html
+
+                html_content = mjml2html(mjml_content, include_loader=self.mjml_loader)
+            logger.debug("html_content")
+            logger.debug(html_content)
+
+            if not html_content and self.html_template is not None:
+                html_content = self.html_template.render(user)  # render with dynamic value
+                logger.debug("html_content")
+                logger.debug(html_content)
+
+            text_content = self.text_template.render(user)  # render with dynamic value
+            logger.debug("text_content")
+            logger.debug(text_content)
+        else:
+            html_content = text_content = self.final_message
+
+        msg = EmailMultiAlternatives(
+            self.subject,
+            text_content,
+            self.email_settings["FROM"],
+            [user.email],
+        )
+        # recorded as delivered once the email is sent
+        msg.user_pk = user.pk
+        if html_content:
+            msg.attach_alternative(html_content, "text/html")
+
+        # the parts are shared by all the emails of the notification
+        for attachment in self.attachments:
+            msg.attach(attachment)
+
+        return msg
+
+    def _send(self):
+        try:
+            logger.info(f"sending emails with subject {self.subject}")
+            self.connect()
+            messages = []
+            for receivers in chunked_receivers(self.receivers, self.chunk_size, self.receivers_fields()):
+                for user in receivers:
+                    messages.append(self.build_message(user))
+                    if len(messages) >= self.batch_size:
+                        self.flush(messages)
+                        messages = []
+
+            self.flush(messages)
+            email_connections.release(self.current_gateway, self.connection, self.email_settings)
+        except Exception:
+            if self.connection:
+                email_connections.discard(self.connection)
+            if self.raise_errors:
+                raise
+            logger.error(traceback.format_exc())
+
+    async def aconnect(self):
+        """Like connect, the connection is opened without blocking the event loop.
 
-                if self.template:
+        The async connections are not pooled, they are bound to the event loop they were opened in.
+        """
+        while True:
+            try:
+                get_async_connection = getattr(self.email_client, "get_async_connection", None)
+                connection = get_async_connection(self.email_settings) if get_async_connection else None
+                if connection is None:
+                    connection = ThreadedConnection(await sync_to_async(
+                        self.email_client.get_connection, thread_sensitive=False)(self.email_settings))
+                await connection.open()
+                self.async_connection = connection
+                return
+            except Exception:
+                logger.error(traceback.format_exc())
+                if not self.switch_gateway():
+                    raise
+
+    async def aclose(self):
+        if self.async_connection is not None:
+            try:
+                await self.async_connection.close()
+            except Exception:
+                logger.debug(traceback.format_exc())
+            self.async_connection = None
+
+    async def asend_message(self, message: EmailMultiAlternatives):
+        """Like send_message, waiting between the retries without blocking the event loop"""
+        retries = self.email_settings.get("RETRIES", 2)
+        for attempt in range(retries + 1):
+            try:
+                async with self.semaphore:
+                    await self.async_connection.send_messages([message])
+                return
+            except smtplib.SMTPRecipientsRefused:
+                raise
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                delay = backoff_delay(attempt, self.email_settings.get("RETRY_DELAY", 1.0),
+                                      self.email_settings.get("RETRY_MAX_DELAY", 30.0))
+                logger.warning(f"Sending to {message.to} via {self.current_gateway} failed ({e!r}), "
+                               f"retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                if isinstance(e, CONNECTION_ERRORS):
                     try:
-                        mjml_content = render_to_string(
-                            f"notifier/{self.template}/email.mjml", ctx
-                        )
-                        logger.debug("mjml_content")
-                        logger.debug(mjml_content)
-                        html_content = mjml2html(mjml_content, include_loader=self.mjml_loader)
-                        logger.debug("html_content")
-                        logger.debug(html_content)
-                    except TemplateDoesNotExist as e:
-                        html_content = None
-
-                    if not html_content:
-                        try:
-                            html_content = render_to_string(
-                                f"notifier/{self.template}/email.html", ctx
-                            )  # render with dynamic value
-                            logger.debug("html_content")
-                            logger.debug(html_content)
-                        except TemplateDoesNotExist:
-                            html_content = None
-
-                    text_content = render_to_string(
-                        f"notifier/{self.template}/email.txt", ctx
-                    )  # render with dynamic value
-                    logger.debug("text_content")
-                    logger.debug(text_content)
+                        await self.async_connection.close()
+                        await self.async_connection.open()
+                    except Exception:
+                        logger.debug(traceback.format_exc())
+
+    async def asend_messages(self, messages: list) -> list:
+        """Like send_messages, return the messages not sent because the gateway failed"""
+        sent = 0
+        async for batch in self.rate_limiter.apaced(messages):
+            for message in batch:
+                try:
+                    await self.asend_message(message)
+                except smtplib.SMTPRecipientsRefused:
+                    self.failed[message.user_pk] = f"The recipients {message.to} were refused by {self.current_gateway}"
+                    logger.error(self.failed[message.user_pk])
+                except Exception:
+                    logger.error(traceback.format_exc())
+                    return messages[sent:]
                 else:
-                    html_content = text_content = self.final_message
-
-                msg = EmailMultiAlternatives(
-                    self.subject,
-                    text_content,
-                    self.email_settings["FROM"],
-                    [user.email],
-                    connection=self.connection,
-                )
-                if html_content:
-                    msg.attach_alternative(html_content, "text/html")
-
-                if self.files:
-                    for i, pos_file in enumerate(self.files):
-                        if isinstance(pos_file, str):
-                            msg.attach_file(pos_file)
-                        elif isinstance(pos_file, tuple):
-                            name, f = pos_file
-                            if hasattr(f, 'read'):
-                                msg.attach(name, f.read())
-                            else:
-                                logger.warning(
-                                    f"file {name} can't be added to mail because it is not a file-like object")
-                        elif hasattr(pos_file, 'read'):
-                            msg.attach(f"file {i + 1}", pos_file.read())
-                        else:
-                            logger.warning(f"discarding possible file {pos_file}")
-
-                logger.debug(f"Sending email via connection")
-                msg.send()
-                logger.debug(f"Email sent!")
-        except Exception as e:
+                    self.delivered.add(message.user_pk)
+                sent += 1
+        return []
+
+    async def aflush(self, messages: list):
+        """Like flush, the messages failed by a gateway are sent by the next fallback gateway"""
+        failed = await self.asend_messages(messages)
+        while failed:
+            await self.aclose()
+            if not self.switch_gateway():
+                raise RuntimeError(f"{len(failed)} emails could not be sent by the gateways {self.tried_gateways}")
+            await self.aconnect()
+            for message in failed:
+                message.from_email = self.email_settings["FROM"]
+            failed = await self.asend_messages(failed)
+
+    async def asend(self, semaphore: Optional[asyncio.Semaphore] = None):
+        """Send the emails without blocking the event loop.
+
+        The receivers are loaded and the emails rendered in the database thread, chunk by chunk. The
+        emails are sent one after the other through one smtp connection, at most semaphore sends of
+        the notification being in flight at the same time.
+        """
+        self.semaphore = semaphore or asyncio.Semaphore(NOTIFIER_ASYNC_CONCURRENCY)
+        try:
+            logger.info(f"sending emails with subject {self.subject}")
+            fields = await sync_to_async(self.receivers_fields)()
+            await self.aconnect()
+            chunks = chunked_receivers(self.receivers, self.chunk_size, fields)
+            async for messages in aiterate([self.build_message(user) for user in receivers] for receivers in chunks):
+                for start in range(0, len(messages), self.batch_size):
+                    await self.aflush(messages[start:start + self.batch_size])
+        except Exception:
             logger.error(traceback.format_exc())
-            self.tried_gateways.append(self.current_gateway)
-            if self.fallback_gateways:
-                for gateway in self.fallback_gateways:
-                    if gateway not in self.tried_gateways:
-                        logger.warning(f"We are falling back to {gateway} gateway")
-                        new_emailer = Emailer(self.subject, self.receivers, self.template, self.context,
-                                              email_gateway=gateway, final_message=self.final_message,
-                                              files=self.files, tried_gateways=self.tried_gateways)
-                        return new_emailer.send()
+        finally:
+            await self.aclose()
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from magic_notifier.outbox import process_batch, requeue_stale
+
+
+class Command(BaseCommand):
+    """The command `process_outbox` sends the notifications enqueued with notify(..., enqueue=True).
+    Many instances can run at the same time, each one claims its own batches."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=None, required=False,
+                            help="The number of items claimed at once. default to NOTIFIER['OUTBOX']['BATCH_SIZE']")
+        parser.add_argument('-c', '--channel', type=str, default=None, required=False,
+                            help="Only send the items of this channel")
+        parser.add_argument('-l', '--loop', action='store_true',
+                            help="Keep waiting for new items instead of exiting when the outbox is empty")
+        parser.add_argument('-s', '--sleep', type=float, default=1.0, required=False,
+                            help="The seconds to wait when the outbox is empty in loop mode. default to 1")
+
+    def handle(self, *args, **options):
+        total = 0
+        requeue_stale()
+        while True:
+            processed = process_batch(options['batch_size'], options['channel'])
+            total += processed
+            if processed:
+                continue
+            if not options['loop']:
+                break
+            requeue_stale()
+            time.sleep(options['sleep'])
+
+        self.stdout.write(f"{total} items processed")
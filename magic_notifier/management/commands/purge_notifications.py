@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from magic_notifier.purge import purge_notifications
+
+
+class Command(BaseCommand):
+    """The command `purge_notifications` deletes the expired notifications and the old read ones.
+    The rows are deleted by small chunks, it can run while the notifications are used."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--read-retention', type=int, default=None, required=False,
+                            help="The days the read notifications are kept. default to NOTIFIER['PURGE']['READ_RETENTION']")
+        parser.add_argument('-e', '--expired-only', action='store_true',
+                            help="Only delete the expired notifications")
+        parser.add_argument('-c', '--chunk-size', type=int, default=None, required=False,
+                            help="The maximum number of rows deleted at once. default to NOTIFIER['PURGE']['CHUNK_SIZE']")
+        parser.add_argument('-s', '--sleep', type=float, default=None, required=False,
+                            help="The seconds to wait between two deletes. default to NOTIFIER['PURGE']['SLEEP']")
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        deleted = purge_notifications(options['read_retention'], options['chunk_size'], options['sleep'],
+                                      options['expired_only'])
+        duration = time.monotonic() - start
+        rate = deleted / duration if duration else 0
+        self.stdout.write(f"{deleted} notifications deleted in {duration:.1f}s ({rate:.0f} rows/s)")
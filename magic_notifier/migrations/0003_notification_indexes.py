@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:52
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class AddIndex(migrations.AddIndex):
+    """Build the index without blocking the writes to the table on postgresql"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            if schema_editor.connection.vendor == "postgresql":
+                schema_editor.add_index(model, self.index, concurrently=True)
+            else:
+                schema_editor.add_index(model, self.index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            if schema_editor.connection.vendor == "postgresql":
+                schema_editor.remove_index(model, self.index, concurrently=True)
+            else:
+                schema_editor.remove_index(model, self.index)
+
+
+class Migration(migrations.Migration):
+
+    # the indexes are built concurrently on postgresql, outside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('magic_notifier', '0002_outboxitem'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('read__isnull', True)), fields=['user', '-id'], name='magic_notif_unread_idx'),
+        ),
+        AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', '-sent'], name='magic_notif_user_sent_idx'),
+        ),
+        AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('expires__isnull', False)), fields=['expires'], name='magic_notif_expires_idx'),
+        ),
+    ]
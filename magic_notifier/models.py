@@ -89,6 +89,18 @@ class Notification(models.Model):
     )
     masked: models.BooleanField = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # the unread notifications of a user, newest first (count, pages and markread of the consumer)
+            models.Index(fields=["user", "-id"], condition=models.Q(read__isnull=True),
+                         name="magic_notif_unread_idx"),
+            # the notifications of a user, most recent first
+            models.Index(fields=["user", "-sent"], name="magic_notif_user_sent_idx"),
+            # the expired notifications, most of them never expire
+            models.Index(fields=["expires"], condition=models.Q(expires__isnull=False),
+                         name="magic_notif_expires_idx"),
+        ]
+
     def __str__(self):
         if self.user and self.user.username:
             user_name = self.user.username
@@ -117,3 +129,36 @@ class NotifyProfile(models.Model):
     phone_number: models.CharField = models.CharField(max_length=20, null=True, blank=True)
     current_channel: models.CharField = models.CharField(max_length=255, null=True, blank=True)
     user: models.OneToOneField = models.OneToOneField(User, models.CASCADE)
+
+
+class OutboxItem(models.Model):
+    """A notification waiting to be sent by a worker, for one receiver through one channel"""
+
+    PENDING = "pending"
+    PROCESSING = "processing"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUSES = [(PENDING, "Pending"), (PROCESSING, "Processing"), (SENT, "Sent"), (FAILED, "Failed")]
+
+    id = models.BigAutoField(primary_key=True)
+    channel: models.CharField = models.CharField(max_length=20)
+    user: models.ForeignKey = models.ForeignKey(User, models.CASCADE, related_name="magic_outbox_items")
+    subject: models.CharField = models.CharField(max_length=255, null=True, blank=True)
+    template: models.CharField = models.CharField(max_length=255, null=True, blank=True)
+    context: JSONField = JSONField(default=dict)
+    final_message: models.TextField = models.TextField(null=True, blank=True)
+    gateway: models.CharField = models.CharField(max_length=100, null=True, blank=True)
+    # the other arguments of the channel, like remove_notification_fields for push
+    options: JSONField = JSONField(default=dict)
+    priority: models.SmallIntegerField = models.SmallIntegerField(default=0)
+    status: models.CharField = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    attempts: models.PositiveSmallIntegerField = models.PositiveSmallIntegerField(default=0)
+    error: models.TextField = models.TextField(null=True, blank=True)
+    created: models.DateTimeField = models.DateTimeField(auto_now_add=True)
+    updated: models.DateTimeField = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "-priority", "id"], name="magic_outbox_claim_idx")]
+
+    def __str__(self):
+        return "{} #{} to {}".format(self.channel, self.id, self.user_id)
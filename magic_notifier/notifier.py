@@ -1,23 +1,41 @@
+import asyncio
 import logging
 import traceback
 from typing import Optional, Union
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
 from django.db import models
 
-from magic_notifier.emailer import Emailer
 from magic_notifier.models import Notification
-from magic_notifier.pusher import Pusher
-from magic_notifier.settings import NOTIFIER_THREADED
-from magic_notifier.smser import ExternalSMS
-from magic_notifier.telegramer import Telegramer
-from magic_notifier.whatsapper import Whatsapper
+from magic_notifier.settings import NOTIFIER_ASYNC_CONCURRENCY, NOTIFIER_CHUNK_SIZE, NOTIFIER_THREADED
 
 User = get_user_model()
 
 logger = logging.getLogger("notifier")
 
 
+def get_receivers(receivers: Union[str, list, models.QuerySet, models.Manager]) -> Union[list, models.QuerySet, models.Manager]:
+    """Return the users designated by the receivers argument of notify, querysets are not evaluated"""
+    if isinstance(receivers, str):
+        if receivers in ["admins", "staff", "all", "all-staff", "all-admins"]:
+            if receivers == "admins":
+                receivers = User.objects.filter(is_superuser=True)
+            elif receivers == "staff":
+                receivers = User.objects.filter(is_staff=True)
+            elif receivers == "all":
+                receivers = User.objects.all()
+            elif receivers == "all-staff":
+                receivers = User.objects.exclude(is_staff=True)
+            elif receivers == "all-admins":
+                receivers = User.objects.exclude(is_superuser=True)
+        else:
+            raise ValueError(f"'{receivers}' is not an allowed value for receivers arguments")
+
+    assert isinstance(receivers, (list, models.Manager, models.QuerySet)), f"receivers must be a list at this point not {receivers}"
+    return receivers
+
+
 def notify(
     vias: list,
     subject: str = None,
@@ -35,6 +53,9 @@ def notify(
     files: list = None,
     threaded: bool = None,
     inited_by: User = None,
+    chunk_size: int = None,
+    enqueue: bool = False,
+    priority: int = 0,
 ):
     """This function send a notification via the method specified in parameter vias
 
@@ -48,74 +69,197 @@ def notify(
     :param sms_gateway: the sms gateway to use. Default to None
     :param files: list of files to be sent. accept file-like objects, tuple, file path. Default None
     :param threaded: if True, the notification is sent in background else sent with the current thread. Default to NOTIFIER["THREADED"] settings
+    :param chunk_size: the number of receivers loaded and sent at once, querysets are streamed chunk by chunk instead of being loaded entirely. Default to NOTIFIER["CHUNK_SIZE"] settings
+    :param enqueue: if True, the notification is written to the outbox and sent later by the process_outbox command or celery task. The context must be JSON serializable. Default False
+    :param priority: the priority of the enqueued notification, higher is sent first. Default 0
     :return:
     """
-    logger.debug(f"Sending {subject} to {receivers} via {vias}")
+    # don't format a queryset of receivers, it would be evaluated
+    logger.debug(f"Sending {subject} to {receivers if isinstance(receivers, (str, list)) else 'a queryset'} via {vias}")
     threaded = threaded if threaded is not None else NOTIFIER_THREADED
+    chunk_size = chunk_size if chunk_size else NOTIFIER_CHUNK_SIZE
     context = {} if context is None else context
 
     assert subject, "subject not defined"
 
 
-    if isinstance(receivers, str):
-        if receivers in ["admins", "staff", "all", "all-staff", "all-admins"]:
-            if receivers == "admins":
-                receivers = User.objects.filter(is_superuser=True)
-            elif receivers == "staff":
-                receivers = User.objects.filter(is_staff=True)
-            elif receivers == "all":
-                receivers = User.objects.all()
-            elif receivers == "all-staff":
-                receivers = User.objects.exclude(is_staff=True)
-            elif receivers == "all-admins":
-                receivers = User.objects.exclude(is_superuser=True)
-        else:
-            raise ValueError(f"'{receivers}' is not an allowed value for receivers arguments")
+    receivers = get_receivers(receivers)
 
-    assert isinstance(receivers, (list, models.Manager, models.QuerySet)), f"receivers must be a list at this point not {receivers}"
+    if enqueue:
+        from magic_notifier.outbox import enqueue_notification
+
+        enqueue_notification(vias, subject, receivers, template, context, final_message=final_message,
+                             email_gateway=email_gateway, sms_gateway=sms_gateway,
+                             whatsapp_gateway=whatsapp_gateway, telegram_gateway=telegram_gateway,
+                             push_gateway=push_gateway, remove_notification_fields=remove_notification_fields,
+                             files=files, final_notification=final_notification, inited_by=inited_by,
+                             priority=priority, chunk_size=chunk_size)
+        return
 
     for via in vias:
         try:
-            if via == "email":
-                em = Emailer(
-                    subject,
-                    list(receivers),
-                    template,
-                    context,
-                    email_gateway,
-                    threaded=threaded,
-                    final_message=final_message,
-                    files=files
-                )
-                em.send()
-
-            elif via == "sms":
-                ex_sms = ExternalSMS(receivers,context, threaded=threaded,
-                    template=template, final_message=final_message,
-                    sms_gateway=sms_gateway)
-                ex_sms.send()
-
-            elif via == "push":
-                assert template, "template variable can't be None or empty"
-
-                pusher = Pusher(
-                    subject, receivers, template, context, threaded=threaded, push_gateway=push_gateway,
-                    remove_notification_fields=remove_notification_fields, final_notification=final_notification,
-                    inited_by=inited_by
-                )
-                pusher.send()
-            elif via == "whatsapp":
-                whatsapper = Whatsapper(receivers,context, threaded=threaded,
-                    template=template, final_message=final_message,
-                    whatsapp_gateway=whatsapp_gateway)
-                whatsapper.send()
-            elif via == "telegram":
-                telegramer = Telegramer(receivers, context, threaded=threaded,
-                        template=template, final_message=final_message,
-                        telegram_gateway=telegram_gateway)
-                telegramer.send()
-            else:
-                logger.error(f"Unknown sending method {via}")
-
+            send_via(via, subject, receivers, template, context, final_message=final_message,
+                     final_notification=final_notification, email_gateway=email_gateway,
+                     sms_gateway=sms_gateway, whatsapp_gateway=whatsapp_gateway,
+                     telegram_gateway=telegram_gateway, push_gateway=push_gateway,
+                     remove_notification_fields=remove_notification_fields, files=files,
+                     threaded=threaded, inited_by=inited_by, chunk_size=chunk_size)
         except:
             logger.error(traceback.format_exc())
+
+
+def get_sender(
+    via: str,
+    subject: str,
+    receivers: Union[list, models.QuerySet, models.Manager],
+    template: str = None,
+    context: dict = None,
+    final_message: str = None,
+    final_notification: Optional[Notification] = None,
+    email_gateway: Optional[str] = None,
+    sms_gateway: Optional[str] = None,
+    whatsapp_gateway: Optional[str] = None,
+    telegram_gateway: Optional[str] = None,
+    push_gateway: Optional[str] = None,
+    remove_notification_fields: list = None,
+    files: list = None,
+    threaded: bool = False,
+    inited_by: User = None,
+    chunk_size: int = None,
+):
+    """Return the sender of the channel, its send method sends the notification.
+
+    The parameters are the ones of send_via.
+    """
+    context = {} if context is None else context
+
+    # the channel modules and their sdk are only imported when a notification goes through them
+    if via == "email":
+        from magic_notifier.emailer import Emailer
+
+        return Emailer(
+            subject,
+            receivers,
+            template,
+            context,
+            email_gateway,
+            threaded=threaded,
+            final_message=final_message,
+            files=files,
+            chunk_size=chunk_size
+        )
+
+    elif via == "sms":
+        from magic_notifier.smser import ExternalSMS
+
+        return ExternalSMS(receivers,context, threaded=threaded,
+            template=template, final_message=final_message,
+            sms_gateway=sms_gateway, chunk_size=chunk_size)
+
+    elif via == "push":
+        assert template, "template variable can't be None or empty"
+        from magic_notifier.pusher import Pusher
+
+        return Pusher(
+            subject, receivers, template, context, threaded=threaded, push_gateway=push_gateway,
+            remove_notification_fields=remove_notification_fields, final_notification=final_notification,
+            inited_by=inited_by, chunk_size=chunk_size
+        )
+    elif via == "whatsapp":
+        from magic_notifier.whatsapper import Whatsapper
+
+        return Whatsapper(receivers,context, threaded=threaded,
+            template=template, final_message=final_message,
+            whatsapp_gateway=whatsapp_gateway, chunk_size=chunk_size)
+    elif via == "telegram":
+        from magic_notifier.telegramer import Telegramer
+
+        return Telegramer(receivers, context, threaded=threaded,
+                template=template, final_message=final_message,
+                telegram_gateway=telegram_gateway, chunk_size=chunk_size)
+    else:
+        raise ValueError(f"Unknown sending method {via}")
+
+
+def send_via(via: str, subject: str, receivers: Union[list, models.QuerySet, models.Manager], *args, **kwargs):
+    """Send the notification through one channel, the errors of an unthreaded send are raised.
+
+    The parameters are the ones of notify, except receivers which must be a list, queryset or manager.
+    """
+    sender = get_sender(via, subject, receivers, *args, **kwargs)
+    sender.raise_errors = True
+    sender.send()
+
+
+async def asend_via(via: str, subject: str, receivers: Union[list, models.QuerySet, models.Manager], *args,
+                    semaphore: Optional[asyncio.Semaphore] = None, **kwargs):
+    """Like send_via, without blocking the event loop.
+
+    The sender is created in the database thread as it may load the templates and the files.
+    """
+    sender = await sync_to_async(get_sender)(via, subject, receivers, *args, **kwargs)
+    await sender.asend(semaphore)
+
+
+async def anotify(
+    vias: list,
+    subject: str = None,
+    receivers: Union[str, list, models.QuerySet, models.Manager] = None,
+    template: str = None,
+    context: dict = None,
+    final_message: str = None,
+    final_notification: Optional[Notification] = None,
+    email_gateway: Optional[str] = None,
+    sms_gateway: Optional[str] = None,
+    whatsapp_gateway: Optional[str] = None,
+    telegram_gateway: Optional[str] = None,
+    push_gateway: Optional[str] = None,
+    remove_notification_fields: list=None,
+    files: list = None,
+    inited_by: User = None,
+    chunk_size: int = None,
+    enqueue: bool = False,
+    priority: int = 0,
+    concurrency: int = None,
+):
+    """The coroutine version of notify, to be awaited from async views and consumers.
+
+    The channels are sent concurrently with async clients (httpx, aiosmtplib), the clients without
+    an async api are run in threads. The parameters are the ones of notify, threaded excepted.
+
+    :param concurrency: the maximum number of sends in flight at the same time. Default to NOTIFIER["ASYNC_CONCURRENCY"] settings
+    """
+    logger.debug(f"Sending {subject} to {receivers if isinstance(receivers, (str, list)) else 'a queryset'} via {vias}")
+    chunk_size = chunk_size if chunk_size else NOTIFIER_CHUNK_SIZE
+    context = {} if context is None else context
+
+    assert subject, "subject not defined"
+
+    receivers = get_receivers(receivers)
+
+    if enqueue:
+        from magic_notifier.outbox import enqueue_notification
+
+        await sync_to_async(enqueue_notification)(
+            vias, subject, receivers, template, context, final_message=final_message,
+            email_gateway=email_gateway, sms_gateway=sms_gateway,
+            whatsapp_gateway=whatsapp_gateway, telegram_gateway=telegram_gateway,
+            push_gateway=push_gateway, remove_notification_fields=remove_notification_fields,
+            files=files, final_notification=final_notification, inited_by=inited_by,
+            priority=priority, chunk_size=chunk_size)
+        return
+
+    semaphore = asyncio.Semaphore(concurrency or NOTIFIER_ASYNC_CONCURRENCY)
+    results = await asyncio.gather(*(
+        asend_via(via, subject, receivers, semaphore=semaphore, template=template, context=context,
+                  final_message=final_message, final_notification=final_notification,
+                  email_gateway=email_gateway, sms_gateway=sms_gateway, whatsapp_gateway=whatsapp_gateway,
+                  telegram_gateway=telegram_gateway, push_gateway=push_gateway,
+                  remove_notification_fields=remove_notification_fields, files=files,
+                  inited_by=inited_by, chunk_size=chunk_size)
+        for via in vias
+    ), return_exceptions=True)
+    for via, result in zip(vias, results):
+        if isinstance(result, Exception):
+            logger.error(f"Can't send the notification via {via}: "
+                         + "".join(traceback.format_exception(type(result), result, result.__traceback__)))
@@ -0,0 +1,171 @@
+import json
+import logging
+import traceback
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Union
+
+from django.contrib.auth import get_user_model
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from magic_notifier.models import Notification, OutboxItem
+from magic_notifier.settings import (NOTIFIER_CHUNK_SIZE, NOTIFIER_OUTBOX_BATCH_SIZE, NOTIFIER_OUTBOX_MAX_ATTEMPTS,
+                                     NOTIFIER_OUTBOX_STALE_AFTER)
+from magic_notifier.utils import chunked_receivers
+
+User = get_user_model()
+
+logger = logging.getLogger("notifier")
+
+
+def enqueue_notification(
+    vias: list,
+    subject: str,
+    receivers: Union[list, models.QuerySet, models.Manager],
+    template: str = None,
+    context: dict = None,
+    final_message: str = None,
+    email_gateway: Optional[str] = None,
+    sms_gateway: Optional[str] = None,
+    whatsapp_gateway: Optional[str] = None,
+    telegram_gateway: Optional[str] = None,
+    push_gateway: Optional[str] = None,
+    remove_notification_fields: list = None,
+    files: list = None,
+    final_notification: Optional[Notification] = None,
+    inited_by: User = None,
+    priority: int = 0,
+    chunk_size: int = None,
+) -> int:
+    """Write an outbox item per via and receiver, return the number of items created.
+
+    The receivers are walked chunk by chunk and each chunk is written with one bulk_create.
+    """
+    assert not files, "files can't be enqueued"
+    assert final_notification is None, "final_notification can't be enqueued"
+
+    chunk_size = chunk_size if chunk_size else NOTIFIER_CHUNK_SIZE
+    gateways = {"email": email_gateway, "sms": sms_gateway, "whatsapp": whatsapp_gateway,
+                "telegram": telegram_gateway, "push": push_gateway}
+    options = {}
+    if remove_notification_fields:
+        options["remove_notification_fields"] = remove_notification_fields
+    if inited_by is not None:
+        options["inited_by"] = inited_by.pk
+
+    count = 0
+    for receivers_chunk in chunked_receivers(receivers, chunk_size, ("pk",)):
+        items = [
+            OutboxItem(channel=via, user_id=user.pk, subject=subject, template=template,
+                       context=context or {}, final_message=final_message, gateway=gateways.get(via),
+                       options=options if via == "push" else {}, priority=priority)
+            for via in vias for user in receivers_chunk
+        ]
+        OutboxItem.objects.bulk_create(items, batch_size=chunk_size)
+        count += len(items)
+    return count
+
+
+def claim_batch(batch_size: int = None, channel: Optional[str] = None) -> List[OutboxItem]:
+    """Claim the next pending items, highest priority first, and mark them as processing.
+
+    The rows are locked with ``skip_locked`` so concurrent workers claim different items.
+    """
+    batch_size = batch_size if batch_size else NOTIFIER_OUTBOX_BATCH_SIZE
+    with transaction.atomic():
+        pending = OutboxItem.objects.filter(status=OutboxItem.PENDING)
+        if channel:
+            pending = pending.filter(channel=channel)
+        ids = list(pending.order_by("-priority", "id").select_for_update(skip_locked=True)
+                   .values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            return []
+        OutboxItem.objects.filter(pk__in=ids).update(status=OutboxItem.PROCESSING, attempts=F("attempts") + 1,
+                                                     updated=timezone.now())
+    return list(OutboxItem.objects.filter(pk__in=ids).select_related("user").order_by("-priority", "id"))
+
+
+def requeue_stale(stale_after: int = None) -> int:
+    """Put back in the queue the items left processing by a worker that died, return their number.
+
+    The items having used all their attempts are marked as failed, they may be the ones killing the workers.
+    """
+    stale_after = stale_after if stale_after is not None else NOTIFIER_OUTBOX_STALE_AFTER
+    limit = timezone.now() - timedelta(seconds=stale_after)
+    stale = OutboxItem.objects.filter(status=OutboxItem.PROCESSING, updated__lt=limit)
+    stale.filter(attempts__gte=NOTIFIER_OUTBOX_MAX_ATTEMPTS).update(
+        status=OutboxItem.FAILED, error="the worker stopped while sending the item", updated=timezone.now())
+    return stale.filter(attempts__lt=NOTIFIER_OUTBOX_MAX_ATTEMPTS).update(
+        status=OutboxItem.PENDING, updated=timezone.now())
+
+
+def record_results(group: List[OutboxItem], delivered: set, failed: Dict[Any, str], error: Optional[str]):
+    """Mark the items delivered to their user as sent, the others are retried or marked as failed.
+
+    :param delivered: the pks of the users the sender reached
+    :param failed: the error of each user the sender failed to reach
+    :param error: the error stopping the send, if any
+    """
+    now = timezone.now()
+    OutboxItem.objects.filter(pk__in=[item.pk for item in group if item.user_id in delivered]).update(
+        status=OutboxItem.SENT, error=None, updated=now)
+
+    # error -> items not delivered
+    not_delivered: Dict[str, list] = {}
+    for item in group:
+        if item.user_id not in delivered:
+            item_error = failed.get(item.user_id) or error or "the notification was not delivered to the user"
+            not_delivered.setdefault(item_error, []).append(item.pk)
+
+    for item_error, ids in not_delivered.items():
+        retried = OutboxItem.objects.filter(pk__in=ids)
+        retried.filter(attempts__gte=NOTIFIER_OUTBOX_MAX_ATTEMPTS).update(
+            status=OutboxItem.FAILED, error=item_error, updated=now)
+        retried.filter(attempts__lt=NOTIFIER_OUTBOX_MAX_ATTEMPTS).update(
+            status=OutboxItem.PENDING, error=item_error, updated=now)
+
+
+def dispatch(items: List[OutboxItem]):
+    """Send the claimed items and record their status.
+
+    The items of a same notification are sent together, one call to the sender of the channel.
+    Each item is marked from the users the sender reached, so a retry only sends the items
+    that were not delivered.
+    """
+    from magic_notifier.notifier import get_sender
+
+    groups: Dict[tuple, List[OutboxItem]] = {}
+    for item in items:
+        key = (item.channel, item.subject, item.template, item.final_message, item.gateway,
+               json.dumps(item.context, sort_keys=True), json.dumps(item.options, sort_keys=True))
+        groups.setdefault(key, []).append(item)
+
+    for group in groups.values():
+        item = group[0]
+        options = item.options.copy()
+        if options.get("inited_by") is not None:
+            options["inited_by"] = User.objects.filter(pk=options["inited_by"]).first()
+        if item.gateway:
+            options[f"{item.channel}_gateway"] = item.gateway
+
+        sender = None
+        error = None
+        try:
+            sender = get_sender(item.channel, item.subject, [grouped.user for grouped in group], item.template,
+                                item.context, final_message=item.final_message, **options)
+            sender.raise_errors = True
+            sender.send()
+        except Exception:
+            error = traceback.format_exc()
+            logger.error(error)
+
+        record_results(group, sender.delivered if sender else set(), sender.failed if sender else {}, error)
+
+
+def process_batch(batch_size: int = None, channel: Optional[str] = None) -> int:
+    """Claim and send a batch of the outbox, return the number of items processed"""
+    items = claim_batch(batch_size, channel)
+    if items:
+        dispatch(items)
+    return len(items)
@@ -0,0 +1,52 @@
+import time
+from datetime import timedelta
+
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from magic_notifier.models import Notification
+from magic_notifier.settings import NOTIFIER_PURGE_CHUNK_SIZE, NOTIFIER_PURGE_READ_RETENTION, NOTIFIER_PURGE_SLEEP
+
+def delete_chunked(queryset: QuerySet, chunk_size: int, sleep: float) -> int:
+    """Delete the rows of the queryset by ranges of primary keys, return the number of rows deleted.
+
+    Each statement deletes at most chunk_size rows so its locks are short, the other queries get
+    sleep seconds between two statements.
+    """
+    deleted = 0
+    last_pk = None
+    while True:
+        chunk = queryset.order_by("pk")
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        pks = list(chunk.values_list("pk", flat=True)[:chunk_size])
+        if not pks:
+            return deleted
+
+        count, _ = queryset.filter(pk__gte=pks[0], pk__lte=pks[-1]).delete()
+        deleted += count
+        last_pk = pks[-1]
+        if len(pks) < chunk_size:
+            return deleted
+        time.sleep(sleep)
+
+
+def purge_notifications(read_retention: int = None, chunk_size: int = None, sleep: float = None,
+                        expired_only: bool = False) -> int:
+    """Delete the expired notifications and the read ones sent before the retention, return their number
+
+    :param read_retention: the days the read notifications are kept. Default to NOTIFIER['PURGE']['READ_RETENTION'], the read notifications are kept when it is None
+    :param chunk_size: the maximum number of rows deleted at once. Default to NOTIFIER['PURGE']['CHUNK_SIZE']
+    :param sleep: the seconds to wait between two deletes. Default to NOTIFIER['PURGE']['SLEEP']
+    :param expired_only: if True, only the expired notifications are deleted
+    """
+    read_retention = read_retention if read_retention is not None else NOTIFIER_PURGE_READ_RETENTION
+    chunk_size = chunk_size if chunk_size else NOTIFIER_PURGE_CHUNK_SIZE
+    sleep = sleep if sleep is not None else NOTIFIER_PURGE_SLEEP
+
+    now = timezone.now()
+    deleted = delete_chunked(Notification.objects.filter(expires__lt=now), chunk_size, sleep)
+    if read_retention is not None and not expired_only:
+        limit = now - timedelta(days=read_retention)
+        deleted += delete_chunked(Notification.objects.filter(read__isnull=False, sent__lt=limit), chunk_size, sleep)
+    return deleted
@@ -1,9 +1,11 @@
+import asyncio
 import json
+from typing import Optional
 
-import requests
-from pyfcm import FCMNotification
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
 from magic_notifier.models import Notification
+from magic_notifier.sms_clients.base import HttpClient
 from magic_notifier.utils import import_attribute
 import logging
 
@@ -12,30 +14,95 @@ User = get_user_model()
 logger = logging.getLogger('notifier')
 
 
-class ExpoClient:
+class ExpoClient(HttpClient):
+
+    url = 'https://exp.host/--/api/v2/push/send'
+    # the expo push api accepts at most 100 messages per request
+    max_messages = 100
+    headers = {
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip, deflate',
+        'Content-Type': 'application/json',
+    }
 
     def send(self, user: User, notification: Notification, options: dict, remove_notification_fields=None):
-        remove_notification_fields = [] if not remove_notification_fields else remove_notification_fields
-        fcm_user_tokens = import_attribute(options['GET_TOKENS_FUNCTION'])(user)
+        return self.send_many([(user, notification)], options, remove_notification_fields)
 
-        data = notification.data
+    def send_many(self, batch: list, options: dict, remove_notification_fields=None) -> dict:
+        """Send the notifications of a batch of (user, notification) to all the tokens of the users.
 
-        for fcm_user_token in fcm_user_tokens:
-            logger.info(f"Token: {fcm_user_token} :: Data: {data}")
-            self.send_push_notification(fcm_user_token, notification.subject, notification.text, data)
+        The messages are sent by requests of at most 100 messages.
 
-    def send_push_notification(self, token:str, title: str, body: str, data: dict):
-        url = 'https://exp.host/--/api/v2/push/send'
-        headers = {
-            'Content-Type': 'application/json',
-        }
-        data = {
+        :return: the expo push ticket of each token
+        """
+        messages = self.build_messages(batch, options)
+
+        tickets = {}
+        for i in range(0, len(messages), self.max_messages):
+            tickets.update(self.push_messages(messages[i:i + self.max_messages], options))
+        return tickets
+
+    async def asend(self, user: User, notification: Notification, options: dict, remove_notification_fields=None):
+        return await self.asend_many([(user, notification)], options, remove_notification_fields)
+
+    async def asend_many(self, batch: list, options: dict, remove_notification_fields=None) -> dict:
+        """Like send_many without blocking the event loop, the requests of 100 messages are sent concurrently"""
+        # the tokens are usually read from the database
+        messages = await sync_to_async(self.build_messages)(batch, options)
+
+        results = await asyncio.gather(*(self.apush_messages(messages[i:i + self.max_messages], options)
+                                         for i in range(0, len(messages), self.max_messages)))
+        tickets = {}
+        for result in results:
+            tickets.update(result)
+        return tickets
+
+    def build_messages(self, batch: list, options: dict) -> list:
+        get_tokens = import_attribute(options['GET_TOKENS_FUNCTION'])
+
+        messages = []
+        for user, notification in batch:
+            for token in get_tokens(user):
+                logger.info(f"Token: {token} :: Data: {notification.data}")
+                messages.append(self.build_message(token, notification.subject, notification.text,
+                                                   notification.data))
+        return messages
+
+    def build_message(self, token: str, title: str, body: str, data: dict) -> dict:
+        return {
             'to': token,
             'sound': 'default',
             'title': title,
             'body': body,
             'data': data,
         }
-        response = requests.post(url, headers=headers, data=json.dumps(data))
-        logger.info(f'Response from Expo: {response.json()}')
 
+    def push_messages(self, messages: list, options: Optional[dict] = None) -> dict:
+        """Send up to 100 messages with one request and return the ticket of each token"""
+        response = self.get_session(options).post(self.url, data=json.dumps(messages),
+                                                  timeout=self.get_timeout(options))
+        return self.get_tickets(messages, response.json())
+
+    async def apush_messages(self, messages: list, options: Optional[dict] = None) -> dict:
+        from magic_notifier.aio import get_http_client
+
+        response = await get_http_client().post(self.url, content=json.dumps(messages),
+                                                timeout=self.get_timeout(options), headers=self.headers)
+        return self.get_tickets(messages, response.json())
+
+    def get_tickets(self, messages: list, content: dict) -> dict:
+        if 'errors' in content:
+            logger.error(f'Error from Expo: {content["errors"]}')
+
+        # the tickets are in the same order as the messages
+        tickets = {}
+        for message, ticket in zip(messages, content.get('data', [])):
+            if ticket.get('status') == 'error':
+                logger.warning(f"Expo can't deliver to {message['to']}: {ticket.get('message')}")
+            tickets[message['to']] = ticket
+        return tickets
+
+    def send_push_notification(self, token:str, title: str, body: str, data: dict):
+        tickets = self.push_messages([self.build_message(token, title, body, data)])
+        logger.info(f'Response from Expo: {tickets}')
+        return tickets.get(token)
@@ -1,4 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+
+import google.auth.transport.requests
 from pyfcm import FCMNotification
+from pyfcm.errors import FCMNotRegisteredError, InvalidDataError
 from django.contrib.auth import get_user_model
 from magic_notifier.models import Notification
 from magic_notifier.utils import import_attribute
@@ -9,19 +14,82 @@ User = get_user_model()
 logger = logging.getLogger('notifier')
 
 
+class CachedTokenFCMNotification(FCMNotification):
+    """FCMNotification refreshing its OAuth access token only when it expires,
+    pyfcm refreshes it before every message."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_lock = Lock()
+
+    def _get_access_token(self):
+        with self.token_lock:
+            if self.credentials is None:
+                self._initialize_credentials()
+
+            if not self.credentials.valid:
+                try:
+                    self.credentials.refresh(google.auth.transport.requests.Request())
+                except Exception as e:
+                    raise InvalidDataError(e)
+
+            return self.credentials.token
+
+
 class FCMClient:
 
+    # the FCMNotification of each (service account file, project id), reused with their credentials
+    fcm_notifications: dict = {}
+    fcm_notifications_lock = Lock()
+
+    @classmethod
+    def get_fcm(cls, options: dict) -> FCMNotification:
+        key = (options["SERVICE_ACCOUNT_FILE"], options['PROJECT_ID'])
+        with cls.fcm_notifications_lock:
+            if key not in cls.fcm_notifications:
+                cls.fcm_notifications[key] = CachedTokenFCMNotification(
+                    service_account_file=options["SERVICE_ACCOUNT_FILE"], project_id=options['PROJECT_ID'])
+            return cls.fcm_notifications[key]
+
     def send(self, user: User, notification: Notification, options: dict, remove_notification_fields=None):
-        remove_notification_fields = [] if not remove_notification_fields else remove_notification_fields
-        fcm_user_tokens = import_attribute(options['GET_TOKENS_FUNCTION'])(user)
+        return self.send_many([(user, notification)], options, remove_notification_fields)
+
+    def send_many(self, batch: list, options: dict, remove_notification_fields=None) -> list:
+        """Send the notifications of a batch of (user, notification) to all the tokens of the users.
+
+        The messages are sent concurrently by CONCURRENCY (default 10) threads. The tokens
+        reported as unregistered by FCM are passed to the UNREGISTERED_TOKENS_FUNCTION option,
+        if set, so they can be pruned.
+
+        :return: the unregistered tokens
+        """
+        get_tokens = import_attribute(options['GET_TOKENS_FUNCTION'])
+        fcm = self.get_fcm(options)
+
+        messages = [(token, notification) for user, notification in batch for token in get_tokens(user)]
+        unregistered_tokens = []
+        if not messages:
+            return unregistered_tokens
 
-        fcm = FCMNotification(service_account_file=options["SERVICE_ACCOUNT_FILE"],
-                              project_id=options['PROJECT_ID'])
+        with ThreadPoolExecutor(max_workers=min(options.get("CONCURRENCY", 10), len(messages))) as executor:
+            futures = {executor.submit(self.notify, fcm, token, notification): token
+                       for token, notification in messages}
+            for future in as_completed(futures):
+                token = futures[future]
+                try:
+                    future.result()
+                except FCMNotRegisteredError:
+                    logger.info(f"Token {token} is not registered anymore")
+                    unregistered_tokens.append(token)
+                except Exception:
+                    logger.exception(f"Can't send the notification to token {token}")
 
-        data = notification.data
+        if unregistered_tokens and options.get("UNREGISTERED_TOKENS_FUNCTION"):
+            import_attribute(options["UNREGISTERED_TOKENS_FUNCTION"])(unregistered_tokens)
 
-        for fcm_user_token in fcm_user_tokens:
-            logger.info(f"Token: {fcm_user_token} :: Data: {data}")
-            fcm.notify(fcm_token=fcm_user_token, notification_title=notification.subject,
-                   data_payload=data)
+        return unregistered_tokens
 
+    def notify(self, fcm: FCMNotification, token: str, notification: Notification):
+        logger.info(f"Token: {token} :: Data: {notification.data}")
+        return fcm.notify(fcm_token=token, notification_title=notification.subject,
+                          data_payload=notification.data)
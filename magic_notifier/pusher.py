@@ -1,22 +1,19 @@
-import importlib
+import asyncio
 import logging
 import traceback
-from threading import Thread
-
-from django.template.loader import render_to_string
+from typing import Any, Dict, Optional
 
+from magic_notifier.aio import aiterate, async_method, limited
 from magic_notifier.models import Notification
-
-try:
-    from asgiref.sync import async_to_sync
-    from channels.layers import get_channel_layer
-except Exception:
-    pass
+from magic_notifier.registry import registry
+from magic_notifier.rendering import NotifierTemplate
+from magic_notifier.settings import NOTIFIER_CHUNK_SIZE
 import json
 
 from django.template import Context, Template
 
-from magic_notifier.utils import NotificationBuilder, get_settings
+from magic_notifier.utils import NotificationBuilder, chunked_receivers
+from magic_notifier.workers import submit
 
 logger = logging.getLogger("notif")
 
@@ -31,13 +28,13 @@ class Pusher:
         """
 
         :param subject:The subject of the notification
-        :param receivers: The user list of receivers
+        :param receivers: The list, queryset or manager of receivers
         :param template: The template to use
         :param context:The context to pass to the template
         :param inited_by: The user who inited the notification
-        :param kwargs:
+        :param kwargs: accept threaded, image and chunk_size (number of receivers loaded at once)
         """
-        self.receivers: list = receivers
+        self.receivers = receivers
         self.template: str = template
         self.context: dict = context
         self.remove_notification_fields = remove_notification_fields
@@ -46,76 +43,148 @@ class Pusher:
         if 'subject' not in context and subject:
             self.context['subject'] = subject
         self.threaded: bool = kwargs.get("threaded", False)
+        # raise the errors of the send instead of logging them, set by send_via
+        self.raise_errors: bool = False
+        # the pks of the users reached by the send and the errors of the others, recorded by the outbox
+        self.delivered: set = set()
+        self.failed: Dict[Any, str] = {}
+        self.chunk_size: int = kwargs.get("chunk_size") or NOTIFIER_CHUNK_SIZE
         self.image = kwargs.get("image")
-        # get the default sms gateway
-        self.push_gateway = get_settings('PUSH::DEFAULT_GATEWAY') if push_gateway is None else push_gateway
-        # get the sms gateway definition
-        NOTIFIER_PUSH_GATEWAY = get_settings('PUSH')["GATEWAYS"][self.push_gateway]
-        # get the sms client to be used
-        NOTIFIER_PUSH_CLIENT = NOTIFIER_PUSH_GATEWAY['CLIENT']
-        # load the sms client
-        module_name, class_name = NOTIFIER_PUSH_CLIENT.rsplit(".", 1)
-        module = importlib.import_module(module_name)
-        assert hasattr(module, class_name), "class {} is not in {}".format(class_name, module_name)
-        self.client_class = getattr(module, class_name)
-        self.push_class_options = NOTIFIER_PUSH_GATEWAY
+        self.push_template: Optional[NotifierTemplate] = None
+        # get the gateway, resolved once by the registry
+        gateway = registry.get("push", push_gateway)
+        self.push_gateway = gateway.name
+        self.client_class = gateway.client_class
+        self.rate_limiter = gateway.rate_limiter
+        self.push_class_options = gateway.options
 
     def send(self):
         if self.threaded:
-            t = Thread(target=self._send)
-            t.setDaemon(True)
-            t.start()
+            submit("push", self._send)
         else:
             return self._send()
 
+    def build_notification(self, user) -> Notification:
+        """Render the push template for the user and return the notification, not saved yet"""
+        if self.push_template is None:
+            self.push_template = NotifierTemplate.for_channel(self.template, "push", self.context)
+        push_content = self.push_template.render(user)
+
+        event: dict = json.loads(push_content)
+        event['type'] = 'notification'
+
+        not_builder = (
+            NotificationBuilder(event["subject"])
+            .text(event['text'])
+            .type(event["type"], event["sub_type"])
+            .link(event["link"])
+            .mode(event["mode"])
+            .data(event["data"])
+            .actions(event["actions"])
+            .user(user)
+        )
+
+        if self.inited_by:
+            not_builder.inited_by(self.inited_by)
+
+        if self.image:
+            not_builder.image(self.image)
+
+        return not_builder.build()
+
+    def deliver(self, client, batch: list):
+        """Hand a batch of (user, notification) to the push client.
+
+        Clients implementing send_many receive the whole batch, the others are called per user.
+        """
+        if hasattr(client, "send_many"):
+            for paced_batch in self.rate_limiter.paced(batch):
+                client.send_many(paced_batch, self.push_class_options,
+                                 remove_notification_fields=self.remove_notification_fields)
+                self.delivered.update(user.pk for user, _ in paced_batch)
+            return
+
+        for user, notification in batch:
+            try:
+                self.rate_limiter.acquire()
+                client.send(user, notification, self.push_class_options,
+                            remove_notification_fields=self.remove_notification_fields)
+                self.delivered.add(user.pk)
+            except Exception:
+                self.failed[user.pk] = traceback.format_exc()
+                logger.error(self.failed[user.pk])
+
+    def build_batch(self, receivers: list) -> list:
+        """Save the notifications of the receivers with one bulk_create and return the (user, notification)"""
+        if self.final_notification:
+            notifications = [self.final_notification] * len(receivers)
+        else:
+            notifications = Notification.objects.bulk_create(
+                [self.build_notification(user) for user in receivers]
+            )
+        return list(zip(receivers, notifications))
+
     def _send(self):
+        """Save the notifications of each chunk of receivers with one bulk_create, then deliver them.
+
+        As the notifications are bulk created, no post_save signal is sent for them.
+
+        :return: the notification of the first receiver
+        """
         try:
             client = self.client_class()
+            first_notification = None
+
+            for receivers in chunked_receivers(self.receivers, self.chunk_size):
+                logger.debug(f"sending push notification to {len(receivers)} users")
+                batch = self.build_batch(receivers)
+                self.deliver(client, batch)
+                if first_notification is None:
+                    first_notification = batch[0][1]
+
+            return first_notification
+        except Exception:
+            if self.raise_errors:
+                raise
+            logger.error(traceback.format_exc())
 
-            for user in self.receivers:
-                logger.debug(f"sending push notification to {user}")
-                if self.final_notification:
-                    notification = self.final_notification
-                else:
-                    ctx = self.context.copy()
-                    ctx["user"] = user
-                    push_content = render_to_string(f"notifier/{self.template}/push.json", ctx)
-
-                    event: dict = json.loads(push_content)
-                    event['type'] = 'notification'
-
-                    not_builder = (
-                        NotificationBuilder(event["subject"])
-                        .text(event['text'])
-                        .type(event["type"], event["sub_type"])
-                        .link(event["link"])
-                        .mode(event["mode"])
-                        .data(event["data"])
-                        .actions(event["actions"])
-                        .user(user)
-                        .inited_by(self.inited_by)
-                    )
-
-                    if self.image:
-                        not_builder.image(self.image)
-
-                    notification = not_builder.save()
+    async def adeliver(self, client, batch: list, semaphore: Optional[asyncio.Semaphore] = None):
+        """Like deliver, without blocking the event loop"""
+        if hasattr(client, "asend_many") or hasattr(client, "send_many"):
+            client_send_many = async_method(client, "asend_many", "send_many")
+            async for paced_batch in self.rate_limiter.apaced(batch):
+                await limited(semaphore, client_send_many(paced_batch, self.push_class_options,
+                                                          remove_notification_fields=self.remove_notification_fields))
+            return
 
-                client.send(user, notification, self.push_class_options,
-                                  remove_notification_fields=self.remove_notification_fields)
-                # event['id'] = res.id
-                #
-                # # return
-                # channel_layer = get_channel_layer()
-                # async_to_sync(channel_layer.group_send)(
-                #     f"user-{user.id}",
-                #     event
-                # )
-
-                return notification
+        client_send = async_method(client, "asend", "send")
+
+        async def send_notification(user, notification: Notification):
+            await self.rate_limiter.aacquire()
+            await client_send(user, notification, self.push_class_options,
+                              remove_notification_fields=self.remove_notification_fields)
+
+        await asyncio.gather(*(limited(semaphore, send_notification(user, notification))
+                               for user, notification in batch))
+
+    async def asend(self, semaphore: Optional[asyncio.Semaphore] = None):
+        """Like _send without blocking the event loop, the notifications are saved in the database thread
+
+        :return: the notification of the first receiver
+        """
+        try:
+            client = self.client_class()
+            first_notification = None
+
+            chunks = chunked_receivers(self.receivers, self.chunk_size)
+            async for batch in aiterate(self.build_batch(receivers) for receivers in chunks):
+                await self.adeliver(client, batch, semaphore)
+                if first_notification is None:
+                    first_notification = batch[0][1]
+
+            return first_notification
         except Exception as e:
             logger.error(traceback.format_exc())
 
-
 if __name__ == "__main__":
     pass
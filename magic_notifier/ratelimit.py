@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Iterator, Optional
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+
+from magic_notifier.utils import get_settings
+
+logger = logging.getLogger("notifier")
+
+
+class RateLimiter:
+    """Limit the sends of a gateway to RATE per second, in bursts of at most BURST sends.
+
+    The sends are counted in windows of BURST / RATE seconds stored in the django cache, so all
+    the processes sharing the cache share the limit. A send over the limit waits for the next window.
+    """
+
+    def __init__(self, key: str, rate: Optional[float] = None, burst: Optional[int] = None,
+                 cache_alias: str = "default"):
+        self.key = key
+        self.rate = rate
+        self.burst = max(1, int(burst if burst else (rate or 1)))
+        self.window = self.burst / rate if rate else 0.0
+        self.cache_alias = cache_alias
+
+    @property
+    def limited(self) -> bool:
+        return bool(self.rate)
+
+    @property
+    def timeout(self) -> int:
+        # the window is kept a bit longer than its duration for the slow clocks
+        return int(self.window * 2) + 1
+
+    def granted(self, tokens: int, count: int) -> int:
+        return max(0, min(tokens, self.burst - (count - tokens)))
+
+    def take(self, tokens: int, window: int) -> int:
+        """Take up to tokens sends of the window, return the number granted"""
+        cache = caches[self.cache_alias]
+        key = f"{self.key}:{window}"
+        cache.add(key, 0, timeout=self.timeout)
+        try:
+            count = cache.incr(key, tokens)
+        except ValueError:
+            # the key expired between add and incr
+            cache.add(key, tokens, timeout=self.timeout)
+            count = tokens
+        return self.granted(tokens, count)
+
+    async def atake(self, tokens: int, window: int) -> int:
+        """Like take, with the async api of the cache so a network cache doesn't block the event loop"""
+        cache = caches[self.cache_alias]
+        if not hasattr(cache, "aincr"):
+            # the caches of django < 4.0 have no async api
+            return await sync_to_async(self.take, thread_sensitive=False)(tokens, window)
+
+        key = f"{self.key}:{window}"
+        await cache.aadd(key, 0, timeout=self.timeout)
+        try:
+            count = await cache.aincr(key, tokens)
+        except ValueError:
+            await cache.aadd(key, tokens, timeout=self.timeout)
+            count = tokens
+        return self.granted(tokens, count)
+
+    def current_window(self) -> tuple:
+        """Return the current window and the seconds left before the next one"""
+        now = time.time()
+        window = int(now // self.window)
+        return window, (window + 1) * self.window - now
+
+    def wait_time(self, tokens: int) -> tuple:
+        """Take what is left of the tokens in the current window.
+
+        :return: the tokens still to take and the seconds to wait before the next window
+        """
+        window, wait = self.current_window()
+        return tokens - self.take(tokens, window), wait
+
+    async def await_time(self, tokens: int) -> tuple:
+        """Like wait_time, without blocking the event loop"""
+        window, wait = self.current_window()
+        return tokens - await self.atake(tokens, window), wait
+
+    def acquire(self, tokens: int = 1):
+        """Wait until the tokens sends are allowed"""
+        if not self.limited:
+            return
+        while tokens > 0:
+            tokens, wait = self.wait_time(tokens)
+            if tokens > 0:
+                logger.debug(f"Rate limit of {self.key} reached, waiting {wait:.2f}s")
+                time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 1):
+        """Like acquire, without blocking the event loop while waiting"""
+        if not self.limited:
+            return
+        while tokens > 0:
+            tokens, wait = await self.await_time(tokens)
+            if tokens > 0:
+                logger.debug(f"Rate limit of {self.key} reached, waiting {wait:.2f}s")
+                await asyncio.sleep(wait)
+
+    def paced(self, items: list) -> Iterator[list]:
+        """Yield the items by slices of at most BURST items, each one once its sends are allowed"""
+        if not self.limited:
+            if items:
+                yield items
+            return
+        for start in range(0, len(items), self.burst):
+            batch = items[start:start + self.burst]
+            self.acquire(len(batch))
+            yield batch
+
+    async def apaced(self, items: list) -> AsyncIterator[list]:
+        """Like paced, without blocking the event loop while waiting"""
+        if not self.limited:
+            if items:
+                yield items
+            return
+        for start in range(0, len(items), self.burst):
+            batch = items[start:start + self.burst]
+            await self.aacquire(len(batch))
+            yield batch
+
+
+def get_rate_limiter(channel: str, gateway: str, options: dict) -> RateLimiter:
+    """Return the rate limiter of the gateway from its RATE_LIMIT option, unlimited if it is not set"""
+    rate_limit = options.get("RATE_LIMIT") or {}
+    return RateLimiter(f"magic_notifier:ratelimit:{channel}:{gateway}", rate_limit.get("RATE"),
+                       rate_limit.get("BURST"), get_settings("RATE_LIMIT_CACHE", "default"))
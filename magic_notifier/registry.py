@@ -0,0 +1,192 @@
+import importlib.util
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger("notifier")
+
+# channel -> (settings key, default client of a gateway)
+CHANNELS: Dict[str, Tuple[str, Optional[str]]] = {
+    "sms": ("SMS", None),
+    "push": ("PUSH", None),
+    "whatsapp": ("WHATSAPP", "magic_notifier.whatsapp_clients.waha_client.WahaClient"),
+    "telegram": ("TELEGRAM", "magic_notifier.telegram_clients.telethon.TelethonClient"),
+}
+
+# hook functions of NOTIFIER -> default path
+HOOKS: Dict[str, Optional[str]] = {
+    "GET_USER_NUMBER": "magic_notifier.utils.get_user_number",
+    "GET_USER_NUMBERS": None,
+    "USER_FROM_WS_TOKEN_FUNCTION": None,
+}
+
+
+class Gateway:
+    """A gateway of a channel with its options and client.
+
+    The client class is imported on first use, so the sdk of a channel is only loaded when
+    something is sent through it. A gateway whose client module can't be found keeps the
+    error, it is raised when the gateway is looked up.
+    """
+
+    def __init__(self, channel: str, name: str, options: dict, client_path: Optional[str] = None,
+                 error: Optional[Exception] = None):
+        self.channel = channel
+        self.name = name
+        self.options = options
+        self.client_path = client_path
+        self.error = error
+        self._client_class = None
+        self._rate_limiter = None
+
+    @property
+    def client_class(self) -> Any:
+        if self._client_class is None:
+            from .utils import import_attribute
+
+            self._client_class = import_attribute(self.client_path)
+        return self._client_class
+
+    @property
+    def rate_limiter(self) -> Any:
+        if self._rate_limiter is None:
+            from .ratelimit import get_rate_limiter
+
+            self._rate_limiter = get_rate_limiter(self.channel, self.name, self.options)
+        return self._rate_limiter
+
+    def __repr__(self):
+        return f"<Gateway {self.channel}:{self.name} {self.client_path}>"
+
+
+def check_module(path: str):
+    """Check that the module of the dotted path exists, without importing it"""
+    module_name = path.rsplit(".", 1)[0]
+    if importlib.util.find_spec(module_name) is None:
+        raise ModuleNotFoundError(f"No module named '{module_name}'", name=module_name)
+
+
+class GatewayRegistry:
+    """Resolve the gateways and hooks of settings.NOTIFIER once and cache them.
+
+    The registry is built when the app is ready and rebuilt on the next lookup after
+    settings.NOTIFIER changed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gateways: Optional[Dict[Tuple[str, str], Gateway]] = None
+        self.defaults: Dict[str, Any] = {}
+        self.fallbacks: Dict[str, List[str]] = {}
+        # hook name -> (path, function or the error raised while looking for it)
+        self.hooks: Dict[str, Tuple[Optional[str], Any]] = {}
+
+    def build(self):
+        from .utils import get_settings
+
+        gateways: Dict[Tuple[str, str], Gateway] = {}
+        defaults: Dict[str, Any] = {}
+        fallbacks: Dict[str, List[str]] = {}
+        hooks: Dict[str, Tuple[Optional[str], Any]] = {}
+
+        def add(channel: str, name: str, options: dict, client_path: Optional[str]):
+            try:
+                if not client_path:
+                    raise KeyError(f"No CLIENT defined for the {channel} gateway {name}")
+                check_module(client_path)
+            except Exception as e:
+                logger.error(f"Can't load the {channel} gateway {name}: {e!r}")
+                gateways[(channel, name)] = Gateway(channel, name, options, client_path, error=e)
+            else:
+                gateways[(channel, name)] = Gateway(channel, name, options, client_path)
+
+        try:
+            NOTIFIER_EMAIL = get_settings('EMAIL')
+            defaults["email"] = NOTIFIER_EMAIL.get('DEFAULT_GATEWAY', 'default')
+        except (AttributeError, KeyError):
+            from magic_notifier.settings import NOTIFIER_EMAIL, NOTIFIER_EMAIL_DEFAULT_GATEWAY
+            defaults["email"] = NOTIFIER_EMAIL_DEFAULT_GATEWAY
+        fallbacks["email"] = NOTIFIER_EMAIL.get('FALLBACKS', [])
+        for name, options in NOTIFIER_EMAIL.items():
+            if isinstance(options, dict):
+                add("email", name, options, options.get("CLIENT"))
+
+        for channel, (key, default_client) in CHANNELS.items():
+            channel_settings = get_settings(key, {})
+            if "DEFAULT_GATEWAY" in channel_settings:
+                defaults[channel] = channel_settings["DEFAULT_GATEWAY"]
+            for name, options in channel_settings.get("GATEWAYS", {}).items():
+                add(channel, name, options, options.get("CLIENT", default_client))
+
+        for name, default in HOOKS.items():
+            path = get_settings(name, default)
+            error = None
+            if path:
+                try:
+                    check_module(path)
+                except Exception as e:
+                    logger.error(f"Can't load the function {path} of {name}: {e!r}")
+                    error = e
+            hooks[name] = (path, error)
+
+        self.defaults, self.fallbacks, self.hooks = defaults, fallbacks, hooks
+        self.gateways = gateways
+
+    def clear(self):
+        with self.lock:
+            self.gateways = None
+
+    def load(self) -> Dict[Tuple[str, str], Gateway]:
+        gateways = self.gateways
+        if gateways is None:
+            with self.lock:
+                if self.gateways is None:
+                    self.build()
+                gateways = self.gateways
+        return gateways
+
+    def get(self, channel: str, name: Optional[str] = None) -> Gateway:
+        """Return the gateway of the channel, the default one if name is None.
+
+        Raise a KeyError if the gateway is not defined.
+        """
+        gateways = self.load()
+        if name is None:
+            name = self.defaults[channel]
+        gateway = gateways[(channel, name)]
+        if gateway.error is not None:
+            raise gateway.error
+        return gateway
+
+    def get_fallbacks(self, channel: str) -> List[str]:
+        self.load()
+        return self.fallbacks.get(channel, [])
+
+    def hook(self, name: str) -> Optional[Callable]:
+        """Return the function of the hook setting, None if it is not set"""
+        self.load()
+        path, func = self.hooks[name]
+        if isinstance(func, Exception):
+            raise func
+        if func is None and path:
+            from .utils import import_attribute
+
+            func = import_attribute(path)
+            self.hooks[name] = (path, func)
+        return func
+
+    def hook_path(self, name: str) -> Optional[str]:
+        self.load()
+        return self.hooks[name][0]
+
+
+registry = GatewayRegistry()
+
+
+@receiver(setting_changed)
+def clear_registry(setting, **kwargs):
+    if setting == "NOTIFIER":
+        registry.clear()
@@ -0,0 +1,227 @@
+import logging
+import os
+from threading import Lock
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template import Context, Template, TemplateDoesNotExist, engines
+from django.template.backends.django import DjangoTemplates
+from django.template.base import FilterExpression, Node, NodeList, Token, TokenType, Variable
+from django.template.loader import get_template, select_template
+from django.template.smartif import TokenBase
+
+logger = logging.getLogger("notifier")
+
+# the context keys set for each receiver by the senders
+RECIPIENT_KEYS = {"user"}
+
+# tags reading the whole context, their template depends on everything
+DYNAMIC_NODES = {"DebugNode"}
+
+# the files of a notifier template tried for each channel, in order
+CHANNEL_TEMPLATES = {
+    "sms": ["sms.txt"],
+    "whatsapp": ["whatsapp.txt", "sms.txt"],
+    "telegram": ["telegram.txt", "sms.txt"],
+    "push": ["push.json"],
+    "email.mjml": ["email.mjml"],
+    "email.html": ["email.html"],
+    "email.txt": ["email.txt"],
+}
+
+# (template, channel) -> (modification time, compiled template or None when it doesn't exist)
+notifier_templates: Dict[Tuple[str, str], Tuple[Optional[float], Any]] = {}
+notifier_templates_lock = Lock()
+
+# template source -> names of the context variables it uses, None if they can't be known
+template_variables_cache: Dict[str, Optional[Set[str]]] = {}
+template_variables_lock = Lock()
+
+
+class UnknownVariables(Exception):
+    """Raised while walking a template whose variables can't be known"""
+
+
+def literal_template_name(expression) -> str:
+    """Return the name of an included or extended template, it must be a string literal"""
+    if isinstance(expression, FilterExpression) and not expression.filters and isinstance(expression.var, str):
+        return expression.var
+    raise UnknownVariables(f"the template name {expression} is not a literal")
+
+
+def collect_variables(obj, names: Set[str], engine):
+    if isinstance(obj, FilterExpression):
+        collect_variables(obj.var, names, engine)
+        for func, args in obj.filters:
+            for lookup, arg in args:
+                collect_variables(arg, names, engine)
+    elif isinstance(obj, Variable):
+        if obj.lookups:
+            names.add(obj.lookups[0])
+    elif isinstance(obj, Token):
+        # the {{ var }} of a blocktranslate
+        if obj.token_type == TokenType.VAR:
+            names.add(obj.contents.split(".")[0])
+    elif isinstance(obj, (list, tuple, NodeList)):
+        for item in obj:
+            collect_variables(item, names, engine)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            collect_variables(item, names, engine)
+    elif isinstance(obj, TokenBase):
+        # the conditions of an if tag
+        collect_variables(list(vars(obj).values()), names, engine)
+    elif isinstance(obj, Node):
+        collect_node_variables(obj, names, engine)
+
+
+def collect_node_variables(node: Node, names: Set[str], engine):
+    node_class = type(node)
+    if not node_class.__module__.startswith(("django.template", "django.templatetags")):
+        # a custom tag may read any variable of the context
+        raise UnknownVariables(f"the tag {node_class.__name__} is not a django tag")
+    if node_class.__name__ in DYNAMIC_NODES:
+        raise UnknownVariables(f"the tag {node_class.__name__} reads the whole context")
+    if node_class.__name__ == "CsrfTokenNode":
+        names.add("csrf_token")
+    if node_class.__name__ in ("IncludeNode", "ExtendsNode"):
+        name_expression = node.template if node_class.__name__ == "IncludeNode" else node.parent_name
+        names.update(get_variables(engine.get_template(literal_template_name(name_expression)), engine))
+
+    for key, value in vars(node).items():
+        if key not in ("token", "origin"):
+            collect_variables(value, names, engine)
+
+
+def get_variables(template: Template, engine=None) -> Set[str]:
+    engine = engine if engine is not None else template.engine
+    names: Set[str] = set()
+    for node in template.nodelist:
+        collect_variables(node, names, engine)
+    return names
+
+
+def template_variables(template: Template) -> Optional[Set[str]]:
+    """Return the names of the context variables used by the template and its includes.
+
+    The analysis walks the compiled nodes and is cached by template source. None is returned
+    when the variables can't be known, for example when the template uses a custom tag.
+    """
+    try:
+        return template_variables_cache[template.source]
+    except KeyError:
+        pass
+
+    try:
+        names: Optional[Set[str]] = get_variables(template)
+    except UnknownVariables as e:
+        logger.debug(f"Can't analyze the template {template.origin.name}: {e}")
+        names = None
+
+    with template_variables_lock:
+        template_variables_cache[template.source] = names
+    return names
+
+
+def depends_on_recipient(template) -> bool:
+    """Tell if the rendering of the template may differ from one receiver to another"""
+    # the templates of the django backend wrap the compiled template
+    template = getattr(template, "template", template)
+    if not isinstance(template, Template):
+        return True
+    names = template_variables(template)
+    return names is None or bool(names & RECIPIENT_KEYS)
+
+
+def get_mtime(template) -> Optional[float]:
+    try:
+        return os.path.getmtime(template.origin.name)
+    except (AttributeError, OSError, TypeError):
+        return None
+
+
+def reset_loaders():
+    for backend in engines.all():
+        if isinstance(backend, DjangoTemplates):
+            for loader in backend.engine.template_loaders:
+                loader.reset()
+
+
+def get_notifier_template(template: str, channel: str) -> Any:
+    """Return the compiled template of a notifier template for the channel, None if there is none.
+
+    The result is cached per process, missing templates included. In DEBUG a template is reloaded
+    when its file is modified and missing templates are looked up again.
+    """
+    key = (template, channel)
+    cached = notifier_templates.get(key)
+    if cached is not None:
+        mtime, compiled = cached
+        if not settings.DEBUG or get_mtime(compiled) == mtime:
+            return compiled
+        if compiled is not None:
+            # the cached loader of django would return the old template
+            reset_loaders()
+
+    try:
+        compiled = select_template([f"notifier/{template}/{name}" for name in CHANNEL_TEMPLATES[channel]])
+    except TemplateDoesNotExist:
+        compiled = None
+
+    if compiled is not None or not settings.DEBUG:
+        with notifier_templates_lock:
+            notifier_templates[key] = (get_mtime(compiled), compiled)
+    return compiled
+
+
+@receiver(setting_changed)
+def clear_templates(setting, **kwargs):
+    if setting == "TEMPLATES":
+        notifier_templates.clear()
+        template_variables_cache.clear()
+
+
+class NotifierTemplate:
+    """A template rendered for many receivers.
+
+    When it doesn't depend on the receiver, it is rendered once and the content is shared.
+    """
+
+    def __init__(self, template: Union[str, List[str], Template], context: dict):
+        """
+        :param template: the template, its name or the names of the templates to try in order
+        :param context: the context shared by the receivers
+        """
+        if isinstance(template, str):
+            template = get_template(template)
+        elif isinstance(template, (list, tuple)):
+            template = select_template(template)
+        self.template = template
+        self.context = context
+        self.shared = not depends_on_recipient(template)
+        self.content: Optional[str] = None
+
+    @classmethod
+    def for_channel(cls, template: str, channel: str, context: dict) -> "NotifierTemplate":
+        """Return the notifier template of the channel, raise TemplateDoesNotExist if there is none"""
+        compiled = get_notifier_template(template, channel)
+        if compiled is None:
+            raise TemplateDoesNotExist(", ".join(f"notifier/{template}/{name}" for name in CHANNEL_TEMPLATES[channel]))
+        return cls(compiled, context)
+
+    def render(self, user) -> str:
+        if self.content is not None:
+            return self.content
+
+        ctx = self.context.copy()
+        ctx["user"] = user
+        if isinstance(self.template, Template):
+            content = self.template.render(Context(ctx, autoescape=self.template.engine.autoescape))
+        else:
+            content = self.template.render(ctx)
+
+        if self.shared:
+            self.content = content
+        return content
@@ -12,6 +12,45 @@ NOTIFIER_DEFAULT_MODE = NOTIFIER_SETTINGS.get("DEFAULT_MODE", "user")
 
 NOTIFIER_THREADED = NOTIFIER_SETTINGS.get('THREADED', False)
 
+# number of receivers loaded and sent at once when walking a queryset
+NOTIFIER_CHUNK_SIZE = NOTIFIER_SETTINGS.get('CHUNK_SIZE', 2000)
+
+# the maximum number of sends in flight at the same time for a call of anotify()
+NOTIFIER_ASYNC_CONCURRENCY = NOTIFIER_SETTINGS.get('ASYNC_CONCURRENCY', 100)
+
+# the pool of threads used to send the notifications in background
+NOTIFIER_WORKERS = NOTIFIER_SETTINGS.get('WORKERS', {})
+# an int for all the channels or a dict channel -> int
+NOTIFIER_WORKERS_MAX_WORKERS = NOTIFIER_WORKERS.get('MAX_WORKERS', 4)
+NOTIFIER_WORKERS_QUEUE_SIZE = NOTIFIER_WORKERS.get('QUEUE_SIZE', 1000)
+# what to do when the queue is full: 'block', 'drop' or 'inline'
+NOTIFIER_WORKERS_BACKPRESSURE = NOTIFIER_WORKERS.get('BACKPRESSURE', 'block')
+
+# the outbox of the notifications enqueued with notify(..., enqueue=True)
+NOTIFIER_OUTBOX = NOTIFIER_SETTINGS.get('OUTBOX', {})
+# number of items claimed at once by a worker
+NOTIFIER_OUTBOX_BATCH_SIZE = NOTIFIER_OUTBOX.get('BATCH_SIZE', 100)
+# an item is marked as failed after this number of attempts
+NOTIFIER_OUTBOX_MAX_ATTEMPTS = NOTIFIER_OUTBOX.get('MAX_ATTEMPTS', 3)
+# items still processing after this number of seconds (crashed worker) are claimed again
+NOTIFIER_OUTBOX_STALE_AFTER = NOTIFIER_OUTBOX.get('STALE_AFTER', 600)
+
+# the purge of the expired and old read notifications
+NOTIFIER_PURGE = NOTIFIER_SETTINGS.get('PURGE', {})
+# read notifications sent more than this number of days ago are deleted, None to keep them
+NOTIFIER_PURGE_READ_RETENTION = NOTIFIER_PURGE.get('READ_RETENTION', 30)
+# maximum number of rows deleted by statement
+NOTIFIER_PURGE_CHUNK_SIZE = NOTIFIER_PURGE.get('CHUNK_SIZE', 1000)
+# seconds to wait between two deletes, to let the other queries run
+NOTIFIER_PURGE_SLEEP = NOTIFIER_PURGE.get('SLEEP', 0.1)
+
+# seconds the user of a websocket token is cached by the push consumer, 0 to disable the cache
+NOTIFIER_WS_TOKEN_TTL = NOTIFIER_SETTINGS.get('WS_TOKEN_TTL', 60)
+# maximum number of tokens cached by process
+NOTIFIER_WS_TOKEN_CACHE_SIZE = NOTIFIER_SETTINGS.get('WS_TOKEN_CACHE_SIZE', 10000)
+# maximum number of unread notifications sent at once by the push consumer
+NOTIFIER_WS_UNREAD_PAGE_SIZE = NOTIFIER_SETTINGS.get('WS_UNREAD_PAGE_SIZE', 50)
+
 NOTIFIER_EMAIL = NOTIFIER_SETTINGS.get('EMAIL', {})
 NOTIFIER_EMAIL_DEFAULT_GATEWAY = NOTIFIER_EMAIL.get('DEFAULT_GATEWAY', 'default')
 
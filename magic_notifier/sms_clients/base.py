@@ -1,5 +1,17 @@
 """
 """
+import logging
+from threading import Lock
+from typing import Dict, Optional
+
+import requests
+from asgiref.sync import sync_to_async
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger("notifier")
 
 
 class BaseSmsClient:
@@ -7,3 +19,80 @@ class BaseSmsClient:
     @classmethod
     def send(cls, number: str, text: str, **kwargs):
         raise NotImplementedError
+
+    @classmethod
+    async def asend(cls, number: str, text: str, **kwargs):
+        """Send the sms from async code, the clients without an async api send it in a thread"""
+        return await sync_to_async(cls.send, thread_sensitive=False)(number, text, **kwargs)
+
+
+class HttpClient:
+    """Base of the clients calling an http api, with one keep-alive session per gateway and process.
+
+    The options of the gateway configure its session:
+
+    - POOL_SIZE: the connections kept open, default 10
+    - TIMEOUT: the timeout of the requests in seconds, default 30
+    - RETRIES: the retries of a failed connection, and of the read errors and the 429 and 5xx
+      responses of the idempotent requests, default 2. Only the failed connections of the clients
+      that aren't idempotent are retried
+    - RETRY_DELAY: the backoff factor between the retries in seconds, default 0.5
+    """
+
+    # headers sent with every request of the client
+    headers: Dict[str, str] = {}
+    # False when the GET or PUT of the client sends a message, the gateway may have sent it before
+    # failing. The POST are never retried after a response
+    idempotent: bool = True
+
+    # (client, gateway options) -> session
+    sessions: Dict[tuple, requests.Session] = {}
+    sessions_lock = Lock()
+
+    @classmethod
+    def get_session(cls, options: Optional[dict] = None) -> requests.Session:
+        options = options or {}
+        # the clients get the options of their gateway, not its name
+        key = (cls, repr(sorted(options.items())))
+        session = HttpClient.sessions.get(key)
+        if session is not None:
+            return session
+
+        with HttpClient.sessions_lock:
+            if key not in HttpClient.sessions:
+                HttpClient.sessions[key] = cls.build_session(options)
+            return HttpClient.sessions[key]
+
+    @classmethod
+    def build_session(cls, options: dict) -> requests.Session:
+        pool_size = options.get("POOL_SIZE", 10)
+        no_retry = None if cls.idempotent else 0
+        retry = Retry(total=options.get("RETRIES", 2), backoff_factor=options.get("RETRY_DELAY", 0.5),
+                      read=no_retry, status=no_retry, other=no_retry,
+                      status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        logger.debug(f"opening a new http session for {cls.__name__}")
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(cls.headers)
+        return session
+
+    @classmethod
+    def get_timeout(cls, options: Optional[dict] = None) -> float:
+        return (options or {}).get("TIMEOUT", 30)
+
+    @classmethod
+    def close_sessions(cls):
+        with HttpClient.sessions_lock:
+            sessions = list(HttpClient.sessions.values())
+            HttpClient.sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+@receiver(setting_changed)
+def close_http_sessions(setting, **kwargs):
+    if setting == "NOTIFIER":
+        HttpClient.close_sessions()
@@ -1,25 +1,40 @@
 import logging
 
-import requests
 from django.conf import settings
 
-from .base import BaseSmsClient
+from .base import BaseSmsClient, HttpClient
 
 logger = logging.getLogger("notifier")
 
 
-class CGSmsClient(BaseSmsClient):
+class CGSmsClient(BaseSmsClient, HttpClient):
+
+    url = "http://cheapglobalsms.com/api_v1"
+    # the sms are sent with a GET
+    idempotent = False
 
     @classmethod
-    def send(cls, number: str, text: str, **kwargs):
+    def get_params(cls, number: str, text: str) -> dict:
         sub_account = settings.NOTIFIER["SMS"]["GATEWAYS"]["CGS"]["SUB_ACCOUNT"]
         sub_account_pass = settings.NOTIFIER["SMS"]["GATEWAYS"]["CGS"]["SUB_ACCOUNT_PASSWORD"]
-        params = {
+        return {
             "sub_account": sub_account,
             "sub_account_pass": sub_account_pass,
             "action": "send_sms",
             "message": text,
             "recipients": number,
         }
-        res = requests.get("http://cheapglobalsms.com/api_v1", params=params)
+
+    @classmethod
+    def send(cls, number: str, text: str, **kwargs):
+        res = cls.get_session(kwargs).get(cls.url, params=cls.get_params(number, text),
+                                         timeout=cls.get_timeout(kwargs))
+        return res
+
+    @classmethod
+    async def asend(cls, number: str, text: str, **kwargs):
+        from magic_notifier.aio import get_http_client
+
+        res = await get_http_client().get(cls.url, params=cls.get_params(number, text),
+                                         timeout=cls.get_timeout(kwargs))
         return res
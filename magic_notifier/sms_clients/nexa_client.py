@@ -1,17 +1,18 @@
 import logging
 
-import requests
 from django.conf import settings
 
-from .base import BaseSmsClient
+from .base import BaseSmsClient, HttpClient
 
 logger = logging.getLogger("notifier")
 
 
-class NexaSmsClient(BaseSmsClient):
+class NexaSmsClient(BaseSmsClient, HttpClient):
+
+    url = "https://smsvas.com/bulk/public/index.php/api/v1/sendsms"
 
     @classmethod
-    def send(cls, number: str, text: str, **kwargs):
+    def get_params(cls, number: str, text: str, **kwargs) -> dict:
         if not kwargs:
             default_settings = settings.NOTIFIER["SMS"]["GATEWAYS"]["NEXA"]
         else:
@@ -27,9 +28,27 @@ class NexaSmsClient(BaseSmsClient):
             "mobiles": number.replace('+', ''),
         }
         logger.info(f"Sending sms with data {params}")
-        res = requests.post("https://smsvas.com/bulk/public/index.php/api/v1/sendsms", json=params)
+        return params
+
+    @classmethod
+    def log_response(cls, res):
         if(res.status_code != 200):
             logger.error(f"Failed to send the sms: {res.content}")
         else:
             logger.info(res.content)
+
+    @classmethod
+    def send(cls, number: str, text: str, **kwargs):
+        res = cls.get_session(kwargs).post(cls.url, json=cls.get_params(number, text, **kwargs),
+                                          timeout=cls.get_timeout(kwargs))
+        cls.log_response(res)
+        return res
+
+    @classmethod
+    async def asend(cls, number: str, text: str, **kwargs):
+        from magic_notifier.aio import get_http_client
+
+        res = await get_http_client().post(cls.url, json=cls.get_params(number, text, **kwargs),
+                                          timeout=cls.get_timeout(kwargs))
+        cls.log_response(res)
         return res
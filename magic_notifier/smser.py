@@ -1,13 +1,18 @@
-import importlib
+import asyncio
 import logging
 import traceback
-from threading import Thread
-from typing import Optional
+from collections import defaultdict
+from typing import Any, Dict, Optional
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.template.loader import render_to_string
 
-from magic_notifier.utils import get_settings, import_attribute
+from magic_notifier.aio import aiterate, async_method, limited
+from magic_notifier.registry import registry
+from magic_notifier.rendering import NotifierTemplate
+from magic_notifier.settings import NOTIFIER_CHUNK_SIZE
+from magic_notifier.utils import chunked_receivers, has_custom_number_resolver, resolve_user_numbers
+from magic_notifier.workers import submit
 
 logger = logging.getLogger("notifier")
 
@@ -18,55 +23,110 @@ class ExternalSMS:
                  final_message: Optional[str] = None, sms_gateway: Optional[str] = None, **kwargs):
         """This class is reponsible of sending a notification via sms.
 
-        :param receivers: list of User
+        :param receivers: list, queryset or manager of User
         :param template: the name of the template to user. Default None
         :param context: the context to be passed to template. Default None
         :param final_message: the final message to be sent as the notification content, must be sent if template is None, template is ignored if it is sent. Default None
         :param sms_gateway: the sms gateway to use. Default to None
-        :param kwargs:
+        :param kwargs: accept threaded and chunk_size (number of receivers loaded at once, default NOTIFIER["CHUNK_SIZE"])
         """
-        self.receivers: list = receivers
+        self.receivers = receivers
         self.template: Optional[str] = template
         self.context: dict = context
         self.threaded: bool = kwargs.get("threaded", False)
+        # raise the errors of the send instead of logging them, set by send_via
+        self.raise_errors: bool = False
+        # the pks of the users reached by the send and the errors of the others, recorded by the outbox
+        self.delivered: set = set()
+        self.failed: Dict[Any, str] = {}
+        self.number_users: Dict[str, list] = defaultdict(list)
+        self.chunk_size: int = kwargs.get("chunk_size") or NOTIFIER_CHUNK_SIZE
         self.final_message: Optional[str] = final_message
-        # get the default sms gateway
-        self.sms_gateway = get_settings('SMS::DEFAULT_GATEWAY') if sms_gateway is None else sms_gateway
-        # get the sms gateway definition
-        NOTIFIER_SMS_GATEWAY = get_settings('SMS')["GATEWAYS"][self.sms_gateway]
-        # get the sms client to be used
-        NOTIFIER_SMS_CLIENT = NOTIFIER_SMS_GATEWAY['CLIENT']
-        # load the sms client
-        module_name, class_name = NOTIFIER_SMS_CLIENT.rsplit(".", 1)
-        module = importlib.import_module(module_name)
-        assert hasattr(module, class_name), "class {} is not in {}".format(class_name, module_name)
-        self.client_class = getattr(module, class_name)
-        self.sms_class_options = NOTIFIER_SMS_GATEWAY
+        # get the gateway, resolved once by the registry
+        gateway = registry.get("sms", sms_gateway)
+        self.sms_gateway = gateway.name
+        self.client_class = gateway.client_class
+        self.rate_limiter = gateway.rate_limiter
+        self.sms_class_options = gateway.options
+
+    def receivers_fields(self, template: Optional[NotifierTemplate] = None) -> Optional[tuple]:
+        """The user columns needed to send the sms, None meaning all of them.
+
+        :param template: the template of the message, if it doesn't depend on the receiver the user is not needed
+        """
+        shared = self.final_message or (template is not None and template.shared)
+        if shared and not has_custom_number_resolver():
+            return ("pk",)
+        return None
 
     def send(self):
         if self.threaded:
-            t = Thread(target=self._send)
-            t.setDaemon(True)
-            t.start()
+            submit("sms", self._send)
         else:
             self._send()
 
+    def load_template(self) -> Optional[NotifierTemplate]:
+        if self.final_message:
+            return None
+        return NotifierTemplate.for_channel(self.template, "sms", self.context)
+
+    def build_messages(self, receivers: list, sms_template: Optional[NotifierTemplate]) -> list:
+        """Return the (number, content) of the receivers having a number"""
+        messages = []
+        for rec, number in resolve_user_numbers(receivers):
+            if not number:
+                logger.warning(f"Can't find a number for user {rec.pk}, ignoring.")
+                self.failed[rec.pk] = "no number found"
+                continue
+            self.number_users[number].append(rec.pk)
+
+            if self.final_message:
+                sms_content = self.final_message
+            else:
+                sms_content = sms_template.render(rec)
+            messages.append((number, sms_content))
+        return messages
+
+    def record(self, numbers: list, failed_numbers: Optional[list] = None):
+        """Record the users of the numbers as delivered, except the ones of the failed numbers"""
+        failed_numbers = set(failed_numbers or ())
+        for number in numbers:
+            for pk in self.number_users[number]:
+                if number in failed_numbers:
+                    self.failed[pk] = f"the message to {number} was not sent"
+                else:
+                    self.delivered.add(pk)
+
     def _send(self):
-        get_user_number = import_attribute(get_settings("GET_USER_NUMBER"))
+        try:
+            sms_template = self.load_template()
+
+            for receivers in chunked_receivers(self.receivers, self.chunk_size, self.receivers_fields(sms_template)):
+                for number, sms_content in self.build_messages(receivers, sms_template):
+                    self.rate_limiter.acquire()
+                    self.client_class.send(number, sms_content, **self.sms_class_options)
+                    self.record([number])
+        except:
+            if self.raise_errors:
+                raise
+            logger.error(traceback.format_exc())
 
+    async def asend(self, semaphore: Optional[asyncio.Semaphore] = None):
+        """Send the sms without blocking the event loop, at most semaphore sends at the same time.
+
+        The receivers are loaded and the messages rendered in the database thread, chunk by chunk.
+        """
         try:
-            for rec in self.receivers:
-                ctx = self.context.copy()
-                ctx["user"] = rec
-                number = get_user_number(rec)
-                if not number:
-                    logger.warning(f"Can't find a number for {rec}, ignoring.")
-
-                if self.final_message:
-                    sms_content = self.final_message
-                else:
-                    sms_content = render_to_string("notifier/{}/sms.txt".format(self.template), ctx)
+            sms_template = await sync_to_async(self.load_template)()
+            client_send = async_method(self.client_class, "asend", "send")
+
+            async def send_sms(number: str, sms_content: str):
+                await self.rate_limiter.aacquire()
+                await client_send(number, sms_content, **self.sms_class_options)
 
-                self.client_class.send(number, sms_content, **self.sms_class_options)
+            chunks = chunked_receivers(self.receivers, self.chunk_size, self.receivers_fields(sms_template))
+            async for messages in aiterate(self.build_messages(receivers, sms_template) for receivers in chunks):
+                await asyncio.gather(*(limited(semaphore, send_sms(number, sms_content))
+                                       for number, sms_content in messages))
         except:
             logger.error(traceback.format_exc())
@@ -2,6 +2,7 @@ from __future__ import absolute_import, unicode_literals
 
 import logging
 import os
+import time
 import traceback
 from urllib.parse import quote
 
@@ -9,3 +10,37 @@ import requests
 from celery import shared_task
 from django.conf import settings
 from django.shortcuts import reverse
+
+from magic_notifier.outbox import process_batch, requeue_stale
+from magic_notifier.purge import purge_notifications as purge
+
+logger = logging.getLogger("notifier")
+
+
+@shared_task
+def process_outbox(batch_size: int = None, channel: str = None) -> int:
+    """Send a batch of the outbox and queue the next one while items are left.
+
+    Many workers can run it at once, each call claims its own batch.
+    """
+    processed = process_batch(batch_size, channel)
+    if processed:
+        process_outbox.delay(batch_size, channel)
+    return processed
+
+
+@shared_task
+def requeue_stale_outbox(stale_after: int = None) -> int:
+    """Put back in the queue the items of the workers that died, to schedule periodically"""
+    return requeue_stale(stale_after)
+
+
+@shared_task
+def purge_notifications(read_retention: int = None, expired_only: bool = False) -> int:
+    """Delete the expired notifications and the old read ones, to schedule periodically"""
+    start = time.monotonic()
+    deleted = purge(read_retention, expired_only=expired_only)
+    duration = time.monotonic() - start
+    rate = deleted / duration if duration else 0
+    logger.info(f"{deleted} notifications deleted in {duration:.1f}s ({rate:.0f} rows/s)")
+    return deleted
@@ -1,50 +1,166 @@
 import asyncio
+import logging
+from collections import defaultdict
+from concurrent.futures import Future
+from threading import Lock, Thread
+from typing import Optional
 
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 from telethon.tl.functions.contacts import ImportContactsRequest
 from telethon.tl.types import InputPhoneContact
 from django.conf import settings
 import time
 
+from magic_notifier.ratelimit import RateLimiter
+
+logger = logging.getLogger("notifier")
+
 
 class TelethonClient:
 
+    # the future of the started client of each gateway
     running_clients = {}
+    # the event loop of each gateway, running in its own thread. A telethon client
+    # is bound to the loop it was started in
+    running_loops = {}
+    # the numbers already imported in the contacts of each gateway
+    imported_numbers = defaultdict(set)
+    # the monotonic time until which each gateway must not send because of a flood wait
+    flood_until = defaultdict(float)
+    lock = Lock()
+
+    @classmethod
+    def get_loop(cls, gateway: str) -> asyncio.AbstractEventLoop:
+        with cls.lock:
+            if gateway not in cls.running_loops:
+                loop = asyncio.new_event_loop()
+                Thread(target=loop.run_forever, name=f"telethon-{gateway}", daemon=True).start()
+                cls.running_loops[gateway] = loop
+            return cls.running_loops[gateway]
+
+    @classmethod
+    def run(cls, gateway: str, coroutine):
+        """Run the coroutine in the loop of the gateway and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, cls.get_loop(gateway)).result()
+
+    @classmethod
+    async def arun(cls, gateway: str, coroutine):
+        """Await the coroutine run in the loop of the gateway, from another event loop"""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, cls.get_loop(gateway)))
+
+    @classmethod
+    def client_future(cls, gateway: str, **kwargs) -> Future:
+        """Return the future of the client of the gateway, started once for all the threads and loops.
+
+        A client that failed to start is started again by the next caller.
+        """
+        loop = cls.get_loop(gateway)
+        with cls.lock:
+            future = cls.running_clients.get(gateway)
+            if future is None or (future.done() and (future.cancelled() or future.exception() is not None)):
+                future = asyncio.run_coroutine_threadsafe(cls.start_client(gateway, **kwargs), loop)
+                cls.running_clients[gateway] = future
+            return future
 
     @classmethod
     def get_client(cls, gateway:str, **kwargs) -> TelegramClient:
-        if gateway in cls.running_clients:
-            return cls.running_clients[gateway]
+        return cls.client_future(gateway, **kwargs).result()
 
+    @classmethod
+    async def aget_client(cls, gateway: str, **kwargs) -> TelegramClient:
+        # a cancelled caller must not cancel the start awaited by the others
+        return await asyncio.shield(asyncio.wrap_future(cls.client_future(gateway, **kwargs)))
+
+    @classmethod
+    async def start_client(cls, gateway: str, **kwargs) -> TelegramClient:
         api_id = kwargs["API_ID"]
         api_hash = kwargs["API_HASH"]
 
         client = TelegramClient(gateway, api_id, api_hash)
-        client.start()
-        cls.running_clients[gateway] = client
+        await client.start()
         return client
+
     @classmethod
     def send(cls, number:str, first_name:str, last_name:str, text:str,
              gateway:str, **kwargs):
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError as e:
-            if 'There is no current event loop' in str(e):
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-            else:
-                raise
+        cls.send_many([(number, first_name, last_name, text)], gateway, **kwargs)
+
+    @classmethod
+    def send_many(cls, messages: list, gateway: str, rate_limiter: Optional[RateLimiter] = None,
+                  **kwargs) -> list:
+        """Send a list of (number, first_name, last_name, text) with the client of the gateway.
+
+        The numbers not imported yet are imported in the contacts by batches of CONTACTS_BATCH_SIZE
+        (default 500), then up to CONCURRENCY (default 5) messages are sent at the same time, each
+        one once the rate_limiter of the gateway allows it.
 
+        :return: the numbers the message was not sent to
+        """
         client = cls.get_client(gateway, **kwargs)
-        client.loop.run_until_complete(cls.async_send(client, number, first_name,
-                        last_name, text))
+        return cls.run(gateway, cls.async_send_many(client, gateway, messages, rate_limiter, **kwargs))
+
+    @classmethod
+    async def asend(cls, number: str, first_name: str, last_name: str, text: str,
+                    gateway: str, **kwargs):
+        await cls.asend_many([(number, first_name, last_name, text)], gateway, **kwargs)
+
+    @classmethod
+    async def asend_many(cls, messages: list, gateway: str, rate_limiter: Optional[RateLimiter] = None,
+                         **kwargs) -> list:
+        """Like send_many, awaiting the loop of the gateway instead of blocking the caller's one"""
+        client = await cls.aget_client(gateway, **kwargs)
+        return await cls.arun(gateway, cls.async_send_many(client, gateway, messages, rate_limiter, **kwargs))
 
+    @classmethod
+    async def async_send_many(cls, client, gateway: str, messages: list,
+                              rate_limiter: Optional[RateLimiter] = None, **kwargs) -> list:
+        await cls.import_contacts(client, gateway, messages, kwargs.get("CONTACTS_BATCH_SIZE", 500))
+
+        semaphore = asyncio.Semaphore(kwargs.get("CONCURRENCY", 5))
+
+        async def send_message(number: str, text: str):
+            async with semaphore:
+                if rate_limiter:
+                    await rate_limiter.aacquire()
+                return await cls.call(gateway, client.send_message, number, text)
+
+        results = await asyncio.gather(*(send_message(number, text) for number, _, _, text in messages),
+                                       return_exceptions=True)
+        failed = []
+        for (number, _, _, _), result in zip(messages, results):
+            if isinstance(result, Exception):
+                logger.error(f"Can't send the telegram message to {number}: {result!r}")
+                failed.append(number)
+        return failed
 
     @classmethod
-    async def async_send(cls, client, number:str, first_name:str, last_name:str, text:str):
-        contact = InputPhoneContact(client_id=0, phone=number,
-                                    first_name=first_name, last_name=last_name)
-        result = await client(ImportContactsRequest([contact]))
-        print(result)
-        result = await client.send_message(number, text)
-        print(result)
+    async def import_contacts(cls, client, gateway: str, messages: list, batch_size: int):
+        imported = cls.imported_numbers[gateway]
+        contacts = {}
+        for number, first_name, last_name, _ in messages:
+            if number not in imported and number not in contacts:
+                contacts[number] = InputPhoneContact(client_id=len(contacts), phone=number,
+                                                     first_name=first_name or "", last_name=last_name or "")
+
+        contacts = list(contacts.values())
+        for i in range(0, len(contacts), batch_size):
+            batch = contacts[i:i + batch_size]
+            await cls.call(gateway, client, ImportContactsRequest(batch))
+            imported.update(contact.phone for contact in batch)
+
+    @classmethod
+    async def call(cls, gateway: str, func, *args, retries: int = 3):
+        """Await func(*args), pausing every call of the gateway when telegram asks to wait"""
+        for attempt in range(retries):
+            wait = cls.flood_until[gateway] - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            try:
+                return await func(*args)
+            except FloodWaitError as e:
+                if attempt == retries - 1:
+                    raise
+                logger.warning(f"Telegram asks {gateway} to wait {e.seconds} seconds")
+                cls.flood_until[gateway] = max(cls.flood_until[gateway], time.monotonic() + e.seconds)
@@ -1,14 +1,18 @@
-import importlib
+import asyncio
 import logging
 import traceback
-from threading import Thread
-from typing import Optional
+from collections import defaultdict
+from typing import Any, Dict, Optional
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.template import TemplateDoesNotExist
-from django.template.loader import render_to_string
 
-from magic_notifier.utils import get_settings, import_attribute
+from magic_notifier.aio import aiterate, async_method, limited
+from magic_notifier.registry import registry
+from magic_notifier.rendering import NotifierTemplate
+from magic_notifier.settings import NOTIFIER_CHUNK_SIZE
+from magic_notifier.utils import chunked_receivers, has_custom_number_resolver, resolve_user_numbers
+from magic_notifier.workers import submit
 
 logger = logging.getLogger("notifier")
 
@@ -19,60 +23,127 @@ class Telegramer:
                  final_message: Optional[str] = None, telegram_gateway: Optional[str] = None, **kwargs):
         """This class is reponsible of sending a notification via telegram.
 
-        :param receivers: list of User
+        :param receivers: list, queryset or manager of User
         :param template: the name of the template to user. Default None
         :param context: the context to be passed to template. Default None
         :param final_message: the final message to be sent as the notification content, must be sent if template is None, template is ignored if it is sent. Default None
         :param telegram_gateway: the telegram gateway to use. Default to None
-        :param kwargs:
+        :param kwargs: accept threaded and chunk_size (number of receivers loaded at once, default NOTIFIER["CHUNK_SIZE"])
         """
-        self.receivers: list = receivers
+        self.receivers = receivers
         self.template: Optional[str] = template
         self.context: dict = context
         self.threaded: bool = kwargs.get("threaded", False)
+        # raise the errors of the send instead of logging them, set by send_via
+        self.raise_errors: bool = False
+        # the pks of the users reached by the send and the errors of the others, recorded by the outbox
+        self.delivered: set = set()
+        self.failed: Dict[Any, str] = {}
+        self.number_users: Dict[str, list] = defaultdict(list)
+        self.chunk_size: int = kwargs.get("chunk_size") or NOTIFIER_CHUNK_SIZE
         self.final_message: Optional[str] = final_message
-        # get the default telegram gateway
-        self.telegram_gateway = get_settings('TELEGRAM::DEFAULT_GATEWAY') if telegram_gateway is None else telegram_gateway
-        # get the telegram gateway definition
-        NOTIFIER_TELEGRAM_GATEWAY = get_settings('TELEGRAM')["GATEWAYS"][self.telegram_gateway]
-        # get the telegram client to be used
-        NOTIFIER_TELEGRAM_CLIENT = NOTIFIER_TELEGRAM_GATEWAY.get('CLIENT',
-                                        'magic_notifier.telegram_clients.telethon.TelethonClient')
-        # load the telegram client
-        module_name, class_name = NOTIFIER_TELEGRAM_CLIENT.rsplit(".", 1)
-        module = importlib.import_module(module_name)
-        assert hasattr(module, class_name), "class {} is not in {}".format(class_name, module_name)
-        self.client_class = getattr(module, class_name)
-        self.telegram_class_options = NOTIFIER_TELEGRAM_GATEWAY
+        # get the gateway, resolved once by the registry
+        gateway = registry.get("telegram", telegram_gateway)
+        self.telegram_gateway = gateway.name
+        self.client_class = gateway.client_class
+        self.rate_limiter = gateway.rate_limiter
+        self.telegram_class_options = gateway.options
+
+    def receivers_fields(self, template: Optional[NotifierTemplate] = None) -> Optional[tuple]:
+        """The user columns needed to send the telegram message, None meaning all of them.
+
+        :param template: the template of the message, if it doesn't depend on the receiver the user is not needed
+        """
+        shared = self.final_message or (template is not None and template.shared)
+        if shared and not has_custom_number_resolver():
+            return ("pk", "first_name", "last_name")
+        return None
 
     def send(self):
         if self.threaded:
-            t = Thread(target=self._send)
-            t.setDaemon(True)
-            t.start()
+            submit("telegram", self._send)
         else:
             self._send()
 
-    def _send(self):
-        get_user_number = import_attribute(get_settings("GET_USER_NUMBER"))
+    def load_template(self) -> Optional[NotifierTemplate]:
+        if self.final_message:
+            return None
+        return NotifierTemplate.for_channel(self.template, "telegram", self.context)
+
+    def build_messages(self, receivers: list, telegram_template: Optional[NotifierTemplate]) -> list:
+        """Return the (number, first name, last name, content) of the receivers having a number"""
+        messages = []
+        for rec, number in resolve_user_numbers(receivers):
+            if not number:
+                logger.warning(f"Can't find a number for user {rec.pk}, ignoring.")
+                self.failed[rec.pk] = "no number found"
+                continue
+            self.number_users[number].append(rec.pk)
 
+            if self.final_message:
+                telegram_content = self.final_message
+            else:
+                telegram_content = telegram_template.render(rec)
+
+            messages.append((number, rec.first_name, rec.last_name, telegram_content))
+        return messages
+
+    def record(self, numbers: list, failed_numbers: Optional[list] = None):
+        """Record the users of the numbers as delivered, except the ones of the failed numbers"""
+        failed_numbers = set(failed_numbers or ())
+        for number in numbers:
+            for pk in self.number_users[number]:
+                if number in failed_numbers:
+                    self.failed[pk] = f"the message to {number} was not sent"
+                else:
+                    self.delivered.add(pk)
+
+    def _send(self):
         try:
-            for rec in self.receivers:
-                ctx = self.context.copy()
-                ctx["user"] = rec
-                number = get_user_number(rec)
-                if not number:
-                    logger.warning(f"Can't find a number for {rec}, ignoring.")
-
-                if self.final_message:
-                    telegram_content = self.final_message
+            telegram_template = self.load_template()
+
+            for receivers in chunked_receivers(self.receivers, self.chunk_size, self.receivers_fields(telegram_template)):
+                messages = self.build_messages(receivers, telegram_template)
+
+                # clients able to send many messages at once import the contacts by batches, taking
+                # a send of the rate limit for each message
+                if hasattr(self.client_class, "send_many"):
+                    failed_numbers = self.client_class.send_many(messages, self.telegram_gateway,
+                                                                 rate_limiter=self.rate_limiter,
+                                                                 **self.telegram_class_options)
+                    self.record([message[0] for message in messages], failed_numbers)
                 else:
-                    try:
-                        telegram_content = render_to_string("notifier/{}/telegram.txt".format(self.template), ctx)
-                    except TemplateDoesNotExist:
-                        telegram_content = render_to_string("notifier/{}/sms.txt".format(self.template), ctx)
+                    for number, first_name, last_name, telegram_content in messages:
+                        self.rate_limiter.acquire()
+                        self.client_class.send(number, first_name, last_name,
+                                    telegram_content, self.telegram_gateway, **self.telegram_class_options)
+                        self.record([number])
+        except:
+            if self.raise_errors:
+                raise
+            logger.error(traceback.format_exc())
+
+    async def asend(self, semaphore: Optional[asyncio.Semaphore] = None):
+        """Send the messages without blocking the event loop, at most semaphore sends at the same time.
 
-                self.client_class.send(number, rec.first_name, rec.last_name,
-                            telegram_content, self.telegram_gateway, **self.telegram_class_options)
+        The clients with asend_many get the messages by chunks and limit their own concurrency and rate.
+        """
+        try:
+            telegram_template = await sync_to_async(self.load_template)()
+            client_send = async_method(self.client_class, "asend", "send")
+
+            async def send_message(number: str, first_name: str, last_name: str, telegram_content: str):
+                await self.rate_limiter.aacquire()
+                await client_send(number, first_name, last_name, telegram_content, self.telegram_gateway,
+                                  **self.telegram_class_options)
+
+            chunks = chunked_receivers(self.receivers, self.chunk_size, self.receivers_fields(telegram_template))
+            async for messages in aiterate(self.build_messages(receivers, telegram_template) for receivers in chunks):
+                if hasattr(self.client_class, "asend_many"):
+                    await self.client_class.asend_many(messages, self.telegram_gateway,
+                                                       rate_limiter=self.rate_limiter,
+                                                       **self.telegram_class_options)
+                else:
+                    await asyncio.gather(*(limited(semaphore, send_message(*message)) for message in messages))
         except:
             logger.error(traceback.format_exc())
@@ -1,19 +1,27 @@
 import importlib
 import logging
+import random
 import traceback
-from typing import Any, Optional, Union
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import models
 from django.utils import timezone
 from datetime import datetime, timedelta
 
 from magic_notifier.models import Notification, NotifyProfile
+from magic_notifier.settings import NOTIFIER_CHUNK_SIZE
 
 logger = logging.getLogger('notifier')
 
 User = get_user_model()
 
+DEFAULT_GET_USER_NUMBER = "magic_notifier.utils.get_user_number"
+
+_missing = object()
+
 
 class NotificationBuilder:
     def __init__(self, subject):
@@ -167,15 +175,25 @@ class NotificationBuilder:
 
         return self
 
-    def save(self):
-        return Notification.objects.create(
+    def validate(self):
+        """Raise a ValueError if a field required by the notification is missing"""
+        for name, value in (("text", self.__text), ("type", self.__type), ("link", self.__link)):
+            if value is None:
+                raise ValueError(f"{name} should be set before saving")
+
+    def build(self, user: User = None) -> Notification:
+        """Return the notification without saving it, to be saved with bulk_create for example
+
+        :param user: the receiver of the notification, default to the user of the builder
+        """
+        return Notification(
             subject=self.__subject,
             text=self.__text,
             link=self.__link,
-            user=self.__user,
+            user=user if user is not None else self.__user,
             inited_by=self.__inited_by,
-            data=self.__data,
-            actions=self.__actions,
+            data=self.__data.copy(),
+            actions=self.__actions.copy(),
             image=self.__image,
             type=self.__type,
             sub_type=self.__sub_type,
@@ -184,6 +202,40 @@ class NotificationBuilder:
             expires=self.__expires
         )
 
+    def save(self):
+        notification = self.build()
+        notification.save(force_insert=True)
+        return notification
+
+    def save_many(self, users: Union[list, models.QuerySet, models.Manager], batch_size: int = None) -> List[Notification]:
+        """Save a copy of the notification for each user, batch_size rows by insert.
+
+        The primary keys of the returned notifications are set on the databases returning them
+        from a bulk insert (postgresql, sqlite, mariadb). No post_save signal is sent.
+
+        :param users: a list, queryset or manager of users
+        :param batch_size: the number of notifications inserted at once. Default to NOTIFIER['CHUNK_SIZE']
+        """
+        self.validate()
+        batch_size = batch_size if batch_size else NOTIFIER_CHUNK_SIZE
+        notifications: List[Notification] = []
+        for users_chunk in chunked_receivers(users, batch_size):
+            for user in users_chunk:
+                if not isinstance(user, User):
+                    raise ValueError("users should be User instances")
+            notifications.extend(Notification.objects.bulk_create([self.build(user) for user in users_chunk],
+                                                                  batch_size=batch_size))
+        return notifications
+
+    @classmethod
+    def bulk_save(cls, builders: Iterable["NotificationBuilder"], batch_size: int = None) -> List[Notification]:
+        """Save the notifications of many builders, batch_size rows by insert. See save_many()"""
+        builders = list(builders)
+        for builder in builders:
+            builder.validate()
+        batch_size = batch_size if batch_size else NOTIFIER_CHUNK_SIZE
+        return Notification.objects.bulk_create([builder.build() for builder in builders], batch_size=batch_size)
+
     def show(self):
         return (
             f"(text={self.__text}, link={self.__link}, user={self.__user}, "
@@ -203,6 +255,42 @@ def import_attribute(class_path:str) -> Any:
     return attribute
 
 
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """Return the seconds to wait before the retry number attempt (from 0).
+
+    The delay grows exponentially up to cap, with a full jitter so the retries of many senders spread out.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def chunked_receivers(receivers: Union[list, models.QuerySet, models.Manager], chunk_size: int,
+                      fields: Optional[Iterable[str]] = None) -> Iterator[list]:
+    """Yield the receivers by lists of at most chunk_size items.
+
+    Querysets and managers are walked with ``.iterator()`` so only one chunk of
+    users is held in memory at a time, whatever the number of receivers.
+
+    :param receivers: a list, queryset or manager of users
+    :param chunk_size: the maximum number of receivers per chunk
+    :param fields: if given and receivers is a queryset, only these columns are loaded
+    """
+    if isinstance(receivers, models.Manager):
+        receivers = receivers.all()
+
+    if isinstance(receivers, models.QuerySet):
+        if fields:
+            receivers = receivers.only(*fields)
+        iterator = receivers.iterator(chunk_size=chunk_size)
+    else:
+        iterator = iter(receivers)
+
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def get_user_number(user:User) -> Optional[str]:
     not_profile:NotifyProfile = NotifyProfile.objects.filter(user=user).first()
     if not_profile:
@@ -211,10 +299,51 @@ def get_user_number(user:User) -> Optional[str]:
     return None
 
 
-def get_settings(name:str) -> Any:
-    res = settings.NOTIFIER
-    for key in name.split('::'):
-        res = res[key]
+def get_user_numbers(users: Union[list, models.QuerySet]) -> Dict[Any, Optional[str]]:
+    """Return the phone numbers of the users by user pk, with one query."""
+    if isinstance(users, models.QuerySet):
+        profiles = NotifyProfile.objects.filter(user__in=users.values("pk"))
+    else:
+        profiles = NotifyProfile.objects.filter(user_id__in=[user.pk for user in users if user.pk is not None])
+    return dict(profiles.values_list("user_id", "phone_number"))
+
+
+def has_custom_number_resolver() -> bool:
+    """Tell if the phone numbers are resolved by functions of the project"""
+    from magic_notifier.registry import registry
+
+    return (registry.hook_path("GET_USER_NUMBERS") is not None
+            or registry.hook_path("GET_USER_NUMBER") != DEFAULT_GET_USER_NUMBER)
+
+
+def resolve_user_numbers(users: list) -> List[Tuple[Any, Optional[str]]]:
+    """Return the users with their phone number.
+
+    The numbers are fetched at once with the GET_USER_NUMBERS function. When only a custom
+    GET_USER_NUMBER function is configured, it is called for each user.
+    """
+    from magic_notifier.registry import registry
+
+    get_user_numbers_func = registry.hook("GET_USER_NUMBERS")
+    if get_user_numbers_func is None:
+        if registry.hook_path("GET_USER_NUMBER") != DEFAULT_GET_USER_NUMBER:
+            get_user_number_func = registry.hook("GET_USER_NUMBER")
+            return [(user, get_user_number_func(user)) for user in users]
+        get_user_numbers_func = get_user_numbers
+
+    numbers = get_user_numbers_func(users)
+    return [(user, numbers.get(user.pk)) for user in users]
+
+
+def get_settings(name:str, default: Any = _missing) -> Any:
+    res = getattr(settings, "NOTIFIER", {})
+    try:
+        for key in name.split('::'):
+            res = res[key]
+    except KeyError:
+        if default is _missing:
+            raise
+        return default
     return res
 
 
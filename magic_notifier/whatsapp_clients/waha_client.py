@@ -1,45 +1,179 @@
+import asyncio
+import heapq
 import requests
 from django.conf import settings
 import logging
 import time
 from random import randint
+from typing import List, Optional
+
+from magic_notifier.ratelimit import RateLimiter
+from magic_notifier.sms_clients.base import HttpClient
 
 logger = logging.getLogger("notifier")
 
-class WahaClient:
+class WahaClient(HttpClient):
 
     @classmethod
     def send(cls, number: str, text: str, **kwargs):
-        session = requests.Session()
+        cls.send_many([(number, text)], **kwargs)
+
+    @classmethod
+    def send_many(cls, messages: list, rate_limiter: Optional[RateLimiter] = None, **kwargs) -> List[str]:
+        """Send a list of (number, text) while overlapping the typing delays of the chats.
+
+        Each message is still sent after the chat has shown the typing status for 5 to 10
+        seconds (TYPING_DELAY option), but up to CONCURRENCY (default 20) chats are typing
+        at the same time, so the messages don't wait for the delays of each other.
+        A chat starts once the rate_limiter of the gateway allows one more send.
+
+        :return: the numbers the message was not sent to
+        """
+        session = cls.get_session(kwargs)
+        concurrency = kwargs.get("CONCURRENCY", 20)
+        min_delay, max_delay = kwargs.get("TYPING_DELAY", (5, 10))
+
+        # the chats typing, ordered by the time their message is due
+        typing = []
+        failed = []
+
+        def finish_next():
+            due, index, chat_id, text = heapq.heappop(typing)
+            if not cls.finish(session, due, index, chat_id, text, **kwargs):
+                failed.append(messages[index][0])
+
+        for i, (number, text) in enumerate(messages):
+            if rate_limiter:
+                rate_limiter.acquire()
+            try:
+                chat_id = cls.check_number(session, number, **kwargs)
+                if not chat_id:
+                    failed.append(number)
+                    continue
+                cls.start_typing(session, chat_id, **kwargs)
+            except Exception:
+                logger.exception(f"Can't send the whatsapp message to {number}")
+                failed.append(number)
+                continue
+
+            heapq.heappush(typing, (time.monotonic() + randint(min_delay, max_delay), i, chat_id, text))
+            if len(typing) >= concurrency:
+                finish_next()
+
+        while typing:
+            finish_next()
+        return failed
+
+    @classmethod
+    async def asend(cls, number: str, text: str, **kwargs):
+        await cls.asend_many([(number, text)], **kwargs)
+
+    @classmethod
+    async def asend_many(cls, messages: list, rate_limiter: Optional[RateLimiter] = None,
+                         **kwargs) -> List[str]:
+        """Like send_many, without blocking the event loop.
+
+        Up to CONCURRENCY (default 20) chats are typing at the same time.
+        """
+        from magic_notifier.aio import get_http_client
+
+        client = get_http_client()
+        semaphore = asyncio.Semaphore(kwargs.get("CONCURRENCY", 20))
+        min_delay, max_delay = kwargs.get("TYPING_DELAY", (5, 10))
+
+        async def send_message(number: str, text: str) -> bool:
+            async with semaphore:
+                if rate_limiter:
+                    await rate_limiter.aacquire()
+                try:
+                    chat_id = await cls.acheck_number(client, number, **kwargs)
+                    if not chat_id:
+                        return False
+                    await cls.apost(client, "startTyping", {'chatId': chat_id}, **kwargs)
+                    await asyncio.sleep(randint(min_delay, max_delay))
+                    await cls.apost(client, "stopTyping", {'chatId': chat_id}, **kwargs)
+                    await cls.apost(client, "sendText", {'chatId': chat_id, 'text': text}, **kwargs)
+                    return True
+                except Exception:
+                    logger.exception(f"Can't send the whatsapp message to {number}")
+                    return False
 
+        sent = await asyncio.gather(*(send_message(number, text) for number, text in messages))
+        return [number for (number, _), ok in zip(messages, sent) if not ok]
+
+    @classmethod
+    async def acheck_number(cls, client, number: str, **kwargs) -> Optional[str]:
         wa_number = number.replace('+', '') + "@c.us"
+        logger.info(f"Checking if {wa_number} exists")
+        resp = await client.get(f"{kwargs['BASE_URL']}/api/contacts/check-exists",
+                                params={'phone': wa_number, 'session': kwargs.get('SESSION', 'default')},
+                                timeout=cls.get_timeout(kwargs))
+        res = resp.json()
+        if not res['numberExists']:
+            logger.info(f"Number {number} doesn't exist aborting")
+            return None
+
+        return res['chatId']
 
-        base_url = kwargs["BASE_URL"]
-        url_check_number = f"{base_url}/api/contacts/check-exists"
-        url_send_typing = f"{base_url}/api/startTyping"
-        url_stop_typing = f"{base_url}/api/stopTyping"
-        url_send_message = f"{base_url}/api/sendText"
+    @classmethod
+    async def apost(cls, client, action: str, data: dict, **kwargs):
+        logger.info(f"{action} to {data['chatId']}")
+        resp = await client.post(f"{kwargs['BASE_URL']}/api/{action}",
+                                 json={**data, 'session': kwargs.get('SESSION', 'default')},
+                                 timeout=cls.get_timeout(kwargs))
+        logger.info(f"{resp.content = }")
 
+    @classmethod
+    def finish(cls, session: requests.Session, due: float, index: int, chat_id: str, text: str, **kwargs) -> bool:
+        """Wait for the message to be due then stop typing and send it, return False if it failed"""
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            cls.stop_typing(session, chat_id, **kwargs)
+            cls.send_text(session, chat_id, text, **kwargs)
+            return True
+        except Exception:
+            logger.exception(f"Can't send the whatsapp message to {chat_id}")
+            return False
+
+    @classmethod
+    def check_number(cls, session: requests.Session, number: str, **kwargs) -> Optional[str]:
+        """Return the chat id of the number, None if the number is not on whatsapp"""
+        wa_number = number.replace('+', '') + "@c.us"
         logger.info(f"Checking if {wa_number} exists")
-        resp = session.get(url_check_number, params={'phone': wa_number, 'session': 'default'})
+        resp = session.get(f"{kwargs['BASE_URL']}/api/contacts/check-exists",
+                           params={'phone': wa_number, 'session': kwargs.get('SESSION', 'default')},
+                           timeout=cls.get_timeout(kwargs))
         logger.info(f"{resp.content = }")
         res = resp.json()
         if not res['numberExists']:
             logger.info(f"Number {number} doesn't exist aborting")
-            return
+            return None
 
-        wa_number = res['chatId']
+        return res['chatId']
 
-        logger.info(f"Start typing to {wa_number}")
-        resp = session.post(url_send_typing, json={'chatId': wa_number, 'session': 'default'})
+    @classmethod
+    def start_typing(cls, session: requests.Session, chat_id: str, **kwargs):
+        logger.info(f"Start typing to {chat_id}")
+        resp = session.post(f"{kwargs['BASE_URL']}/api/startTyping",
+                            json={'chatId': chat_id, 'session': kwargs.get('SESSION', 'default')},
+                            timeout=cls.get_timeout(kwargs))
         logger.info(f"{resp.content = }")
-        time.sleep(randint(5, 10))
 
-        logger.info(f"Stop typing to {wa_number}")
-        resp = session.post(url_stop_typing, json={'chatId': wa_number, 'session': 'default'})
+    @classmethod
+    def stop_typing(cls, session: requests.Session, chat_id: str, **kwargs):
+        logger.info(f"Stop typing to {chat_id}")
+        resp = session.post(f"{kwargs['BASE_URL']}/api/stopTyping",
+                            json={'chatId': chat_id, 'session': kwargs.get('SESSION', 'default')},
+                            timeout=cls.get_timeout(kwargs))
         logger.info(f"{resp.content = }")
 
-        logger.info(f"Send message to {wa_number}")
-        resp = session.post(url_send_message, json={'chatId': wa_number, 'session': 'default',
-                                                    'text': text})
+    @classmethod
+    def send_text(cls, session: requests.Session, chat_id: str, text: str, **kwargs):
+        logger.info(f"Send message to {chat_id}")
+        resp = session.post(f"{kwargs['BASE_URL']}/api/sendText",
+                            json={'chatId': chat_id, 'session': kwargs.get('SESSION', 'default'), 'text': text},
+                            timeout=cls.get_timeout(kwargs))
         logger.info(f"{resp.content = }")
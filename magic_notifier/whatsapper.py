@@ -1,14 +1,18 @@
-import importlib
+import asyncio
 import logging
 import traceback
-from threading import Thread
-from typing import Optional
+from collections import defaultdict
+from typing import Any, Dict, Optional
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.template import TemplateDoesNotExist
-from django.template.loader import render_to_string
 
-from magic_notifier.utils import get_settings, import_attribute
+from magic_notifier.aio import aiterate, async_method, limited
+from magic_notifier.registry import registry
+from magic_notifier.rendering import NotifierTemplate
+from magic_notifier.settings import NOTIFIER_CHUNK_SIZE
+from magic_notifier.utils import chunked_receivers, has_custom_number_resolver, resolve_user_numbers
+from magic_notifier.workers import submit
 
 logger = logging.getLogger("notifier")
 
@@ -19,59 +23,124 @@ class Whatsapper:
                  final_message: Optional[str] = None, whatsapp_gateway: Optional[str] = None, **kwargs):
         """This class is reponsible of sending a notification via whatsapp.
 
-        :param receivers: list of User
+        :param receivers: list, queryset or manager of User
         :param template: the name of the template to user. Default None
         :param context: the context to be passed to template. Default None
         :param final_message: the final message to be sent as the notification content, must be sent if template is None, template is ignored if it is sent. Default None
         :param whatsapp_gateway: the whatsapp gateway to use. Default to None
-        :param kwargs:
+        :param kwargs: accept threaded and chunk_size (number of receivers loaded at once, default NOTIFIER["CHUNK_SIZE"])
         """
-        self.receivers: list = receivers
+        self.receivers = receivers
         self.template: Optional[str] = template
         self.context: dict = context
         self.threaded: bool = kwargs.get("threaded", False)
+        # raise the errors of the send instead of logging them, set by send_via
+        self.raise_errors: bool = False
+        # the pks of the users reached by the send and the errors of the others, recorded by the outbox
+        self.delivered: set = set()
+        self.failed: Dict[Any, str] = {}
+        self.number_users: Dict[str, list] = defaultdict(list)
+        self.chunk_size: int = kwargs.get("chunk_size") or NOTIFIER_CHUNK_SIZE
         self.final_message: Optional[str] = final_message
-        # get the default whatsapp gateway
-        self.whatsapp_gateway = get_settings('WHATSAPP::DEFAULT_GATEWAY') if whatsapp_gateway is None else whatsapp_gateway
-        # get the whatsapp gateway definition
-        NOTIFIER_WHATSAPP_GATEWAY = get_settings('WHATSAPP')["GATEWAYS"][self.whatsapp_gateway]
-        # get the whatsapp client to be used
-        NOTIFIER_WHATSAPP_CLIENT = NOTIFIER_WHATSAPP_GATEWAY.get('CLIENT',
-                                                    'magic_notifier.whatsapp_clients.waha_client.WahaClient')
-        # load the whatsapp client
-        module_name, class_name = NOTIFIER_WHATSAPP_CLIENT.rsplit(".", 1)
-        module = importlib.import_module(module_name)
-        assert hasattr(module, class_name), "class {} is not in {}".format(class_name, module_name)
-        self.client_class = getattr(module, class_name)
-        self.whatsapp_class_options = NOTIFIER_WHATSAPP_GATEWAY
+        # get the gateway, resolved once by the registry
+        gateway = registry.get("whatsapp", whatsapp_gateway)
+        self.whatsapp_gateway = gateway.name
+        self.client_class = gateway.client_class
+        self.rate_limiter = gateway.rate_limiter
+        self.whatsapp_class_options = gateway.options
+
+    def receivers_fields(self, template: Optional[NotifierTemplate] = None) -> Optional[tuple]:
+        """The user columns needed to send the whatsapp message, None meaning all of them.
+
+        :param template: the template of the message, if it doesn't depend on the receiver the user is not needed
+        """
+        shared = self.final_message or (template is not None and template.shared)
+        if shared and not has_custom_number_resolver():
+            return ("pk",)
+        return None
 
     def send(self):
         if self.threaded:
-            t = Thread(target=self._send)
-            t.setDaemon(True)
-            t.start()
+            submit("whatsapp", self._send)
         else:
             self._send()
 
-    def _send(self):
-        get_user_number = import_attribute(get_settings("GET_USER_NUMBER"))
+    def load_template(self) -> Optional[NotifierTemplate]:
+        if self.final_message:
+            return None
+        return NotifierTemplate.for_channel(self.template, "whatsapp", self.context)
+
+    def build_messages(self, receivers: list, whatsapp_template: Optional[NotifierTemplate]) -> list:
+        """Return the (number, content) of the receivers having a number"""
+        messages = []
+        for rec, number in resolve_user_numbers(receivers):
+            if not number:
+                logger.warning(f"Can't find a number for user {rec.pk}, ignoring.")
+                self.failed[rec.pk] = "no number found"
+                continue
+            self.number_users[number].append(rec.pk)
 
+            if self.final_message:
+                whatsapp_content = self.final_message
+            else:
+                whatsapp_content = whatsapp_template.render(rec)
+
+            messages.append((number, whatsapp_content))
+        return messages
+
+    def record(self, numbers: list, failed_numbers: Optional[list] = None):
+        """Record the users of the numbers as delivered, except the ones of the failed numbers"""
+        failed_numbers = set(failed_numbers or ())
+        for number in numbers:
+            for pk in self.number_users[number]:
+                if number in failed_numbers:
+                    self.failed[pk] = f"the message to {number} was not sent"
+                else:
+                    self.delivered.add(pk)
+
+    def _send(self):
         try:
-            for rec in self.receivers:
-                ctx = self.context.copy()
-                ctx["user"] = rec
-                number = get_user_number(rec)
-                if not number:
-                    logger.warning(f"Can't find a number for {rec}, ignoring.")
-
-                if self.final_message:
-                    whatsapp_content = self.final_message
+            whatsapp_template = self.load_template()
+
+            for receivers in chunked_receivers(self.receivers, self.chunk_size, self.receivers_fields(whatsapp_template)):
+                messages = self.build_messages(receivers, whatsapp_template)
+
+                # clients able to send many messages at once overlap their delays, taking a send
+                # of the rate limit for each message
+                if hasattr(self.client_class, "send_many"):
+                    failed_numbers = self.client_class.send_many(messages, rate_limiter=self.rate_limiter,
+                                                                 **self.whatsapp_class_options)
+                    self.record([number for number, _ in messages], failed_numbers)
                 else:
-                    try:
-                        whatsapp_content = render_to_string("notifier/{}/whatsapp.txt".format(self.template), ctx)
-                    except TemplateDoesNotExist:
-                        whatsapp_content = render_to_string("notifier/{}/sms.txt".format(self.template), ctx)
+                    for number, whatsapp_content in messages:
+                        self.rate_limiter.acquire()
+                        self.client_class.send(number, whatsapp_content, **self.whatsapp_class_options)
+                        self.record([number])
+        except:
+            if self.raise_errors:
+                raise
+            logger.error(traceback.format_exc())
+
+    async def asend(self, semaphore: Optional[asyncio.Semaphore] = None):
+        """Send the messages without blocking the event loop, at most semaphore sends at the same time.
 
-                self.client_class.send(number, whatsapp_content, **self.whatsapp_class_options)
+        The clients with asend_many get the messages by chunks and limit their own concurrency and rate.
+        """
+        try:
+            whatsapp_template = await sync_to_async(self.load_template)()
+            client_send = async_method(self.client_class, "asend", "send")
+
+            async def send_message(number: str, whatsapp_content: str):
+                await self.rate_limiter.aacquire()
+                await client_send(number, whatsapp_content, **self.whatsapp_class_options)
+
+            chunks = chunked_receivers(self.receivers, self.chunk_size, self.receivers_fields(whatsapp_template))
+            async for messages in aiterate(self.build_messages(receivers, whatsapp_template) for receivers in chunks):
+                if hasattr(self.client_class, "asend_many"):
+                    await self.client_class.asend_many(messages, rate_limiter=self.rate_limiter,
+                                                       **self.whatsapp_class_options)
+                else:
+                    await asyncio.gather(*(limited(semaphore, send_message(number, whatsapp_content))
+                                           for number, whatsapp_content in messages))
         except:
             logger.error(traceback.format_exc())
@@ -0,0 +1,104 @@
+import atexit
+import logging
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from typing import Callable, Dict, Optional
+
+from django.db import close_old_connections
+
+from magic_notifier.settings import (NOTIFIER_WORKERS_BACKPRESSURE, NOTIFIER_WORKERS_MAX_WORKERS,
+                                     NOTIFIER_WORKERS_QUEUE_SIZE)
+
+logger = logging.getLogger("notifier")
+
+BACKPRESSURE_POLICIES = ("block", "drop", "inline")
+
+
+class ChannelExecutor:
+
+    def __init__(self, channel: str, max_workers: int, queue_size: int, backpressure: str = "block"):
+        """A bounded pool of threads sending the notifications of one channel.
+
+        :param channel: the name of the channel, used to name the threads
+        :param max_workers: the maximum number of threads sending at the same time
+        :param queue_size: the maximum number of sends waiting for a free thread
+        :param backpressure: what to do when the queue is full. 'block' waits for a free slot,
+            'drop' discards the send and 'inline' runs it in the calling thread
+        """
+        assert backpressure in BACKPRESSURE_POLICIES, f"unknown backpressure policy {backpressure}"
+        self.channel = channel
+        self.backpressure = backpressure
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix=f"notifier-{channel}")
+        self.slots = BoundedSemaphore(max_workers + queue_size)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Optional[Future]:
+        if self.backpressure == "block":
+            self.slots.acquire()
+        elif not self.slots.acquire(blocking=False):
+            if self.backpressure == "drop":
+                logger.warning(f"The {self.channel} queue is full, dropping {fn}")
+                return None
+            logger.warning(f"The {self.channel} queue is full, running {fn} inline")
+            self._run(fn, args, kwargs, release=False)
+            return None
+
+        try:
+            return self.executor.submit(self._run, fn, args, kwargs)
+        except RuntimeError:
+            # the executor is shut down, we don't want to lose the notification
+            self.slots.release()
+            self._run(fn, args, kwargs, release=False)
+            return None
+
+    def _run(self, fn: Callable, args: tuple, kwargs: dict, release: bool = True):
+        # the worker threads outlive the requests, their connections are recycled like the ones
+        # of a request. The inline runs keep the connections of the calling thread
+        if release:
+            close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            logger.error(traceback.format_exc())
+        finally:
+            if release:
+                close_old_connections()
+                self.slots.release()
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
+
+_executors: Dict[str, ChannelExecutor] = {}
+_executors_lock = Lock()
+
+
+def get_executor(channel: str) -> ChannelExecutor:
+    """Return the process wide executor of a channel, creating it on first use."""
+    with _executors_lock:
+        if channel not in _executors:
+            if isinstance(NOTIFIER_WORKERS_MAX_WORKERS, dict):
+                max_workers = NOTIFIER_WORKERS_MAX_WORKERS.get(channel, 4)
+            else:
+                max_workers = NOTIFIER_WORKERS_MAX_WORKERS
+            _executors[channel] = ChannelExecutor(channel, max_workers, NOTIFIER_WORKERS_QUEUE_SIZE,
+                                                  NOTIFIER_WORKERS_BACKPRESSURE)
+        return _executors[channel]
+
+
+def submit(channel: str, fn: Callable, *args, **kwargs) -> Optional[Future]:
+    """Send fn to the background pool of the channel"""
+    return get_executor(channel).submit(fn, *args, **kwargs)
+
+
+@atexit.register
+def shutdown(wait: bool = True):
+    """Drain the pending sends of every channel. It is called when the process exits
+    and can be called from a worker shutdown hook (gunicorn worker_exit, celery worker_shutdown...)"""
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+
+    for executor in executors:
+        executor.shutdown(wait=wait)
@@ -35,7 +35,8 @@ EXTRAS = {
     'push': ['channels', 'channels-redis'],
     'telegram': ['telethon'],
     'fcm': ['pyfcm'],
-    'amazon_ses': ['django-ses']
+    'amazon_ses': ['django-ses'],
+    'async': ['httpx', 'aiosmtplib']
 }
 
 # The rest you shouldn't have to touch too much :)
@@ -1,29 +1,72 @@
+import asyncio
 import json
 import os
+import smtplib
+import subprocess
+import sys
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
 from pathlib import Path
-from unittest import mock
+from threading import Thread
+from unittest import mock, skipUnless
 from unittest.mock import patch
 
 import requests
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
 from django.contrib.auth import get_user_model
 from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.mail import get_connection
 from django.core.management import call_command
-from django.template.loader import render_to_string
+from django.db import connection
+from django.template import Template, engines
+from django.template.loader import render_to_string, select_template
 from django.test import TestCase, override_settings, LiveServerTestCase
-
-from magic_notifier.models import NotifyProfile, Notification
-from magic_notifier.notifier import notify
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils import timezone
+
+from magic_notifier.consumers import PushNotifConsumer, ws_users
+from magic_notifier.emailer import Emailer, email_connections
+from magic_notifier.models import NotifyProfile, Notification, OutboxItem
+from magic_notifier.notifier import anotify, notify
+from magic_notifier.outbox import claim_batch, process_batch, requeue_stale
+from magic_notifier.purge import purge_notifications
 from magic_notifier.pusher import Pusher
+from magic_notifier.ratelimit import RateLimiter
+from magic_notifier.registry import registry
+from magic_notifier.rendering import (NotifierTemplate, depends_on_recipient, get_notifier_template,
+                                      notifier_templates, template_variables)
+from magic_notifier.sms_clients.cgsms_client import CGSmsClient
+from magic_notifier.sms_clients.nexa_client import NexaSmsClient
 from magic_notifier.telegramer import Telegramer
 from magic_notifier.telegram_clients.telethon import TelethonClient
-from magic_notifier.utils import NotificationBuilder
+from magic_notifier.utils import NotificationBuilder, chunked_receivers
 from magic_notifier.serializers import NotificationSerializer
 from magic_notifier.whatsapp_clients.waha_client import WahaClient
 from magic_notifier.whatsapper import Whatsapper
+from magic_notifier.workers import ChannelExecutor
 User = get_user_model()
 
 
+class BackupEmailClient:
+    """Email client of the fallback gateway in the tests"""
+
+    @classmethod
+    def get_connection(cls, email_settings: dict):
+        connection = get_connection("django.core.mail.backends.locmem.EmailBackend")
+        connection.gateway = "backup"
+        return connection
+
+
 class EmailTestCase(TestCase):
     """Class to test emails sending"""
 
@@ -69,6 +112,31 @@ class EmailTestCase(TestCase):
         self.assertEqual(first_message.to, [user.email])
         self.assertEqual(first_message.subject, subject)
 
+    def test_executor_backpressure(self):
+        import threading
+        release = threading.Event()
+        ran = []
+
+        for policy, expected in (("drop", []), ("inline", [threading.get_ident()])):
+            executor = ChannelExecutor("email", max_workers=1, queue_size=0, backpressure=policy)
+            executor.submit(release.wait)
+            executor.submit(lambda: ran.append(threading.get_ident()))
+            self.assertEqual(ran, expected)
+            release.set()
+            executor.shutdown()
+            release.clear()
+
+    def test_executor_closes_old_connections(self):
+        with patch('magic_notifier.workers.close_old_connections') as mock_close:
+            executor = ChannelExecutor("email", max_workers=1, queue_size=0, backpressure="inline")
+            executor.submit(lambda: None).result()
+            executor.shutdown()
+            self.assertEqual(mock_close.call_count, 2)
+
+            # the inline runs keep the connections of the calling thread
+            executor._run(lambda: None, (), {}, release=False)
+            self.assertEqual(mock_close.call_count, 2)
+
     def test_simple_direct_email(self):
         subject = "Test magic notifier"
         notify(["email"], subject, ["testuser@localhost"], final_message="Nice if you get this")
@@ -90,6 +158,21 @@ class EmailTestCase(TestCase):
         self.assertEqual(first_message.subject, subject)
         self.assertEqual(len(first_message.alternatives), 1)
 
+    def test_template_mjml_compiled_once(self):
+        import mjml
+        from magic_notifier import emailer
+
+        subject = "Test magic notifier"
+        with patch('mjml.mjml2html', wraps=mjml.mjml2html) as mock_mjml2html:
+            emailer.compiled_mjml_templates.clear()
+            notify(["email"], subject, "staff", template='welcome')
+
+        self.assertEqual(mock_mjml2html.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3) # type: ignore
+        for message in mail.outbox: # type: ignore
+            username = message.to[0].split("@")[0]
+            self.assertIn(f"Hello {username}", message.alternatives[0][0])
+
     def test_template_txt_with_user(self):
         user = User(email="testuser@localhost", username="testuser")
 
@@ -192,6 +275,31 @@ class EmailTestCase(TestCase):
             self.assertEqual(len(first_message.alternatives), 0)
             self.assertGreater(len(first_message.attachments), 0)
 
+    def test_files_read_once_for_all_receivers(self):
+        users = [User(email=f"testuser{i}@localhost", username=f"testuser{i}") for i in range(3)]
+        path = Path(__file__).parent / "models.py"
+
+        with open(str(path), "rb") as fp, tempfile.NamedTemporaryFile(suffix=".bin") as large, \
+                patch("magic_notifier.attachments.MMAP_THRESHOLD", 10):
+            large.write(b"\x00\xff" * 100)
+            large.flush()
+            notify(["email"], "Test magic notifier", users, template='hello',
+                   files=[("models.py", fp), large.name])
+
+        self.assertEqual(len(mail.outbox), 3) # type: ignore
+        for message in mail.outbox: # type: ignore
+            self.assertEqual(len(message.attachments), 2)
+            self.assertEqual(message.attachments[0].get_payload(decode=True), path.read_bytes())
+            self.assertEqual(message.attachments[1].get_payload(decode=True), b"\x00\xff" * 100)
+            self.assertEqual(message.attachments[1].get_filename(), os.path.basename(large.name))
+        self.assertIn(b"Content-Disposition: attachment", mail.outbox[2].message().as_bytes()) # type: ignore
+
+        # the parts are built once and shared by the emails
+        emailer = Emailer("Test magic notifier", users, None, {}, final_message="Hello",
+                          files=[str(path)])
+        self.assertIs(emailer.build_message(users[0]).attachments[0],
+                      emailer.build_message(users[1]).attachments[0])
+
     def test_simple_with_string_all(self):
         subject = "Test magic notifier"
         notify(["email"], subject, "all", final_message="Nice if you get this")
@@ -222,6 +330,105 @@ class EmailTestCase(TestCase):
 
         self.assertEqual(len(mail.outbox), 3) # type: ignore
 
+    def test_simple_with_string_all_chunked(self):
+        subject = "Test magic notifier"
+        with CaptureQueriesContext(connection) as queries:
+            notify(["email"], subject, "all", final_message="Nice if you get this", chunk_size=4)
+
+        self.assertEqual(len(mail.outbox), 6) # type: ignore
+        # the queryset is streamed with only the needed columns
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn("password", queries[0]["sql"])
+
+    def test_closed_connection_not_reused(self):
+        from magic_notifier.email_clients.django_email import DjangoEmailClient
+
+        email_connections.close_all()
+        closed = mock.MagicMock()
+        closed.connection = mock.create_autospec(smtplib.SMTP, instance=True)
+        closed.connection.noop.side_effect = smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        alive = mock.MagicMock()
+        alive.connection = mock.create_autospec(smtplib.SMTP, instance=True)
+        alive.connection.noop.return_value = (250, b"OK")
+        email_connections.idle_connections["default"] = [alive, closed]
+
+        client = mock.MagicMock()
+        self.assertIs(email_connections.acquire("default", client, {}), alive)
+        closed.close.assert_called_once()
+        client.get_connection.assert_not_called()
+
+        # once the idle connections are all closed a new one is opened
+        alive.connection.noop.side_effect = OSError("Broken pipe")
+        email_connections.release("default", alive, {})
+        self.assertIs(email_connections.acquire("default", client, {}), client.get_connection.return_value)
+        client.get_connection.return_value.open.assert_called_once()
+
+    def test_connection_reused_and_batched(self):
+        from magic_notifier.email_clients.django_email import DjangoEmailClient
+        from magic_notifier.emailer import email_connections
+
+        email_connections.close_all()
+        subject = "Test magic notifier"
+        with patch.object(DjangoEmailClient, 'get_connection', wraps=DjangoEmailClient.get_connection) as mock_conn, \
+                patch('django.core.mail.backends.locmem.EmailBackend.send_messages', autospec=True,
+                      side_effect=lambda backend, messages: mail.outbox.extend(messages)) as mock_send:
+            notify(["email"], subject, "all", final_message="Nice if you get this")
+            notify(["email"], subject, "staff", final_message="Nice if you get this")
+
+        self.assertEqual(len(mail.outbox), 9) # type: ignore
+        self.assertEqual(mock_conn.call_count, 1)
+        # every email is sent on the pooled connection
+        self.assertEqual(mock_send.call_count, 9)
+        self.assertEqual(len({id(call.args[0]) for call in mock_send.call_args_list}), 1)
+
+    def test_fallback_only_failed_recipients(self):
+        NOTIFIER = {
+            "EMAIL": {
+                "default": {
+                    "CLIENT": "magic_notifier.email_clients.django_email.DjangoEmailClient",
+                    "HOST": "", "PORT": 0, "USER": "", "PASSWORD": "", "FROM": "main@localhost",
+                    "RETRIES": 1, "RETRY_DELAY": 0,
+                },
+                "backup": {
+                    "CLIENT": "core.tests.BackupEmailClient",
+                    "FROM": "backup@localhost",
+                },
+                "FALLBACKS": ["backup"],
+            }
+        }
+        users = [User.objects.create(email=f"fallback{i}@localhost", username=f"fallback{i}") for i in range(5)]
+        attempts = []
+
+        def send_messages(backend, messages):
+            gateway = getattr(backend, "gateway", "default")
+            for message in messages:
+                attempts.append((gateway, message.to[0]))
+                if gateway == "default" and message.to == ["fallback2@localhost"]:
+                    raise smtplib.SMTPServerDisconnected()
+            mail.outbox.extend(messages) # type: ignore
+            return len(messages)
+
+        with self.settings(NOTIFIER=NOTIFIER), \
+                patch('django.core.mail.backends.locmem.EmailBackend.send_messages', autospec=True,
+                      side_effect=send_messages), \
+                patch.object(Emailer, 'build_message', autospec=True, side_effect=Emailer.build_message) as mock_build:
+            notify(["email"], "Test magic notifier", users, final_message="Nice if you get this")
+
+        self.assertEqual(mock_build.call_count, 5)
+        # the failing email is retried once then the rest goes through the backup gateway
+        self.assertEqual(attempts, [("default", "fallback0@localhost"), ("default", "fallback1@localhost"),
+                                    ("default", "fallback2@localhost"), ("default", "fallback2@localhost"),
+                                    ("backup", "fallback2@localhost"), ("backup", "fallback3@localhost"),
+                                    ("backup", "fallback4@localhost")])
+        self.assertEqual([(message.to[0], message.from_email) for message in mail.outbox], # type: ignore
+                         [(f"fallback{i}@localhost", "main@localhost" if i < 2 else "backup@localhost")
+                          for i in range(5)])
+
+    def test_chunked_receivers(self):
+        chunks = list(chunked_receivers(User.objects.order_by("pk"), 4))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 2])
+        self.assertEqual(list(chunked_receivers(["a", "b", "c"], 2)), [["a", "b"], ["c"]])
+
     def test_simple_with_string_unknown(self):
         subject = "Test magic notifier"
         self.assertRaises(ValueError, notify, ["email"], subject, "unknown", final_message="Nice if you get this")
@@ -300,64 +507,10 @@ def send_to_sms_outbox(*args, **kwargs):
                         }))
 
 
-def notifier_settings_for_global_cheap(*args, **kwargs):
-    if args[0] == "SMS::DEFAULT_GATEWAY":
-        return "CGS"
-    elif args[0] == "SMS":
-        return {
-                    "GATEWAYS": {
-                        "CGS": {
-                            "CLIENT": "magic_notifier.sms_clients.cgsms_client.CGSmsClient",
-                            "SUB_ACCOUNT": "sub_account",
-                            "SUB_ACCOUNT_PASSWORD": "sub_account_password"
-                        }
-                    }
-                }
-    elif args[0] == "GET_USER_NUMBER":
-        return "magic_notifier.utils.get_user_number"
-
-
-def notifier_settings_for_nexa(*args, **kwargs):
-    if args[0] == "SMS::DEFAULT_GATEWAY":
-        return "NEXA"
-    elif args[0] == "SMS":
-        return {
-                    "GATEWAYS": {
-                        "NEXA": {
-                            "CLIENT": "magic_notifier.sms_clients.nexa_client.NexaSmsClient",
-                            "EMAIL": "sub_account",
-                            "PASSWORD": "sub_account_password",
-                            "SENDERID": "senderid"
-                        }
-                    }
-                }
-    elif args[0] == "GET_USER_NUMBER":
-        return "magic_notifier.utils.get_user_number"
-
-
-def notifier_settings_for_twilio(*args, **kwargs):
-    if args[0] == "SMS::DEFAULT_GATEWAY":
-        return "TWILIO"
-    elif args[0] == "SMS":
-        return {
-                    "GATEWAYS": {
-                        "TWILIO": {
-                            "CLIENT": "magic_notifier.sms_clients.twilio_client.TwilioClient",
-                            "ACCOUNT": "sub_account",
-                            "TOKEN": "token",
-                            "FROM_NUMBER": "from_number"
-                        }
-                    }
-                }
-    elif args[0] == "GET_USER_NUMBER":
-        return "magic_notifier.utils.get_user_number"
-
-
 class SmsTestCase(TestCase):
 
-    @patch('magic_notifier.smser.get_settings', side_effect=notifier_settings_for_global_cheap)
-    @patch('magic_notifier.sms_clients.cgsms_client.requests.get', side_effect=send_to_sms_outbox)
-    def test_global_cheap_sms_client(self, mock_get_request, mock_get_settings):
+    @patch('magic_notifier.sms_clients.base.requests.Session.get', side_effect=send_to_sms_outbox)
+    def test_global_cheap_sms_client(self, mock_get_request):
         NOTIFIER = {
             "SMS":{
                 "GATEWAYS": {
@@ -384,9 +537,38 @@ class SmsTestCase(TestCase):
             self.assertEqual(first_message.number, not_profile.phone_number)
             self.assertEqual(first_message.message, "Nice if you get this")
 
-    @patch('magic_notifier.smser.get_settings', side_effect=notifier_settings_for_twilio)
+    @patch('magic_notifier.sms_clients.base.requests.Session.get', side_effect=send_to_sms_outbox)
+    def test_numbers_resolved_in_one_query(self, mock_get_request):
+        NOTIFIER = {
+            "SMS": {
+                "GATEWAYS": {
+                    "CGS": {
+                        "CLIENT": "magic_notifier.sms_clients.cgsms_client.CGSmsClient",
+                        "SUB_ACCOUNT": "sub_account",
+                        "SUB_ACCOUNT_PASSWORD": "sub_account_password"
+                    }
+                },
+                "DEFAULT_GATEWAY": "CGS"
+            }
+        }
+
+        with self.settings(NOTIFIER=NOTIFIER):
+            for i in range(5):
+                user = User.objects.create(email=f"smsuser{i}@localhost", username=f"smsuser{i}")
+                NotifyProfile.objects.create(phone_number=f"+23760000000{i}", user=user)
+            User.objects.create(email="nonumber@localhost", username="nonumber")
+            sent_before = len(sms_outbox)
+
+            # one query for the users and one for their numbers
+            with self.assertNumQueries(2):
+                notify(["sms"], "Test magic notifier", User.objects.all(), final_message="Nice if you get this")
+
+            self.assertEqual(len(sms_outbox) - sent_before, 5)
+            self.assertEqual(sorted(sms.number for sms in sms_outbox[sent_before:]),
+                             [f"+23760000000{i}" for i in range(5)])
+
     @patch('twilio.http.http_client.TwilioHttpClient.request', side_effect=send_to_sms_outbox)
-    def test_twilio_sms_client(self, mock_get_request, mock_get_settings):
+    def test_twilio_sms_client(self, mock_get_request):
         NOTIFIER = {
             "SMS": {
                 "GATEWAYS": {
@@ -414,9 +596,139 @@ class SmsTestCase(TestCase):
             self.assertEqual(first_message.number, not_profile.phone_number)
             self.assertEqual(first_message.message, "Nice if you get this")
 
-    @patch('magic_notifier.smser.get_settings', side_effect=notifier_settings_for_nexa)
-    @patch('magic_notifier.sms_clients.cgsms_client.requests.post', side_effect=send_to_sms_outbox)
-    def test_nexa_sms_client(self, mock_get_request, mock_get_settings):
+    @patch('magic_notifier.sms_clients.base.requests.Session.get', side_effect=send_to_sms_outbox)
+    def test_gateways_resolved_once(self, mock_get_request):
+        NOTIFIER = {
+            "SMS": {
+                "GATEWAYS": {
+                    "CGS": {
+                        "CLIENT": "magic_notifier.sms_clients.cgsms_client.CGSmsClient",
+                        "SUB_ACCOUNT": "sub_account",
+                        "SUB_ACCOUNT_PASSWORD": "sub_account_password"
+                    }
+                },
+                "DEFAULT_GATEWAY": "CGS"
+            }
+        }
+
+        with self.settings(NOTIFIER=NOTIFIER):
+            self.assertIs(registry.get("sms").client_class, CGSmsClient)
+            user = User.objects.create(email="testuser@localhost", username="testuser")
+            NotifyProfile.objects.create(phone_number="+237600000000", user=user)
+
+            with patch('magic_notifier.utils.import_attribute') as mock_import_attribute:
+                notify(["sms"], "Test magic notifier", [user], final_message="Nice if you get this")
+                notify(["sms"], "Test magic notifier", [user], final_message="Nice if you get this")
+            mock_import_attribute.assert_not_called()
+
+        # the registry is rebuilt when the settings change
+        NOTIFIER["SMS"] = {
+            "GATEWAYS": {
+                "NEXA": {
+                    "CLIENT": "magic_notifier.sms_clients.nexa_client.NexaSmsClient",
+                    "EMAIL": "sub_account",
+                    "PASSWORD": "sub_account_password",
+                    "SENDERID": "senderid"
+                },
+                "BROKEN": {
+                    "CLIENT": "magic_notifier.sms_clients.nexa_client.MissingClient"
+                },
+                "MISSING": {
+                    "CLIENT": "magic_notifier.sms_clients.missing_client.MissingClient"
+                }
+            },
+            "DEFAULT_GATEWAY": "NEXA"
+        }
+        with self.settings(NOTIFIER=NOTIFIER):
+            self.assertIs(registry.get("sms").client_class, NexaSmsClient)
+            # the client is only imported when it is used
+            with self.assertRaises(AssertionError):
+                registry.get("sms", "BROKEN").client_class
+            with self.assertRaises(ModuleNotFoundError):
+                registry.get("sms", "MISSING")
+            with self.assertRaises(KeyError):
+                registry.get("sms", "CGS")
+
+    def test_http_session_per_gateway(self):
+        NOTIFIER = {
+            "SMS": {
+                "GATEWAYS": {
+                    "CGS": {
+                        "CLIENT": "magic_notifier.sms_clients.cgsms_client.CGSmsClient",
+                        "SUB_ACCOUNT": "sub_account",
+                        "SUB_ACCOUNT_PASSWORD": "sub_account_password",
+                        "POOL_SIZE": 3,
+                        "RETRIES": 4,
+                        "TIMEOUT": 5
+                    }
+                },
+                "DEFAULT_GATEWAY": "CGS"
+            }
+        }
+
+        with self.settings(NOTIFIER=NOTIFIER):
+            options = registry.get("sms", "CGS").options
+            session = CGSmsClient.get_session(options)
+            self.assertIs(CGSmsClient.get_session(dict(options)), session)
+            self.assertIsNot(NexaSmsClient.get_session(options), session)
+            self.assertIsNot(CGSmsClient.get_session({}), session)
+
+            adapter = session.get_adapter("http://cheapglobalsms.com/api_v1")
+            self.assertEqual(adapter._pool_maxsize, 3)
+            self.assertEqual(adapter.max_retries.total, 4)
+
+            with patch.object(session, 'get', side_effect=send_to_sms_outbox) as mock_get:
+                for i in range(3):
+                    user = User.objects.create(email=f"pooled{i}@localhost", username=f"pooled{i}")
+                    NotifyProfile.objects.create(phone_number=f"+23762000000{i}", user=user)
+                notify(["sms"], "Test magic notifier", User.objects.filter(username__startswith="pooled"),
+                       final_message="Nice if you get this")
+
+            self.assertEqual(mock_get.call_count, 3)
+            self.assertEqual(mock_get.call_args.kwargs["timeout"], 5)
+
+    def test_sms_get_not_retried(self):
+        hits = []
+
+        class UnavailableHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                hits.append(self.path)
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), UnavailableHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        NOTIFIER = {
+            "SMS": {
+                "GATEWAYS": {
+                    "CGS": {
+                        "CLIENT": "magic_notifier.sms_clients.cgsms_client.CGSmsClient",
+                        "SUB_ACCOUNT": "sub_account",
+                        "SUB_ACCOUNT_PASSWORD": "sub_account_password",
+                        "RETRIES": 2,
+                        "RETRY_DELAY": 0,
+                    }
+                },
+                "DEFAULT_GATEWAY": "CGS"
+            }
+        }
+
+        with self.settings(NOTIFIER=NOTIFIER), \
+                patch.object(CGSmsClient, "url", f"http://127.0.0.1:{server.server_port}/api_v1"):
+            res = CGSmsClient.send("+237600000000", "Hello", **registry.get("sms", "CGS").options)
+
+        # the gateway may have sent the sms before failing
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(len(hits), 1)
+
+    @patch('magic_notifier.sms_clients.base.requests.Session.post', side_effect=send_to_sms_outbox)
+    def test_nexa_sms_client(self, mock_get_request):
         NOTIFIER = {
             "SMS": {
                 "GATEWAYS": {
@@ -445,6 +757,342 @@ class SmsTestCase(TestCase):
             self.assertEqual(first_message.message, "Nice if you get this")
 
 
+push_outbox = []
+
+
+def expo_tokens_for_user(user):
+    return [f"ExponentPushToken[{user.username}-{i}]" for i in range(2)]
+
+
+pruned_tokens = []
+
+
+def prune_tokens(tokens):
+    pruned_tokens.extend(tokens)
+
+
+def expo_push_response(url, data=None, **kwargs):
+    messages = json.loads(data)
+    response = mock.MagicMock()
+    response.json.return_value = {'data': [{'status': 'ok', 'id': message['to']} for message in messages]}
+    return response
+
+
+class DummyPushClient:
+
+    def send_many(self, batch, options, remove_notification_fields=None):
+        push_outbox.extend(batch)
+
+
+PUSH_NOTIFIER = {
+    "PUSH": {
+        "DEFAULT_GATEWAY": "dummy",
+        "GATEWAYS": {
+            "dummy": {
+                "CLIENT": "core.tests.DummyPushClient"
+            }
+        }
+    }
+}
+
+
+class RenderingTestCase(TestCase):
+
+    def get_template(self, source: str) -> Template:
+        return engines["django"].from_string(source).template
+
+    def test_template_variables(self):
+        template = self.get_template(
+            "{% load i18n %}{% if user.is_staff and code|default:fallback %}{{ site.name|date:fmt }}{% endif %}"
+            "{% for item in items %}{{ item }}{% empty %}{{ empty }}{% endfor %}"
+            "{% blocktranslate with n=name %}Hi {{ n }} {{ other }}{% endblocktranslate %}{% translate 'Hello' %}"
+        )
+        self.assertEqual(template_variables(template),
+                         {"user", "code", "fallback", "site", "fmt", "items", "item", "empty", "name", "n", "other"})
+        # the included templates are analyzed too
+        self.assertEqual(template_variables(self.get_template("{% include 'notifier/hello/email.txt' %}")), set())
+        self.assertIsNone(template_variables(self.get_template("{% include name %}")))
+        self.assertIsNone(template_variables(self.get_template("{% debug %}")))
+
+    def test_depends_on_recipient(self):
+        self.assertTrue(depends_on_recipient(self.get_template("Hello {{ user.first_name }}")))
+        self.assertTrue(depends_on_recipient(self.get_template("{% with name=user.username %}{{ name }}{% endwith %}")))
+        self.assertFalse(depends_on_recipient(self.get_template("Your code is {{ code }}")))
+
+    def test_notifier_templates_cached(self):
+        notifier_templates.clear()
+        with patch('magic_notifier.rendering.select_template', wraps=select_template) as mock_select:
+            for i in range(3):
+                # whatsapp.txt doesn't exist, sms.txt is used
+                self.assertTrue(get_notifier_template("base", "whatsapp").origin.name.endswith("sms.txt"))
+                self.assertIsNone(get_notifier_template("missing", "sms"))
+        self.assertEqual(mock_select.call_count, 2)
+
+    def test_notifier_templates_reloaded_in_debug(self):
+        with tempfile.TemporaryDirectory() as templates_dir:
+            template_path = Path(templates_dir) / "notifier" / "edited" / "sms.txt"
+            template_path.parent.mkdir(parents=True)
+            template_path.write_text("First {{ code }}")
+            TEMPLATES = [{"BACKEND": "django.template.backends.django.DjangoTemplates", "DIRS": [templates_dir]}]
+
+            with self.settings(DEBUG=True, TEMPLATES=TEMPLATES):
+                self.assertEqual(NotifierTemplate.for_channel("edited", "sms", {"code": 1}).render(None), "First 1")
+                self.assertIsNone(get_notifier_template("edited", "push"))
+
+                template_path.write_text("Second {{ code }}")
+                mtime = template_path.stat().st_mtime + 10
+                os.utime(template_path, (mtime, mtime))
+                (template_path.parent / "push.json").write_text("{}")
+
+                self.assertEqual(NotifierTemplate.for_channel("edited", "sms", {"code": 1}).render(None), "Second 1")
+                self.assertIsNotNone(get_notifier_template("edited", "push"))
+
+    @patch('magic_notifier.sms_clients.base.requests.Session.get', side_effect=send_to_sms_outbox)
+    def test_sms_rendered_once(self, mock_get_request):
+        NOTIFIER = {
+            "SMS": {
+                "GATEWAYS": {
+                    "CGS": {
+                        "CLIENT": "magic_notifier.sms_clients.cgsms_client.CGSmsClient",
+                        "SUB_ACCOUNT": "sub_account",
+                        "SUB_ACCOUNT_PASSWORD": "sub_account_password"
+                    }
+                },
+                "DEFAULT_GATEWAY": "CGS"
+            }
+        }
+
+        with self.settings(NOTIFIER=NOTIFIER):
+            for i in range(5):
+                user = User.objects.create(email=f"rendered{i}@localhost", username=f"rendered{i}")
+                NotifyProfile.objects.create(phone_number=f"+23760000000{i}", user=user)
+            sent_before = len(sms_outbox)
+
+            with patch.object(Template, 'render', autospec=True, side_effect=Template.render) as mock_render:
+                notify(["sms"], "Test magic notifier", User.objects.filter(username__startswith="rendered"),
+                       template="base")
+
+        self.assertEqual(mock_render.call_count, 1)
+        self.assertEqual(len({sms.message for sms in sms_outbox[sent_before:]}), 1)
+        self.assertEqual(len(sms_outbox) - sent_before, 5)
+
+
+class RateLimitTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_sends_paced_by_window(self):
+        clock = FakeClock()
+        limiter = RateLimiter("test:paced", rate=10, burst=5)
+
+        with patch('magic_notifier.ratelimit.time', clock):
+            batches = [(clock.now, len(batch)) for batch in limiter.paced(list(range(12)))]
+
+        self.assertEqual(batches, [(0.0, 5), (0.5, 5), (1.0, 2)])
+
+    def test_limit_shared_through_cache(self):
+        clock = FakeClock()
+        # two processes limiting the same gateway
+        first = RateLimiter("test:shared", rate=2, burst=2)
+        second = RateLimiter("test:shared", rate=2, burst=2)
+
+        with patch('magic_notifier.ratelimit.time', clock):
+            first.acquire(2)
+            self.assertEqual(clock.now, 0.0)
+            second.acquire()
+            self.assertEqual(clock.now, 1.0)
+            RateLimiter("test:unlimited").acquire(100)
+            self.assertEqual(clock.now, 1.0)
+
+    async def test_async_limiter_uses_async_cache(self):
+        limiter = RateLimiter("test:async", rate=1000, burst=5)
+
+        # a blocking call to a network cache would stall the event loop
+        with patch.object(RateLimiter, "take", side_effect=AssertionError("blocking cache call")), \
+                patch.object(cache, "aincr", wraps=cache.aincr) as mock_aincr:
+            batches = [len(batch) async for batch in limiter.apaced(list(range(12)))]
+
+        self.assertEqual(batches, [5, 5, 2])
+        self.assertGreaterEqual(mock_aincr.call_count, 3)
+
+    @patch('magic_notifier.sms_clients.base.requests.Session.get', side_effect=send_to_sms_outbox)
+    def test_sms_gateway_rate_limit(self, mock_get_request):
+        NOTIFIER = {
+            "SMS": {
+                "GATEWAYS": {
+                    "CGS": {
+                        "CLIENT": "magic_notifier.sms_clients.cgsms_client.CGSmsClient",
+                        "SUB_ACCOUNT": "sub_account",
+                        "SUB_ACCOUNT_PASSWORD": "sub_account_password",
+                        "RATE_LIMIT": {"RATE": 2, "BURST": 2}
+                    }
+                },
+                "DEFAULT_GATEWAY": "CGS"
+            }
+        }
+        clock = FakeClock()
+        sent_at = []
+
+        def send_and_record(*args, **kwargs):
+            sent_at.append(clock.now)
+            return send_to_sms_outbox(*args, **kwargs)
+
+        mock_get_request.side_effect = send_and_record
+
+        with self.settings(NOTIFIER=NOTIFIER), patch('magic_notifier.ratelimit.time', clock):
+            for i in range(5):
+                user = User.objects.create(email=f"limited{i}@localhost", username=f"limited{i}")
+                NotifyProfile.objects.create(phone_number=f"+23760000000{i}", user=user)
+            notify(["sms"], "Test magic notifier", User.objects.filter(username__startswith="limited"),
+                   final_message="Nice if you get this")
+
+        self.assertEqual(sent_at, [0.0, 0.0, 1.0, 1.0, 2.0])
+
+
+class FlakySmsClient:
+    """Sms client failing for the numbers in failing"""
+
+    failing = set()
+    sent = []
+
+    @classmethod
+    def send(cls, number: str, text: str, **kwargs):
+        if number in cls.failing:
+            raise ConnectionError(f"the gateway dropped {number}")
+        cls.sent.append(number)
+
+
+class OutboxTestCase(TestCase):
+
+    def test_enqueue_and_process(self):
+        for i in range(3):
+            User.objects.create(email=f"outbox{i}@localhost", username=f"outbox{i}")
+
+        # one query for the users and one insert
+        with self.assertNumQueries(2):
+            notify(["email"], "Test magic notifier", User.objects.filter(username__startswith="outbox"),
+                   final_message="Nice if you get this", enqueue=True)
+        self.assertEqual(len(mail.outbox), 0) # type: ignore
+        self.assertEqual(OutboxItem.objects.filter(status=OutboxItem.PENDING).count(), 3)
+
+        out = StringIO()
+        call_command("process_outbox", stdout=out)
+        self.assertIn("3 items processed", out.getvalue())
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), # type: ignore
+                         [f"outbox{i}@localhost" for i in range(3)])
+        self.assertEqual(OutboxItem.objects.filter(status=OutboxItem.SENT, attempts=1).count(), 3)
+
+    def test_claim_by_priority(self):
+        user = User.objects.create(email="testuser@localhost", username="testuser")
+        low = OutboxItem.objects.create(channel="email", user=user, final_message="low")
+        high = OutboxItem.objects.create(channel="email", user=user, final_message="high", priority=5)
+
+        self.assertEqual(claim_batch(1), [high])
+        self.assertEqual(claim_batch(1), [low])
+        self.assertEqual(claim_batch(1), [])
+
+        high.refresh_from_db()
+        self.assertEqual((high.status, high.attempts), (OutboxItem.PROCESSING, 1))
+        OutboxItem.objects.filter(pk=high.pk).update(updated=timezone.now() - timedelta(hours=1))
+        self.assertEqual(requeue_stale(60), 1)
+        self.assertEqual(claim_batch(1), [high])
+
+    def test_failed_items_are_retried(self):
+        user = User.objects.create(email="testuser@localhost", username="testuser")
+        item = OutboxItem.objects.create(channel="fax", user=user, final_message="Nice if you get this")
+
+        for attempt in range(1, 4):
+            self.assertEqual(process_batch(), 1)
+            item.refresh_from_db()
+            self.assertEqual(item.attempts, attempt)
+            self.assertIn("Unknown sending method fax", item.error)
+        self.assertEqual(item.status, OutboxItem.FAILED)
+        self.assertEqual(process_batch(), 0)
+
+    def test_failed_sends_are_retried(self):
+        from magic_notifier.email_clients.django_email import DjangoEmailClient
+
+        user = User.objects.create(email="testuser@localhost", username="testuser")
+        item = OutboxItem.objects.create(channel="email", user=user, final_message="Nice if you get this")
+        email_connections.close_all()
+
+        with patch.object(DjangoEmailClient, 'get_connection', side_effect=ConnectionRefusedError("refused")):
+            self.assertEqual(process_batch(), 1)
+            item.refresh_from_db()
+            self.assertEqual((item.status, item.attempts), (OutboxItem.PENDING, 1))
+            self.assertIn("ConnectionRefusedError", item.error)
+
+            process_batch()
+            process_batch()
+        item.refresh_from_db()
+        self.assertEqual((item.status, item.attempts), (OutboxItem.FAILED, 3))
+        self.assertEqual(len(mail.outbox), 0) # type: ignore
+
+    def test_delivered_items_not_sent_again(self):
+        NOTIFIER = {
+            "SMS": {
+                "GATEWAYS": {
+                    "flaky": {"CLIENT": "core.tests.FlakySmsClient"}
+                },
+                "DEFAULT_GATEWAY": "flaky"
+            }
+        }
+        numbers = [f"+23762000000{i}" for i in range(3)]
+        items = []
+        for i, number in enumerate(numbers):
+            user = User.objects.create(email=f"flaky{i}@localhost", username=f"flaky{i}")
+            NotifyProfile.objects.create(phone_number=number, user=user)
+            items.append(OutboxItem.objects.create(channel="sms", user=user, final_message="Hello"))
+        no_number = User.objects.create(email="nonumber@localhost", username="nonumber")
+        items.append(OutboxItem.objects.create(channel="sms", user=no_number, final_message="Hello"))
+        FlakySmsClient.sent = []
+        FlakySmsClient.failing = {numbers[1]}
+
+        with self.settings(NOTIFIER=NOTIFIER):
+            self.assertEqual(process_batch(), 4)
+            for item in items:
+                item.refresh_from_db()
+            # the send stopped at the second number, the third one was not reached
+            self.assertEqual([item.status for item in items],
+                             [OutboxItem.SENT, OutboxItem.PENDING, OutboxItem.PENDING, OutboxItem.PENDING])
+            self.assertIn("the gateway dropped", items[1].error)
+            self.assertEqual(items[3].error, "no number found")
+
+            FlakySmsClient.failing = set()
+            self.assertEqual(process_batch(), 3)
+
+        self.assertEqual(FlakySmsClient.sent, numbers)
+        self.assertEqual(OutboxItem.objects.filter(status=OutboxItem.SENT).count(), 3)
+
+    def test_refused_recipients_retried(self):
+        for i in range(2):
+            user = User.objects.create(email=f"refused{i}@localhost", username=f"refused{i}")
+            OutboxItem.objects.create(channel="email", user=user, final_message="Nice if you get this")
+
+        def send_message(emailer, message):
+            if message.to == ["refused1@localhost"]:
+                raise smtplib.SMTPRecipientsRefused({"refused1@localhost": (550, b"unknown")})
+
+        with patch.object(Emailer, 'send_message', autospec=True, side_effect=send_message):
+            process_batch()
+
+        self.assertEqual(OutboxItem.objects.get(user__username="refused0").status, OutboxItem.SENT)
+        refused = OutboxItem.objects.get(user__username="refused1")
+        self.assertEqual(refused.status, OutboxItem.PENDING)
+        self.assertIn("were refused", refused.error)
+
+    def test_stale_items_fail_after_max_attempts(self):
+        user = User.objects.create(email="testuser@localhost", username="testuser")
+        item = OutboxItem.objects.create(channel="email", user=user, final_message="crash", attempts=3,
+                                         status=OutboxItem.PROCESSING)
+        OutboxItem.objects.filter(pk=item.pk).update(updated=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(requeue_stale(60), 0)
+        item.refresh_from_db()
+        self.assertEqual(item.status, OutboxItem.FAILED)
+
+
 class PushNotificationTestCase(TestCase):
 
     def test_load_json(self):
@@ -479,6 +1127,63 @@ class PushNotificationTestCase(TestCase):
         print(notif)
         print(seria.data)
 
+    @override_settings(NOTIFIER=PUSH_NOTIFIER)
+    def test_pusher_bulk_creates_notifications(self):
+        User.objects.bulk_create([User(username=f"pushuser{i}") for i in range(20)])
+        users = list(User.objects.filter(username__startswith="pushuser"))
+        push_outbox.clear()
+
+        pusher = Pusher("just a test", users, 'base', {'data': {'love': 'you'}, 'actions': []})
+        with self.assertNumQueries(1):
+            notif = pusher.send()
+
+        self.assertIsInstance(notif, Notification)
+        self.assertEqual(Notification.objects.filter(user__in=users).count(), 20)
+        self.assertEqual([user for user, _ in push_outbox], users)
+        self.assertTrue(all(notification.pk and notification.user == user for user, notification in push_outbox))
+
+    def test_expo_client_batches_messages(self):
+        from magic_notifier.push_clients.expo import ExpoClient
+
+        users = [User(username=f"expouser{i}") for i in range(3)]
+        batch = [(user, NotificationBuilder("Hello").text("Hi").user(user).build()) for user in users]
+        session = mock.MagicMock()
+        session.post.side_effect = expo_push_response
+
+        with patch.object(ExpoClient, 'get_session', return_value=session), \
+                patch.object(ExpoClient, 'max_messages', 4):
+            tickets = ExpoClient().send_many(batch, {'GET_TOKENS_FUNCTION': 'core.tests.expo_tokens_for_user'})
+
+        self.assertEqual(session.post.call_count, 2)
+        self.assertEqual(len(tickets), 6)
+        for token, ticket in tickets.items():
+            self.assertEqual(ticket['id'], token)
+
+    def test_fcm_client_collects_unregistered_tokens(self):
+        from pyfcm.errors import FCMNotRegisteredError
+        from magic_notifier.push_clients.fcm import FCMClient
+
+        def fcm_notify(fcm_token, **kwargs):
+            if fcm_token.endswith("-1]"):
+                raise FCMNotRegisteredError("Token not registered")
+            return {"name": fcm_token}
+
+        users = [User(username=f"fcmuser{i}") for i in range(3)]
+        batch = [(user, NotificationBuilder("Hello").text("Hi").user(user).build()) for user in users]
+        fcm = mock.MagicMock()
+        fcm.notify.side_effect = fcm_notify
+        pruned_tokens.clear()
+
+        with patch.object(FCMClient, 'get_fcm', return_value=fcm):
+            unregistered = FCMClient().send_many(batch, {
+                'GET_TOKENS_FUNCTION': 'core.tests.expo_tokens_for_user',
+                'UNREGISTERED_TOKENS_FUNCTION': 'core.tests.prune_tokens',
+            })
+
+        self.assertEqual(fcm.notify.call_count, 6)
+        self.assertEqual(sorted(unregistered), [f"ExponentPushToken[fcmuser{i}-1]" for i in range(3)])
+        self.assertEqual(sorted(pruned_tokens), sorted(unregistered))
+
     def test_send_push_via_fcm(self):
         user = User.objects.create_user('testuser')
         notify(['push'], "Super cool", [user], template="testfcm", remove_notification_fields=['action', 'link',
@@ -500,6 +1205,380 @@ class LivePushNotificationTestCase(LiveServerTestCase):
         print(seria.data)
 
 
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class WahaSchedulerTestCase(TestCase):
+
+    def send_with_concurrency(self, concurrency):
+        clock = FakeClock()
+        session = mock.MagicMock()
+        session.get.return_value.json.side_effect = lambda: {'numberExists': True, 'chatId': 'chat@c.us'}
+        messages = [(f"+23760000000{i}", f"Hello {i}") for i in range(10)]
+
+        with patch('magic_notifier.whatsapp_clients.waha_client.time', clock), \
+                patch.object(WahaClient, 'get_session', return_value=session):
+            WahaClient.send_many(messages, BASE_URL="http://waha", CONCURRENCY=concurrency, TYPING_DELAY=(5, 5))
+
+        sent = [call for call in session.post.call_args_list if call.args[0].endswith("/api/sendText")]
+        self.assertEqual([call.kwargs['json']['text'] for call in sent], [f"Hello {i}" for i in range(10)])
+        return clock.now
+
+    def test_typing_delays_overlap(self):
+        self.assertEqual(self.send_with_concurrency(20), 5)
+        self.assertEqual(self.send_with_concurrency(2), 25)
+
+    def test_rate_limit_taken_per_message(self):
+        NOTIFIER = {
+            "WHATSAPP": {
+                "GATEWAYS": {
+                    "waha": {
+                        "CLIENT": "magic_notifier.whatsapp_clients.waha_client.WahaClient",
+                        "BASE_URL": "http://waha",
+                        "TYPING_DELAY": (5, 5),
+                        "RATE_LIMIT": {"RATE": 2, "BURST": 2}
+                    }
+                },
+                "DEFAULT_GATEWAY": "waha"
+            }
+        }
+        cache.clear()
+        clock = FakeClock()
+        session = mock.MagicMock()
+        session.get.return_value.json.side_effect = lambda: {'numberExists': True, 'chatId': 'chat@c.us'}
+        started_at = []
+
+        def post(url, **kwargs):
+            if url.endswith("/api/startTyping"):
+                started_at.append(clock.now)
+            return mock.DEFAULT
+
+        session.post.side_effect = post
+        for i in range(5):
+            user = User.objects.create(email=f"wlimited{i}@localhost", username=f"wlimited{i}")
+            NotifyProfile.objects.create(phone_number=f"+23760000000{i}", user=user)
+
+        with self.settings(NOTIFIER=NOTIFIER), patch('magic_notifier.ratelimit.time', clock), \
+                patch('magic_notifier.whatsapp_clients.waha_client.time', clock), \
+                patch.object(WahaClient, 'get_session', return_value=session):
+            whatsapper = Whatsapper(User.objects.filter(username__startswith="wlimited"), {},
+                                    final_message="Hello")
+            whatsapper.send()
+
+        # the chats start at the rate of the gateway while the previous ones are still typing
+        self.assertEqual(started_at, [0.0, 0.0, 1.0, 1.0, 2.0])
+        self.assertEqual(clock.now, 7.0)
+        self.assertEqual(len(whatsapper.delivered), 5)
+
+
+class SlowAsyncSmsClient:
+    """Async sms client recording the number of sends in flight"""
+
+    in_flight = 0
+    max_in_flight = 0
+    sent = []
+
+    @classmethod
+    async def asend(cls, number: str, text: str, **kwargs):
+        cls.in_flight += 1
+        cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        await asyncio.sleep(0.01)
+        cls.sent.append((number, text))
+        cls.in_flight -= 1
+
+
+class AsyncNotifyTestCase(TestCase):
+
+    async def test_anotify_email(self):
+        users = [User(email=f"asyncuser{i}@localhost", username=f"asyncuser{i}") for i in range(3)]
+
+        await anotify(["email"], "Test magic notifier", users, template='hello',
+                      files=[str(Path(__file__).parent / "models.py")])
+
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), # type: ignore
+                         [user.email for user in users])
+        self.assertEqual(len(mail.outbox[0].attachments), 1) # type: ignore
+
+    async def test_anotify_sms_concurrency(self):
+        NOTIFIER = {
+            "SMS": {
+                "GATEWAYS": {
+                    "slow": {"CLIENT": "core.tests.SlowAsyncSmsClient"}
+                },
+                "DEFAULT_GATEWAY": "slow"
+            }
+        }
+        for i in range(5):
+            user = await User.objects.acreate(email=f"asms{i}@localhost", username=f"asms{i}")
+            await NotifyProfile.objects.acreate(phone_number=f"+23761000000{i}", user=user)
+        SlowAsyncSmsClient.sent = []
+
+        with self.settings(NOTIFIER=NOTIFIER):
+            await anotify(["sms"], "Test magic notifier", User.objects.filter(username__startswith="asms"),
+                          final_message="Nice if you get this", concurrency=2)
+
+        self.assertEqual(sorted(number for number, text in SlowAsyncSmsClient.sent),
+                         [f"+23761000000{i}" for i in range(5)])
+        self.assertEqual(SlowAsyncSmsClient.max_in_flight, 2)
+
+    async def test_waha_asend_many(self):
+        client = mock.MagicMock()
+        client.get = mock.AsyncMock()
+        client.get.return_value.json = lambda: {'numberExists': True, 'chatId': 'chat@c.us'}
+        client.post = mock.AsyncMock()
+        messages = [(f"+23760000000{i}", f"Hello {i}") for i in range(10)]
+
+        with patch('magic_notifier.aio.get_http_client', return_value=client):
+            await WahaClient.asend_many(messages, BASE_URL="http://waha", CONCURRENCY=3, TYPING_DELAY=(0, 0))
+
+        actions = [call.args[0].rsplit("/", 1)[1] for call in client.post.call_args_list]
+        self.assertEqual(actions.count("startTyping"), 10)
+        self.assertEqual(sorted(call.kwargs['json']['text'] for call in client.post.call_args_list
+                                if call.args[0].endswith("/api/sendText")), [f"Hello {i}" for i in range(10)])
+
+
+class PushConsumerTestCase(TestCase):
+
+    def setUp(self):
+        ws_users.clear()
+        self.application = URLRouter([path("ws/notifications/<str:token>/", PushNotifConsumer.as_asgi())])
+
+    async def test_token_users_cached(self):
+        user = await User.objects.acreate(username="wsuser", email="wsuser@localhost")
+        await Notification.objects.acreate(user=user, subject="Hello", text="Hi", type="info", link="")
+
+        with patch('magic_notifier.consumers.fetch_user_from_ws_token', return_value=user) as mock_fetch:
+            for i in range(2):
+                communicator = WebsocketCommunicator(self.application, "ws/notifications/secret/")
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+
+                await communicator.send_json_to({"type": "unread"})
+                self.assertEqual((await communicator.receive_json_from())["count"], 1)
+
+                await get_channel_layer().group_send(f"user-{user.id}", {"type": "notification", "text": "Hi"})
+                self.assertEqual((await communicator.receive_json_from())["text"], "Hi")
+                await communicator.disconnect()
+
+        self.assertEqual(mock_fetch.call_count, 1)
+
+    async def test_unread_paginated(self):
+        user = await User.objects.acreate(username="wspager", email="wspager@localhost")
+        ids = [(await Notification.objects.acreate(user=user, subject=f"Hello {i}", text="Hi", type="info",
+                                                   link="")).id for i in range(5)]
+        await Notification.objects.acreate(user=user, subject="Read", text="Hi", type="info", link="",
+                                           read=timezone.now())
+
+        with patch('magic_notifier.consumers.fetch_user_from_ws_token', return_value=user):
+            communicator = WebsocketCommunicator(self.application, "ws/notifications/pager/")
+            await communicator.connect()
+
+            pages = []
+            cursor = None
+            while True:
+                await communicator.send_json_to({"type": "unread", "limit": 2, "cursor": cursor})
+                response = await communicator.receive_json_from()
+                self.assertEqual(response["count"], 5)
+                pages.append([notification["id"] for notification in response["notifications"]])
+                cursor = response["next_cursor"]
+                if cursor is None:
+                    break
+            self.assertEqual(pages, [ids[:2:-1], ids[2:0:-1], ids[:1]])
+
+            await communicator.send_json_to({"type": "unread", "since_id": ids[2]})
+            response = await communicator.receive_json_from()
+            self.assertEqual([notification["id"] for notification in response["notifications"]], ids[:2:-1])
+            self.assertIsNone(response["next_cursor"])
+
+            await communicator.send_json_to({"type": "unread", "cursor": "abc"})
+            self.assertIn("error", await communicator.receive_json_from())
+            await communicator.disconnect()
+
+    async def test_only_client_events_handled(self):
+        user = await User.objects.acreate(username="wsevents", email="wsevents@localhost")
+        notification = await Notification.objects.acreate(user=user, subject="Hello", text="Hi", type="info",
+                                                           link="")
+
+        with patch('magic_notifier.consumers.fetch_user_from_ws_token', return_value=user):
+            communicator = WebsocketCommunicator(self.application, "ws/notifications/events/")
+            await communicator.connect()
+
+            # the helpers of the handlers and the methods of the consumer are not events
+            for event_type in ("mark_read", "get_unread", "close", "websocket.disconnect"):
+                await communicator.send_json_to({"type": event_type})
+            await communicator.send_json_to({"text": "no type"})
+            self.assertTrue(await communicator.receive_nothing())
+
+            await communicator.send_json_to({"type": "markread"})
+            self.assertTrue((await communicator.receive_json_from())["success"])
+            await communicator.disconnect()
+
+        await notification.arefresh_from_db()
+        self.assertIsNotNone(notification.read)
+
+    async def test_bad_token_closed(self):
+        with patch('magic_notifier.consumers.fetch_user_from_ws_token', side_effect=ObjectDoesNotExist):
+            communicator = WebsocketCommunicator(self.application, "ws/notifications/bad/")
+            await communicator.connect()
+            self.assertEqual((await communicator.receive_output())["type"], "websocket.close")
+            await communicator.disconnect()
+
+
+class PurgeNotificationsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email="purge@localhost", username="purge")
+        now = timezone.now()
+
+        def create(count, **kwargs):
+            return [Notification.objects.create(user=self.user, text="Hi", type="info", link="", **kwargs).pk
+                    for i in range(count)]
+
+        self.expired = create(5, expires=now - timedelta(hours=1))
+        self.valid = create(2, expires=now + timedelta(hours=1))
+        self.old_read = create(3, read=now - timedelta(days=40))
+        self.recent_read = create(2, read=now)
+        self.old_unread = create(2)
+        Notification.objects.filter(pk__in=self.old_read + self.old_unread).update(sent=now - timedelta(days=40))
+
+    def test_purge_command(self):
+        out = StringIO()
+        with CaptureQueriesContext(connection) as context:
+            call_command("purge_notifications", chunk_size=2, sleep=0, stdout=out)
+
+        self.assertIn("8 notifications deleted", out.getvalue())
+        self.assertIn("rows/s", out.getvalue())
+        self.assertEqual(set(Notification.objects.values_list("pk", flat=True)),
+                         set(self.valid + self.recent_read + self.old_unread))
+        # no statement deletes more than a chunk
+        deletes = [query for query in context.captured_queries if query["sql"].startswith("DELETE")]
+        self.assertEqual(len(deletes), 5)
+
+    def test_purge_task(self):
+        from magic_notifier.tasks import purge_notifications as purge_task
+
+        with self.assertLogs("notifier", level="INFO") as logs:
+            self.assertEqual(purge_task(read_retention=30), 8)
+
+        self.assertIn("8 notifications deleted", logs.output[-1])
+        self.assertIn("rows/s", logs.output[-1])
+
+    def test_purge_expired_only(self):
+        self.assertEqual(purge_notifications(expired_only=True, sleep=0), 5)
+        self.assertEqual(purge_notifications(read_retention=60, sleep=0), 0)
+        self.assertEqual(purge_notifications(read_retention=10, sleep=0), 3)
+
+
+class NotificationQueryTestCase(TestCase):
+    """The queries of the consumer and the builder against a generated table, their count and their indexes"""
+
+    @classmethod
+    def setUpTestData(cls):
+        users = User.objects.bulk_create([User(username=f"reader{i}", email=f"reader{i}@localhost")
+                                          for i in range(50)])
+        now = timezone.now()
+        # most notifications are read and never expire
+        Notification.objects.bulk_create([
+            Notification(user=user, subject=f"Hello {i}", text="Hi", type="info", link="",
+                         read=None if i % 10 == 0 else now,
+                         expires=now + timedelta(days=i - 50) if i % 20 == 0 else None)
+            for user in users for i in range(100)
+        ], batch_size=1000)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        cls.user = users[0]
+
+    def explain(self, sql: str) -> str:
+        prefix = "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql)
+            return "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
+
+    def assertUseIndex(self, queries, index: str):
+        for query in queries:
+            self.assertIn(index, self.explain(query["sql"]), query["sql"])
+
+    def test_consumer_unread(self):
+        consumer = PushNotifConsumer()
+        consumer.user = self.user
+
+        with CaptureQueriesContext(connection) as context:
+            count, notifications, next_cursor = async_to_sync(consumer.get_unread)(limit=5)
+            async_to_sync(consumer.get_unread)(cursor=next_cursor, limit=5)
+
+        self.assertEqual(count, 10)
+        # a count and a page by call
+        self.assertEqual(len(context.captured_queries), 4)
+        self.assertUseIndex(context.captured_queries, "magic_notif_unread_idx")
+
+    def test_consumer_markread(self):
+        consumer = PushNotifConsumer()
+        consumer.user = self.user
+
+        with CaptureQueriesContext(connection) as context:
+            async_to_sync(consumer.mark_read)()
+
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertUseIndex(context.captured_queries, "magic_notif_unread_idx")
+        self.assertFalse(Notification.objects.filter(user=self.user, read__isnull=True).exists())
+
+    def test_recent_and_expired(self):
+        with CaptureQueriesContext(connection) as context:
+            list(Notification.objects.filter(user=self.user).order_by("-sent")[:20])
+        self.assertUseIndex(context.captured_queries, "magic_notif_user_sent_idx")
+
+        with CaptureQueriesContext(connection) as context:
+            expired = Notification.objects.filter(expires__lt=timezone.now()).count()
+        self.assertEqual(expired, 50 * 3)
+        self.assertUseIndex(context.captured_queries, "magic_notif_expires_idx")
+
+    def test_builder_save(self):
+        with self.assertNumQueries(1):
+            NotificationBuilder("Hello").text("Hi").type("info").link("").user(self.user).save()
+
+    def test_builder_save_many(self):
+        builder = NotificationBuilder("Hello").text("Hi").type("info").link("").data({"a": 1})
+        users = User.objects.filter(username__startswith="reader")
+
+        with self.assertNumQueries(3):
+            # the users and two inserts
+            notifications = builder.save_many(users, batch_size=25)
+
+        self.assertEqual(len(notifications), 50)
+        self.assertTrue(all(notification.pk for notification in notifications))
+        self.assertEqual({notification.user_id for notification in notifications},
+                         set(users.values_list("pk", flat=True)))
+        notifications[0].data["a"] = 2
+        self.assertEqual(notifications[1].data, {"a": 1})
+
+        with self.assertRaises(ValueError):
+            NotificationBuilder("Hello").type("info").link("").save_many(users)
+
+    def test_builder_bulk_save(self):
+        users = list(User.objects.filter(username__startswith="reader")[:3])
+        builders = [NotificationBuilder(f"Hello {user.username}").text("Hi").type("info").link("").user(user)
+                    for user in users]
+
+        with self.assertNumQueries(1):
+            notifications = NotificationBuilder.bulk_save(builders)
+
+        self.assertEqual([notification.subject for notification in Notification.objects.filter(
+            pk__in=[notification.pk for notification in notifications]).order_by("pk")],
+            [f"Hello {user.username}" for user in users])
+
+
 class WhatsappNotificationTestCase(LiveServerTestCase):
 
     def test_waha_client(self):
@@ -515,6 +1594,48 @@ class WhatsappNotificationTestCase(LiveServerTestCase):
         whatsapper.send()
 
 
+class TelethonClientTestCase(TestCase):
+
+    def test_contacts_imported_once_by_batches(self):
+        from telethon.errors import FloodWaitError
+
+        client = mock.AsyncMock()
+        # telegram asks to wait once, the message is sent again
+        client.send_message.side_effect = [FloodWaitError(None, capture=0)] + [None] * 10
+        messages = [(f"+23760000000{i}", "Jeff", "Matt", f"Hello {i}") for i in range(5)]
+
+        with patch.object(TelethonClient, 'get_client', return_value=client):
+            TelethonClient.send_many(messages, "test-gateway", CONTACTS_BATCH_SIZE=2)
+            TelethonClient.send_many(messages, "test-gateway", CONTACTS_BATCH_SIZE=2)
+
+        imports = [call.args[0] for call in client.call_args_list]
+        self.assertEqual([len(request.contacts) for request in imports], [2, 2, 1])
+        self.assertEqual(client.send_message.await_count, 11)
+
+    def test_client_started_once(self):
+        starts = []
+
+        async def start_client(gateway, **kwargs):
+            starts.append(gateway)
+            await asyncio.sleep(0.05)
+            if len(starts) == 1:
+                raise ConnectionError("telegram unreachable")
+            return object()
+
+        self.addCleanup(TelethonClient.running_clients.pop, "start-gateway", None)
+        with patch.object(TelethonClient, 'start_client', side_effect=start_client):
+            with self.assertRaises(ConnectionError):
+                TelethonClient.get_client("start-gateway")
+
+            # the first sends of the worker threads and of an event loop
+            with ThreadPoolExecutor(4) as executor:
+                clients = list(executor.map(lambda i: TelethonClient.get_client("start-gateway"), range(4)))
+            clients.append(async_to_sync(TelethonClient.aget_client)("start-gateway"))
+
+        self.assertEqual(starts, ["start-gateway"] * 2)
+        self.assertEqual(len(set(map(id, clients))), 1)
+
+
 class TelegramNotificationTestCase(LiveServerTestCase):
 
     def test_telethon_client(self):
@@ -540,3 +1661,41 @@ class AllNotificationTestCase(LiveServerTestCase):
                                                    user=user)
         notify(['sms', 'whatsapp', 'telegram'], "Code",[user],
                final_message="Salut Fedim Stephane. Ceci est un test d'envoi de code")
+
+
+class ImportTestCase(TestCase):
+
+    def run_fresh(self, code: str) -> list:
+        """Run the code in a fresh interpreter, the modules of this one are already imported"""
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE="example.settings",
+                   PYTHONPATH=os.pathsep.join(sys.path))
+        return subprocess.run([sys.executable, "-c", code], env=env, check=True,
+                              capture_output=True, text=True).stdout.splitlines()
+
+    def test_notifier_import_is_lazy(self):
+        output = self.run_fresh(
+            "import sys, django\n"
+            "django.setup()\n"
+            "import magic_notifier.notifier\n"
+            "print(' '.join(sys.modules))\n"
+        )
+        modules = set(output[0].split())
+
+        for module in ("telethon", "twilio", "pyfcm", "mjml", "channels.layers",
+                       "magic_notifier.emailer", "magic_notifier.pusher", "magic_notifier.smser",
+                       "magic_notifier.whatsapper", "magic_notifier.telegramer"):
+            self.assertNotIn(module, modules)
+
+    @skipUnless(os.environ.get("NOTIFIER_BENCHMARKS"), "set NOTIFIER_BENCHMARKS to run the benchmarks")
+    def test_notifier_import_time(self):
+        output = self.run_fresh(
+            "import gc, time, django\n"
+            "django.setup()\n"
+            # the collection owed by the setup would be counted in the import
+            "gc.collect()\n"
+            "start = time.perf_counter()\n"
+            "import magic_notifier.notifier\n"
+            "print(time.perf_counter() - start)\n"
+        )
+        # the sdk of the channels took tens of milliseconds
+        self.assertLess(float(output[0]), 0.02)